@@ -69,8 +69,11 @@ Author: Aur Saraf
     1110101010000111
 """
 
+from array import array
+import mmap
 import os
 import re
+import struct
 import sys
 
 NEWLINE = "\n"
@@ -127,6 +130,16 @@ C_INSTRUCTION_RE = re.compile("^(?:(A?M?D?)=|)(%s)(?:|;(%s))$" % (comps, jumps))
 del comps
 del jumps
 
+# Integer bit fields, so that a C instruction is encoded with a couple
+# of ORs instead of string concatenation.
+C_INSTRUCTION_PREFIX = 0b111 << 13
+COMP_BITS = dict((key, int(value, 2) << 6) for key, value in COMPS.items())
+DEST_BITS = dict((key, int(value, 2) << 3) for key, value in DESTS.items())
+JUMP_BITS = dict((key, int(value, 2)) for key, value in JUMPS.items())
+WORD_FORMAT = "{0:016b}"
+# binary ROMs hold raw little-endian 16 bit words
+BINARY_WORD = struct.Struct("<H")
+
 BUILTIN_SYMBOLS = {"SCREEN": 0x4000, "KBD": 0x6000}
 for i, name in enumerate("SP LCL ARG THIS THAT".split()):
     BUILTIN_SYMBOLS[name] = i
@@ -135,6 +148,10 @@ for i in xrange(16):
 del i
 del name
 
+# Kinds of the (kind, value) instruction tuples that link() resolves.
+# WORD values are already encoded machine words.
+WORD, SYMBOL, LABEL = range(3)
+
 class SyntaxError(Exception):
     pass
 
@@ -142,6 +159,12 @@ class Command(object):
     def is_instruction(self):
         return True
 
+    def instruction(self):
+        return WORD, self.encode()
+
+    def code(self):
+        return WORD_FORMAT.format(self.encode())
+
     def __repr__(self):
         return "%s(%r)" % (self.__class__.__name__, self.value)
 
@@ -154,8 +177,8 @@ class NumericLiteral(Literal):
             raise SyntaxError("Literal out of range: %d" % value)
         self.value = value
 
-    def code(self):
-        return "{0:016b}".format(self.value)
+    def encode(self):
+        return self.value
 
 class SymbolLiteral(Literal):
     def __init__(self, value):
@@ -163,6 +186,9 @@ class SymbolLiteral(Literal):
             raise SyntaxError("Invalid symbol: %s" % value)
         self.value = value
 
+    def instruction(self):
+        return SYMBOL, self.value
+
 class Label(Command):
     def __init__(self, value):
         if not SYMBOL_RE.match(value):
@@ -172,14 +198,17 @@ class Label(Command):
     def is_instruction(self):
         return False
 
+    def instruction(self):
+        return LABEL, self.value
+
 class CInstruction(Command):
     def __init__(self, dest, comp, jump):
         self.dest = dest
         self.comp = comp
         self.jump = jump
 
-    def code(self):
-        return "111" + COMPS[self.comp] + DESTS[self.dest] + JUMPS[self.jump]
+    def encode(self):
+        return C_INSTRUCTION_PREFIX | COMP_BITS[self.comp] | DEST_BITS[self.dest] | JUMP_BITS[self.jump]
 
     def __repr__(self):
         return "%s(%r, %r, %r)" % (self.__class__.__name__, self.dest, self.comp, self.jump)
@@ -269,7 +298,20 @@ def parser(text):
     ... 0;JMP''')))
     29
     """
-    for line in text.splitlines():
+    return parse_lines(text.splitlines())
+
+
+def parse_lines(lines):
+    """
+    Parses an iterable of lines, e.g. an open file, lazily.
+
+    >>> list(parse_lines(["@1 // one\\n", "(X)\\n", "D=A\\n"]))
+    [NumericLiteral(1), Label('X'), CInstruction('D', 'A', None)]
+    """
+    # C instructions are immutable and heavily repeated, so each distinct
+    # one is parsed (and regex matched) only once
+    c_instructions = {}
+    for line in lines:
         if "//" in line:
             line = line[:line.find("//")]
         line = line.strip()
@@ -284,7 +326,10 @@ def parser(text):
         elif line.startswith("(") and line.endswith(")"):
             yield Label(line[1:-1])
         else:
-            yield CInstruction.parse(line)
+            instruction = c_instructions.get(line)
+            if instruction is None:
+                instruction = c_instructions[line] = CInstruction.parse(line)
+            yield instruction
 
 
 def code(commands):
@@ -320,31 +365,341 @@ def code(commands):
     >>> code([SymbolLiteral("i"), Label("i")])
     '0000000000000001'
     """
-    commands = list(commands)
+    return render(assemble(commands))
+
+
+def assemble(commands, labels=None):
+    """
+    Encodes commands into an array of 16 bit machine words in a single
+    pass. Symbols that are not yet known (forward label references and
+    variables) are patched in once all labels have been seen.
+
+    If labels is a dict, every label's ROM address is recorded in it.
+
+    >>> assemble([])
+    array('H')
+    >>> assemble([NumericLiteral(7), CInstruction("D", "A", None)])
+    array('H', [7, 60432])
+    >>> labels = {}
+    >>> assemble([SymbolLiteral("END"), SymbolLiteral("x"), Label("END"), SymbolLiteral("SCREEN")], labels)
+    array('H', [2, 16, 16384])
+    >>> labels
+    {'END': 2}
+    """
+    return link((command.instruction() for command in commands), labels)
+
+
+def link(instructions, labels=None):
+    """
+    Resolves symbols in (kind, value) instruction tuples, as produced by
+    Command.instruction(), and returns the machine words. Code
+    generators can feed this directly, skipping the assembly text.
+
+    >>> link([(SYMBOL, "END"), (WORD, 60432), (LABEL, "END"), (SYMBOL, "x")])
+    array('H', [2, 60432, 16])
+    """
+    symbols = dict(BUILTIN_SYMBOLS)
+    words = array("H")
+    append = words.append
+    fixups = []
+    for kind, value in instructions:
+        if kind == WORD:
+            append(value)
+        elif kind == SYMBOL:
+            fixups.append((len(words), value))
+            append(0)
+        else:
+            if value in symbols:
+                raise SyntaxError("Label redefined: %s" % value)
+            symbols[value] = len(words)
+            if labels is not None:
+                labels[value] = len(words)
+
+    first_free_variable = 16
+    for address, symbol in fixups:
+        if symbol not in symbols:
+            symbols[symbol] = first_free_variable
+            first_free_variable += 1
+        words[address] = symbols[symbol]
+    return words
+
+
+def render(words):
+    """
+    Renders machine words in the textual .hack format.
+
+    >>> render(array("H", [1, 0xFFFF]))
+    '0000000000000001\\n1111111111111111'
+    """
+    return NEWLINE.join(WORD_FORMAT.format(word) for word in words)
+
+
+def to_binary(words):
+    """
+    Returns the raw little-endian bytes of an array of machine words.
+
+    >>> to_binary(array("H", [1, 0x8000]))
+    '\\x01\\x00\\x00\\x80'
+    """
+    if sys.byteorder != "little":
+        words = array("H", words)
+        words.byteswap()
+    return words.tostring()
 
+
+class Rom(object):
+    """
+    A read-only view of the words in a binary ROM file. The file is
+    memory-mapped and words are unpacked on access, so nothing is
+    copied or parsed up front.
+
+    >>> import tempfile
+    >>> with tempfile.NamedTemporaryFile(suffix=".bin") as binfile:
+    ...     binfile.write(to_binary(array("H", [7, 60432])))
+    ...     binfile.flush()
+    ...     with Rom(binfile.name) as rom:
+    ...         (len(rom), rom[0], rom[-1], list(rom), rom.words())
+    (2, 7, 60432, [7, 60432], array('H', [7, 60432]))
+    """
+    def __init__(self, path):
+        with open(path, "rb") as romfile:
+            size = os.fstat(romfile.fileno()).st_size
+            if size % BINARY_WORD.size:
+                raise SyntaxError("Truncated binary ROM: %s" % path)
+            if size:
+                self.buffer = mmap.mmap(romfile.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                # empty files can't be mapped
+                self.buffer = ""
+        self.size = size // BINARY_WORD.size
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, address):
+        if address < 0:
+            address += self.size
+        if not 0 <= address < self.size:
+            raise IndexError("ROM address out of range: %d" % address)
+        return BINARY_WORD.unpack_from(self.buffer, address * BINARY_WORD.size)[0]
+
+    def __iter__(self):
+        unpack_from = BINARY_WORD.unpack_from
+        for offset in xrange(0, self.size * BINARY_WORD.size, BINARY_WORD.size):
+            yield unpack_from(self.buffer, offset)[0]
+
+    def words(self):
+        """
+        Copies the whole ROM into an array of machine words.
+        """
+        words = array("H")
+        words.fromstring(self.buffer[:])
+        if sys.byteorder != "little":
+            words.byteswap()
+        return words
+
+    def close(self):
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Comments vm.py writes before each command's code with --source-lines,
+# e.g. "//> Main.vm:12"; a bare "//>" means no VM source.
+LOCATION_PREFIX = "//>"
+NO_FILE = -1
+SOURCE_MAP_EXTENSION = ".map"
+SOURCE_MAP_MAGIC = "HACKMAP2"
+SOURCE_MAP_HEADER = struct.Struct("<II")
+SOURCE_MAP_NAME = struct.Struct("<H")
+
+
+class SourceMap(object):
+    """
+    Maps ROM addresses to the .asm line of their instruction and the VM
+    file and line it was translated from. Kept as three parallel arrays
+    of ints (asm line, VM file index, VM line) so a full ROM takes 384K.
+
+    >>> source_map = SourceMap.from_lines('''//> Main.vm:3
+    ... // push constant 1
+    ... @1
+    ... D=A
+    ... //>
+    ... (END)
+    ... @END'''.splitlines())
+    >>> len(source_map), source_map[0], source_map[1], source_map[2]
+    (3, (3, 'Main.vm', 3), (4, 'Main.vm', 3), (7, None, None))
+    >>> from StringIO import StringIO
+    >>> mapfile = StringIO()
+    >>> source_map.write(mapfile)
+    >>> SourceMap.read(StringIO(mapfile.getvalue()))[1]
+    (4, 'Main.vm', 3)
+    >>> SourceMap.from_lines(["//> Main.vm:70000", "@1"])[0]
+    (2, 'Main.vm', 70000)
+    """
+    def __init__(self):
+        self.files = []
+        self.file_indices = {}
+        self.asm_lines = array("i")
+        self.vm_files = array("i")
+        self.vm_lines = array("i")
+
+    @classmethod
+    def from_lines(cls, lines):
+        """
+        Builds the map of assembly source lines, counting instructions
+        the same way parse_lines() does.
+        """
+        source_map = cls()
+        vm_file = NO_FILE
+        vm_line = 0
+        for number, line in enumerate(lines, 1):
+            line = line.strip()
+            if line.startswith(LOCATION_PREFIX):
+                location = line[len(LOCATION_PREFIX):].strip()
+                if location:
+                    filename, vm_line = location.rsplit(":", 1)
+                    vm_file = source_map.file_index(filename)
+                    vm_line = int(vm_line)
+                else:
+                    vm_file = NO_FILE
+                    vm_line = 0
+                continue
+            if "//" in line:
+                line = line[:line.find("//")].strip()
+            if line == "" or (line.startswith("(") and line.endswith(")")):
+                continue
+            source_map.asm_lines.append(number)
+            source_map.vm_files.append(vm_file)
+            source_map.vm_lines.append(vm_line)
+        return source_map
+
+    def file_index(self, filename):
+        if filename not in self.file_indices:
+            self.file_indices[filename] = len(self.files)
+            self.files.append(filename)
+        return self.file_indices[filename]
+
+    def __len__(self):
+        return len(self.asm_lines)
+
+    def __getitem__(self, address):
+        """
+        Returns (asm line, VM file, VM line); the VM ones are None for
+        code that has no VM source.
+        """
+        vm_file = self.vm_files[address]
+        if vm_file == NO_FILE:
+            return self.asm_lines[address], None, None
+        return self.asm_lines[address], self.files[vm_file], self.vm_lines[address]
+
+    def write(self, outfile):
+        outfile.write(SOURCE_MAP_MAGIC)
+        outfile.write(SOURCE_MAP_HEADER.pack(len(self.files), len(self)))
+        for filename in self.files:
+            outfile.write(SOURCE_MAP_NAME.pack(len(filename)) + filename)
+        for values in (self.asm_lines, self.vm_files, self.vm_lines):
+            if sys.byteorder != "little":
+                values = array(values.typecode, values)
+                values.byteswap()
+            outfile.write(values.tostring())
+
+    @classmethod
+    def read(cls, mapfile):
+        if mapfile.read(len(SOURCE_MAP_MAGIC)) != SOURCE_MAP_MAGIC:
+            raise SyntaxError("Not a source map")
+        num_files, size = SOURCE_MAP_HEADER.unpack(mapfile.read(SOURCE_MAP_HEADER.size))
+        source_map = cls()
+        for _ in xrange(num_files):
+            length, = SOURCE_MAP_NAME.unpack(mapfile.read(SOURCE_MAP_NAME.size))
+            source_map.file_index(mapfile.read(length))
+        for values in (source_map.asm_lines, source_map.vm_files, source_map.vm_lines):
+            values.fromstring(mapfile.read(size * values.itemsize))
+            if len(values) != size:
+                raise SyntaxError("Truncated source map")
+            if sys.byteorder != "little":
+                values.byteswap()
+        return source_map
+
+
+FORMATS = {
+    "hack": (".hack", render),
+    "bin": (".bin", to_binary),
+}
+STREAM_CHUNK_SIZE = 4096
+
+
+def assemble_stream(asmfile, outfile, output_format="hack"):
+    """
+    Assembles a seekable file into outfile in two passes over the
+    source: the first only records labels, the second encodes and
+    writes words in chunks. Memory use is bounded by the symbol table,
+    not by the size of the program. The output is identical to
+    assembling the whole text at once.
+
+    >>> from StringIO import StringIO
+    >>> source = "@END\\n@x\\n(END)\\n@x\\nD=A"
+    >>> output = StringIO()
+    >>> assemble_stream(StringIO(source), output)
+    4
+    >>> output.getvalue() == code(parser(source))
+    True
+    """
     symbols = dict(BUILTIN_SYMBOLS)
     counter = 0
-    for i, command in enumerate(commands):
-        if command.is_instruction():
-            counter += 1
+    for command in parse_lines(asmfile):
         if isinstance(command, Label):
             if command.value in symbols:
                 raise SyntaxError("Label redefined: %s" % command.value)
             symbols[command.value] = counter
+        else:
+            counter += 1
 
+    asmfile.seek(0)
+    writer = FORMATS[output_format][1]
+    separator = NEWLINE if output_format == "hack" else ""
     first_free_variable = 16
-    for i, command in enumerate(commands):
+    words = array("H")
+    written = 0
+    for command in parse_lines(asmfile):
         if isinstance(command, SymbolLiteral):
             if command.value not in symbols:
                 symbols[command.value] = first_free_variable
                 first_free_variable += 1
-            commands[i] = NumericLiteral(symbols[command.value])
-
-    return NEWLINE.join(command.code() for command in commands if command.is_instruction())
+            words.append(symbols[command.value])
+        elif not isinstance(command, Label):
+            words.append(command.encode())
+        if len(words) == STREAM_CHUNK_SIZE:
+            outfile.write((separator if written else "") + writer(words))
+            written += len(words)
+            words = array("H")
+    if words:
+        outfile.write((separator if written else "") + writer(words))
+        written += len(words)
+    return written
 
 
 def main(args):
-    if len(args) != 1:
+    output_format = "hack"
+    stream = False
+    write_source_map = False
+    while args and args[0].startswith("--"):
+        if args[0].startswith("--format="):
+            output_format = args[0][len("--format="):]
+        elif args[0] == "--stream":
+            stream = True
+        elif args[0] == "--source-map":
+            write_source_map = True
+        else:
+            print_usage()
+            return -1
+        args = args[1:]
+    if len(args) != 1 or output_format not in FORMATS:
         print_usage()
         return -1
     path, = args
@@ -355,14 +710,29 @@ def main(args):
         print "file not found"
         return 1
 
-    with open(path, "rb") as asmfile:
-        hack = code(parser(asmfile.read()))
-    with open(path[:-4] + ".hack", "wb") as hackfile:
-        hackfile.write(hack)
+    extension, writer = FORMATS[output_format]
+    if stream:
+        with open(path, "rb") as asmfile:
+            with open(path[:-4] + extension, "wb") as outfile:
+                assemble_stream(asmfile, outfile, output_format)
+            if write_source_map:
+                asmfile.seek(0)
+                source_map = SourceMap.from_lines(asmfile)
+    else:
+        with open(path, "rb") as asmfile:
+            text = asmfile.read()
+        output = writer(assemble(parser(text)))
+        with open(path[:-4] + extension, "wb") as outfile:
+            outfile.write(output)
+        if write_source_map:
+            source_map = SourceMap.from_lines(text.splitlines())
+    if write_source_map:
+        with open(path[:-4] + SOURCE_MAP_EXTENSION, "wb") as mapfile:
+            source_map.write(mapfile)
     return 0
 
 def print_usage():
-        print "usage: assembler.py path/to/file.asm"
+        print "usage: assembler.py [--format=hack|bin] [--stream] [--source-map] path/to/file.asm"
 
 if __name__ == '__main__':
     import doctest
@@ -0,0 +1,463 @@
+#!/usr/bin/python2
+"""
+An emulator for the nand2tetris Hack computer.
+
+Every ROM word is decoded once, up front, into a tuple the main loop
+can dispatch on directly: the comp function, the dest mask and the
+jump mask. RAM is a flat 32K array of signed 16 bit words.
+
+    >>> emulator = Emulator(assemble(parser('''
+    ... @2
+    ... D=A
+    ... @3
+    ... D=D+A
+    ... @0
+    ... M=D''')))
+    >>> emulator.run(6)
+    6
+    >>> emulator.ram[0], emulator.a, emulator.d, emulator.pc
+    (5, 0, 5, 6)
+"""
+
+from array import array
+import os
+import sys
+
+from assembler import assemble, parser, Rom, COMP_BITS, DEST_BITS, JUMP_BITS, NEWLINE
+
+ROM_SIZE = RAM_SIZE = 2 ** 15
+SCREEN = 0x4000
+KBD = 0x6000
+
+C_INSTRUCTION_BIT = 1 << 15
+COMP_MASK = 0b1111111 << 6
+DEST_MASK = 0b111 << 3
+JUMP_MASK = 0b111
+
+# dest mask bits
+DEST_A = DEST_BITS["A"] >> 3
+DEST_D = DEST_BITS["D"] >> 3
+DEST_M = DEST_BITS["M"] >> 3
+
+# jump mask bits, tested against the sign of the ALU output
+JUMP_LT = JUMP_BITS["JLT"]
+JUMP_EQ = JUMP_BITS["JEQ"]
+JUMP_GT = JUMP_BITS["JGT"]
+
+# keeps a Python int in the signed 16 bit range
+WRAP = "((%s) + 0x8000 & 0xFFFF) - 0x8000"
+
+
+class EmulatorError(Exception):
+    pass
+
+
+def comp_expression(mnemonic):
+    """
+    Returns a Python expression over A, D and M for a comp mnemonic.
+
+    >>> comp_expression("D&M")
+    'D&M'
+    >>> comp_expression("!A")
+    '~A'
+    >>> comp_expression("D-1")
+    '((D-1) + 0x8000 & 0xFFFF) - 0x8000'
+    """
+    expression = mnemonic.replace("!", "~")
+    if "+" in mnemonic or "-" in mnemonic:
+        # only addition and negation can overflow
+        expression = WRAP % expression
+    return expression
+
+
+def alu(bits):
+    """
+    Returns a comp function for any 7 bit comp field, following the
+    ALU's zx/nx/zy/ny/f/no semantics, for the encodings the assembler
+    has no mnemonic for.
+
+    >>> alu(0b0101010)(5, 7, 9)
+    0
+    >>> alu(0b1000010)(5, 7, 9)
+    16
+    """
+    zx, nx, zy, ny, f, no = [bool(bits & (1 << bit)) for bit in range(5, -1, -1)]
+    use_m = bool(bits & (1 << 6))
+
+    def comp(a, d, m):
+        x = 0 if zx else d
+        if nx:
+            x = ~x
+        y = 0 if zy else (m if use_m else a)
+        if ny:
+            y = ~y
+        out = ((x + y + 0x8000) & 0xFFFF) - 0x8000 if f else x & y
+        return ~out if no else out
+    return comp
+
+
+COMP_MNEMONICS = dict((bits >> 6, mnemonic) for mnemonic, bits in COMP_BITS.items())
+COMP_FUNCTIONS = dict(
+    (bits, eval("lambda A, D, M: " + comp_expression(mnemonic)))
+    for bits, mnemonic in COMP_MNEMONICS.items())
+
+
+def decode(word):
+    """
+    Decodes a machine word into (comp, value, dest, jump). A
+    instructions have no comp function and carry the loaded value.
+
+    >>> decode(7)
+    (None, 7, 0, 0)
+    >>> comp, value, dest, jump = decode(0b1110001100000110) # D;JLE
+    >>> comp(1, 2, 3), dest, jump == JUMP_LT | JUMP_EQ
+    (2, 0, True)
+    """
+    if not word & C_INSTRUCTION_BIT:
+        return (None, word, 0, 0)
+    comp_bits = (word & COMP_MASK) >> 6
+    comp = COMP_FUNCTIONS.get(comp_bits)
+    if comp is None:
+        comp = COMP_FUNCTIONS[comp_bits] = alu(comp_bits)
+    return (comp, 0, (word & DEST_MASK) >> 3, word & JUMP_MASK)
+
+
+def predecode(words):
+    """
+    Decodes a whole ROM. Identical words share one decoded tuple.
+    """
+    if len(words) > ROM_SIZE:
+        raise EmulatorError("Program too large: %d words" % len(words))
+    decoded = {}
+    program = []
+    for word in words:
+        entry = decoded.get(word)
+        if entry is None:
+            entry = decoded[word] = decode(word)
+        program.append(entry)
+    return program
+
+
+def load(path, labels=None):
+    """
+    Reads a program's machine words from a .hack, binary .bin or
+    (assembled on the fly) .asm file. If labels is a dict, an .asm
+    file's label addresses are recorded in it, as by assemble().
+    """
+    if path.endswith(".bin"):
+        with Rom(path) as rom:
+            return rom.words()
+    with open(path, "rb") as programfile:
+        text = programfile.read()
+    if path.endswith(".asm"):
+        return assemble(parser(text), labels)
+    words = array("H")
+    for line in text.split():
+        try:
+            words.append(int(line, 2))
+        except ValueError:
+            raise EmulatorError("Invalid machine word: %s" % line)
+    return words
+
+
+class Emulator(object):
+    """
+    >>> emulator = Emulator(assemble(parser('''
+    ... @32767
+    ... D=A
+    ... D=D+1
+    ... @0
+    ... AM=D-1
+    ... (HALT)
+    ... @HALT
+    ... 0;JMP''')))
+    >>> emulator.run(1000)
+    1000
+    >>> emulator.d, emulator.a, emulator.ram[0], emulator.halted()
+    (-32768, 5, 32767, True)
+    """
+    def __init__(self, words):
+        self.rom = array("H", words)
+        self.program = predecode(self.rom)
+        self.ram = array("h", [0]) * RAM_SIZE
+        self.reset()
+
+    def reset(self):
+        self.a = 0
+        self.d = 0
+        self.pc = 0
+        self.cycles = 0
+
+    def halted(self):
+        """
+        True when the program ran past its last instruction or sits in
+        the usual "(HALT) @HALT 0;JMP" infinite loop.
+        """
+        pc = self.pc
+        program = self.program
+        if pc >= len(program):
+            return True
+        if program[pc][0] is not None:
+            pc -= 1
+        if not 0 <= pc < len(program) - 1:
+            return False
+        comp, value, dest, jump = program[pc]
+        next_comp, _, next_dest, next_jump = program[pc + 1]
+        return (comp is None and value == pc and next_comp is not None and
+                next_jump == JUMP_LT | JUMP_EQ | JUMP_GT and not next_dest & DEST_A)
+
+    def step(self):
+        self.run(1)
+
+    def run(self, steps):
+        """
+        Executes up to steps instructions and returns how many ran.
+        Stops early when the program counter leaves the program.
+        """
+        program = self.program
+        ram = self.ram
+        a = self.a
+        d = self.d
+        pc = self.pc
+        executed = 0
+        try:
+            for executed in xrange(steps):
+                comp, value, dest, jump = program[pc]
+                if comp is None:
+                    a = value
+                    pc += 1
+                    continue
+                out = comp(a, d, ram[a])
+                if dest & DEST_M:
+                    ram[a] = out
+                if jump and jump & (JUMP_LT if out < 0 else JUMP_EQ if out == 0 else JUMP_GT):
+                    pc = a & 0x7FFF
+                else:
+                    pc += 1
+                if dest & DEST_A:
+                    a = out
+                if dest & DEST_D:
+                    d = out
+            else:
+                executed = max(steps, 0)
+        except IndexError:
+            # fetched past the end of the program
+            pass
+        self.a = a
+        self.d = d
+        self.pc = pc
+        self.cycles += executed
+        return executed
+
+    def peek(self, address):
+        return self.ram[address]
+
+    def poke(self, address, value):
+        self.ram[address] = ((value + 0x8000) & 0xFFFF) - 0x8000
+
+
+# Python conditions for each jump field, over the ALU output
+JUMP_CONDITIONS = {
+    JUMP_BITS["JGT"]: "out > 0",
+    JUMP_BITS["JEQ"]: "out == 0",
+    JUMP_BITS["JGE"]: "out >= 0",
+    JUMP_BITS["JLT"]: "out < 0",
+    JUMP_BITS["JNE"]: "out != 0",
+    JUMP_BITS["JLE"]: "out <= 0",
+    JUMP_BITS["JMP"]: "True",
+}
+MAX_BLOCK_SIZE = 256
+
+
+def compile_block(rom, start, leaders=()):
+    """
+    Compiles the basic block starting at start into a Python function
+    (ram, A, D) -> (A, D, PC). The block runs until (and including)
+    the first conditional or computed jump, stopping early before any
+    address in leaders. Returns the function and the number of
+    instructions it executes.
+
+    A is tracked as a compile time constant after every @value, so
+    those loads turn into literal addresses in the generated code, and
+    unconditional jumps to such constants are followed into the target.
+
+    >>> block, size = compile_block(assemble(parser('''
+    ... @7
+    ... D=A
+    ... @1
+    ... AM=D-A
+    ... D;JGT
+    ... @0''')), 0)
+    >>> ram = array("h", [0]) * 8
+    >>> block(ram, 0, 0), size, ram[1]
+    ((6, 7, 6), 5, 6)
+    """
+    namespace = {}
+    lines = ["def block(ram, A, D):"]
+    # the value of A if known at compile time, else None
+    constant = None
+
+    def substitute(expression):
+        if constant is None:
+            return expression.replace("M", "ram[A]")
+        return expression.replace("A", str(constant)).replace("M", "ram[%d]" % constant)
+
+    address = start
+    length = 0
+    jump = 0
+    while address < len(rom) and length < MAX_BLOCK_SIZE:
+        if length and address in leaders:
+            break
+        word = rom[address]
+        address += 1
+        length += 1
+        if not word & C_INSTRUCTION_BIT:
+            constant = word
+            continue
+        comp_bits = (word & COMP_MASK) >> 6
+        dest = (word & DEST_MASK) >> 3
+        jump = word & JUMP_MASK
+        mnemonic = COMP_MNEMONICS.get(comp_bits)
+        if mnemonic is None:
+            namespace["comp%d" % comp_bits] = alu(comp_bits)
+            expression = substitute("comp%d(A, D, M)" % comp_bits)
+        else:
+            expression = substitute(comp_expression(mnemonic))
+        if jump == JUMP_MASK and constant is not None and not dest & DEST_A:
+            # an unconditional jump to a known address: keep compiling
+            # at the target, as if it were straight-line code
+            if dest:
+                lines.append("%s = %s" % (" = ".join(assignment_targets(dest, substitute)), expression))
+            address = constant
+            jump = 0
+            continue
+        targets = assignment_targets(dest, substitute)
+        if jump:
+            target = "A & 0x7FFF" if constant is None else str(constant)
+            if dest & DEST_A:
+                lines.append("target = " + target)
+                target = "target"
+            targets.insert(-1 if dest & DEST_A else len(targets), "out")
+        if dest & DEST_A:
+            constant = None
+        if targets:
+            lines.append("%s = %s" % (" = ".join(targets), expression))
+        if jump:
+            break
+    if constant is not None:
+        lines.append("A = %d" % constant)
+    if jump:
+        lines.append("if %s: return A, D, %s" % (JUMP_CONDITIONS[jump], target))
+    lines.append("return A, D, %d" % address)
+    exec (NEWLINE + "    ").join(lines) in namespace
+    return namespace["block"], length
+
+
+def assignment_targets(dest, substitute):
+    """
+    Returns the assignment targets for a dest field, M first so that
+    it is written through the A value from before the instruction.
+    """
+    targets = []
+    if dest & DEST_M:
+        targets.append(substitute("M"))
+    if dest & DEST_D:
+        targets.append("D")
+    if dest & DEST_A:
+        targets.append("A")
+    return targets
+
+
+class JitEmulator(Emulator):
+    """
+    An emulator that compiles each basic block to Python source the
+    first time it is entered and caches it by start address.
+
+    leaders are addresses that should always start a block, typically
+    the label addresses recorded by assemble(). Blocks are discovered
+    lazily from the addresses actually jumped to, so leaders are only
+    an optimization that keeps blocks from overlapping.
+
+    >>> labels = {}
+    >>> words = assemble(parser(open(os.path.join(os.path.dirname(__file__) or ".",
+    ...                                        "..", "04", "mult", "Mult.asm")).read()), labels)
+    >>> emulator = JitEmulator(words, labels.values())
+    >>> emulator.ram[0], emulator.ram[1] = 6, 7
+    >>> emulator.run(210), emulator.ram[2], emulator.halted()
+    (210, 42, True)
+    """
+    def __init__(self, words, leaders=()):
+        super(JitEmulator, self).__init__(words)
+        self.leaders = frozenset(leaders)
+        # compiled blocks, indexed by start address
+        self.blocks = [None] * len(self.rom)
+
+    def run(self, steps):
+        blocks = self.blocks
+        ram = self.ram
+        size = len(self.rom)
+        a = self.a
+        d = self.d
+        pc = self.pc
+        executed = 0
+        while pc < size:
+            block = blocks[pc]
+            if block is None:
+                block = blocks[pc] = compile_block(self.rom, pc, self.leaders)
+            function, length = block
+            if executed + length > steps:
+                break
+            a, d, pc = function(ram, a, d)
+            executed += length
+        self.a = a
+        self.d = d
+        self.pc = pc
+        self.cycles += executed
+        if executed < steps and pc < size:
+            # not enough steps left for a whole block
+            executed += super(JitEmulator, self).run(steps - executed)
+        return executed
+
+
+def main(args):
+    steps = None
+    jit = False
+    while args and args[0].startswith("--"):
+        if args[0].startswith("--steps="):
+            steps = int(args[0][len("--steps="):])
+        elif args[0] == "--jit":
+            jit = True
+        else:
+            print_usage()
+            return -1
+        args = args[1:]
+    if len(args) != 1 or os.path.splitext(args[0])[1] not in (".hack", ".bin", ".asm"):
+        print_usage()
+        return -1
+    path, = args
+    if not os.path.exists(path):
+        print "file not found"
+        return 1
+
+    if jit:
+        # only .asm files have labels to start blocks at
+        labels = {}
+        emulator = JitEmulator(load(path, labels), labels.values())
+    else:
+        emulator = Emulator(load(path))
+    chunk = 10 ** 6
+    while not emulator.halted() and (steps is None or emulator.cycles < steps):
+        emulator.run(chunk if steps is None else min(chunk, steps - emulator.cycles))
+    print "cycles: %d, PC: %d, A: %d, D: %d" % (emulator.cycles, emulator.pc, emulator.a, emulator.d)
+    for address in xrange(16):
+        print "RAM[%d] = %d" % (address, emulator.ram[address])
+    return 0
+
+def print_usage():
+        print "usage: hackemu.py [--steps=N] [--jit] path/to/file.hack|bin|asm"
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
+
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,303 @@
+#!/usr/bin/python2
+"""
+A profiler for Hack programs translated from VM code.
+
+Runs a program on an instrumented Emulator that counts executions per
+ROM address, and follows the VM's calling convention through the labels
+vm.py emits: a jump to an F<name> label enters function name, and a
+jump to a CALL<id> return label returns from the innermost function.
+Cycles are attributed to the stack of functions active when they run.
+
+Labels alone are ambiguous, since several can share an address: the
+return label of a call that is the last command before a function, or
+before a loop's label. So a jump to a function label only counts as a
+call if LCL equals SP, as it does right after the frame is set up, and
+a jump to a return label only counts as a return if it is the return
+address saved in the innermost frame (RAM[LCL - 5] at the call).
+
+The results are a flat profile (self and total cycles per function),
+the hottest addresses relative to the nearest label (and, with the
+--source-map written by assembler.py, the hottest VM lines), and call
+stacks in the folded format read by flamegraph.pl and speedscope:
+
+    (top);Sys.init;Main.fibonacci 1234
+
+    >>> labels = {}
+    >>> words = assemble(parser('''
+    ... @CALL0
+    ... D=A
+    ... @256
+    ... M=D
+    ... @261
+    ... D=A
+    ... @SP
+    ... M=D
+    ... @LCL
+    ... M=D
+    ... @Fmain
+    ... 0;JMP
+    ... (CALL0)
+    ... @CALL0
+    ... 0;JMP
+    ... (Fmain)
+    ... @256
+    ... A=M
+    ... 0;JMP'''), labels)
+    >>> profiler = Profiler(words, labels)
+    >>> profiler.run(20)
+    20
+    >>> sorted(profiler.stacks.items())
+    [(('(top)',), 17), (('(top)', 'main'), 3)]
+    >>> profiler.hits[10:].tolist()
+    [1, 1, 3, 2, 1, 1, 1]
+    >>> print profiler.folded(),
+    (top) 17
+    (top);main 3
+"""
+
+from array import array
+from bisect import bisect_right
+import os
+import sys
+
+from assembler import assemble, parser, SourceMap, NO_FILE, SOURCE_MAP_EXTENSION
+from hackemu import Emulator, DEST_A, DEST_D, DEST_M, JUMP_LT, JUMP_EQ, JUMP_GT
+
+SP, LCL = 0, 1
+
+ROOT = "(top)"
+FUNCTION_PREFIX = "F"
+RETURN_PREFIX = "CALL"
+DEFAULT_TOP = 20
+
+
+def is_function_label(label):
+    # VM labels inside functions are scoped as function$label
+    return label.startswith(FUNCTION_PREFIX) and "$" not in label
+
+
+def is_return_label(label):
+    return label.startswith(RETURN_PREFIX) and "$" not in label
+
+
+class Profiler(Emulator):
+    """
+    An Emulator that counts executions per address (hits) and cycles
+    per call stack (stacks, keyed by tuples of function names).
+    """
+    def __init__(self, words, labels):
+        super(Profiler, self).__init__(words)
+        self.labels = labels
+        self.hits = array("l", [0]) * len(self.rom)
+        # what a jump to each address may be: a call to the function
+        # named, a return (RETURN_PREFIX), or neither (None)
+        self.events = [None] * (len(self.rom) + 1)
+        for label, address in labels.items():
+            if address >= len(self.events):
+                continue
+            if is_function_label(label):
+                self.events[address] = label[len(FUNCTION_PREFIX):]
+            elif is_return_label(label) and self.events[address] is None:
+                self.events[address] = RETURN_PREFIX
+        self.stacks = {}
+        self.stack = (ROOT,)
+        # the return address of each function on the stack
+        self.returns = [None]
+
+    def run(self, steps):
+        """
+        Like Emulator.run(), counting as it goes.
+        """
+        program = self.program
+        ram = self.ram
+        hits = self.hits
+        events = self.events
+        stacks = self.stacks
+        stack = self.stack
+        returns = self.returns
+        a = self.a
+        d = self.d
+        pc = self.pc
+        executed = 0
+        # executed count when the current stack was entered
+        entered = 0
+        try:
+            for executed in xrange(steps):
+                hits[pc] += 1
+                comp, value, dest, jump = program[pc]
+                if comp is None:
+                    a = value
+                    pc += 1
+                    continue
+                out = comp(a, d, ram[a])
+                if dest & DEST_M:
+                    ram[a] = out
+                if jump and jump & (JUMP_LT if out < 0 else JUMP_EQ if out == 0 else JUMP_GT):
+                    pc = a & 0x7FFF
+                    event = events[pc]
+                    if event is not None:
+                        if event is not RETURN_PREFIX and ram[SP] == ram[LCL]:
+                            stacks[stack] = stacks.get(stack, 0) + executed + 1 - entered
+                            entered = executed + 1
+                            stack = stack + (event,)
+                            returns.append(ram[ram[LCL] - 5])
+                        elif pc == returns[-1]:
+                            stacks[stack] = stacks.get(stack, 0) + executed + 1 - entered
+                            entered = executed + 1
+                            stack = stack[:-1]
+                            returns.pop()
+                else:
+                    pc += 1
+                if dest & DEST_A:
+                    a = out
+                if dest & DEST_D:
+                    d = out
+            else:
+                executed = max(steps, 0)
+        except IndexError:
+            # fetched past the end of the program
+            pass
+        if executed > entered:
+            stacks[stack] = stacks.get(stack, 0) + executed - entered
+        self.stack = stack
+        self.a = a
+        self.d = d
+        self.pc = pc
+        self.cycles += executed
+        return executed
+
+    def flat_profile(self):
+        """
+        Returns (function, self cycles, total cycles) tuples, hottest
+        first. Recursive functions count once per stack in the total.
+        """
+        self_cycles = {}
+        total_cycles = {}
+        for stack, cycles in self.stacks.items():
+            self_cycles[stack[-1]] = self_cycles.get(stack[-1], 0) + cycles
+            for function in set(stack):
+                total_cycles[function] = total_cycles.get(function, 0) + cycles
+        return sorted(((function, self_cycles.get(function, 0), total)
+                       for function, total in total_cycles.items()),
+                      key=lambda row: (-row[1], row[0]))
+
+    def hot_addresses(self, count=DEFAULT_TOP):
+        """
+        Returns (address, location, hits) for the most executed
+        addresses, where location is label+offset.
+        """
+        by_address = sorted((address, label) for label, address in self.labels.items())
+        addresses = [address for address, _ in by_address]
+        hot = sorted((address for address in xrange(len(self.hits)) if self.hits[address]),
+                     key=lambda address: -self.hits[address])[:count]
+        rows = []
+        for address in hot:
+            index = bisect_right(addresses, address) - 1
+            if index < 0:
+                location = str(address)
+            else:
+                label_address, label = by_address[index]
+                location = "%s+%d" % (label, address - label_address)
+            rows.append((address, location, self.hits[address]))
+        return rows
+
+    def hot_sources(self, source_map, count=DEFAULT_TOP):
+        """
+        Returns ("file:line", hits) for the most executed VM source
+        lines, using a SourceMap of the program.
+        """
+        by_source = {}
+        vm_files = source_map.vm_files
+        vm_lines = source_map.vm_lines
+        for address in xrange(min(len(self.hits), len(source_map))):
+            if self.hits[address]:
+                key = vm_files[address], vm_lines[address]
+                by_source[key] = by_source.get(key, 0) + self.hits[address]
+        rows = []
+        for (vm_file, vm_line), hits in sorted(by_source.items(), key=lambda item: -item[1])[:count]:
+            if vm_file != NO_FILE:
+                rows.append(("%s:%d" % (source_map.files[vm_file], vm_line), hits))
+            else:
+                rows.append(("(no VM source)", hits))
+        return rows
+
+    def folded(self):
+        """
+        Returns the call stacks in folded format, one "a;b;c cycles"
+        line each.
+        """
+        return "".join("%s %d\n" % (";".join(stack), cycles)
+                       for stack, cycles in sorted(self.stacks.items()))
+
+
+def print_profile(profiler, top, source_map=None):
+    print "cycles: %d" % profiler.cycles
+    print
+    print "%12s %6s %12s %6s  %s" % ("self", "%", "total", "%", "function")
+    cycles = float(profiler.cycles) or 1
+    for function, self_cycles, total in profiler.flat_profile()[:top]:
+        print "%12d %5.1f%% %12d %5.1f%%  %s" % (
+            self_cycles, 100 * self_cycles / cycles, total, 100 * total / cycles, function)
+    print
+    print "%12s %6s  %s" % ("hits", "address", "location")
+    for address, location, hits in profiler.hot_addresses(top):
+        print "%12d %6d  %s" % (hits, address, location)
+    if source_map is not None:
+        print
+        print "%12s  %s" % ("hits", "VM source")
+        for location, hits in profiler.hot_sources(source_map, top):
+            print "%12d  %s" % (hits, location)
+
+
+def main(args):
+    steps = None
+    top = DEFAULT_TOP
+    folded_path = None
+    use_source_map = False
+    while args and args[0].startswith("--"):
+        if args[0].startswith("--steps="):
+            steps = int(args[0][len("--steps="):])
+        elif args[0].startswith("--top="):
+            top = int(args[0][len("--top="):])
+        elif args[0].startswith("--folded="):
+            folded_path = args[0][len("--folded="):]
+        elif args[0] == "--source-map":
+            use_source_map = True
+        else:
+            print_usage()
+            return -1
+        args = args[1:]
+    if len(args) != 1 or not args[0].endswith(".asm"):
+        print_usage()
+        return -1
+    path, = args
+    if not os.path.exists(path):
+        print "file not found"
+        return 1
+
+    labels = {}
+    with open(path, "rb") as asmfile:
+        words = assemble(parser(asmfile.read()), labels)
+    source_map = None
+    if use_source_map:
+        # as written by assembler.py --source-map
+        with open(path[:-4] + SOURCE_MAP_EXTENSION, "rb") as mapfile:
+            source_map = SourceMap.read(mapfile)
+    profiler = Profiler(words, labels)
+    chunk = 10 ** 6
+    while not profiler.halted() and (steps is None or profiler.cycles < steps):
+        profiler.run(chunk if steps is None else min(chunk, steps - profiler.cycles))
+    print_profile(profiler, top, source_map)
+    if folded_path is not None:
+        with open(folded_path, "wb") as foldedfile:
+            foldedfile.write(profiler.folded())
+    return 0
+
+def print_usage():
+        print "usage: hackprof.py [--steps=N] [--top=N] [--folded=out.folded] [--source-map] path/to/file.asm"
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
+
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,298 @@
+#!/usr/bin/python2
+'''
+A peephole optimizer for the Hack assembly generated by vm.py.
+
+The translator emits a fixed template per VM command, so consecutive
+commands often undo each other's work, e.g. a push immediately popped
+again. The optimizer parses the assembly into a list of instruction
+tuples and rewrites short, label-free windows until nothing changes:
+
+    ('A', symbol)              @symbol
+    ('C', dest, comp, jump)    dest=comp;jump
+    ('L', name)                (name)
+
+Comments are kept and attached to the next surviving instruction.
+
+The rewrites only assume that memory above the stack pointer is
+garbage, which holds for all code generated by vm.py.
+
+    >>> import vm
+    >>> asm, saved = optimize_asm(vm.code([vm.Push(vm.CONSTANT, 7, 'f'), vm.Pop(vm.TEMP, 0, 'f')]))
+    >>> print asm
+    // push constant 7
+    @7
+    D=A
+    // pop temp 0
+    @5
+    M=D
+    <BLANKLINE>
+    >>> saved
+    7
+'''
+
+NEWLINE = '\n'
+
+PUSH_D = [('A', 'SP'), ('C', 'AM', 'M+1', None), ('C', 'A', 'A-1', None), ('C', 'M', 'D', None)]
+POP_D = [('A', 'SP'), ('C', 'AM', 'M-1', None), ('C', 'D', 'M', None)]
+LOAD_SP = [('A', 'SP'), ('C', 'A', 'M', None)]
+
+
+def parse(asm):
+    '''
+    Parses assembly into (comments, instruction) pairs, where comments
+    are the comment lines preceding the instruction. Comments at the
+    end of the text are paired with None.
+
+    >>> parse('// hi\\n@SP\\nAM=M+1\\n(LOOP)\\n0;JMP\\n')
+    [(['// hi'], ('A', 'SP')), ([], ('C', 'AM', 'M+1', None)), ([], ('L', 'LOOP')), ([], ('C', None, '0', 'JMP'))]
+    '''
+    code = []
+    comments = []
+    for line in asm.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('//'):
+            comments.append(line)
+            continue
+        code.append((comments, parse_instruction(line)))
+        comments = []
+    if comments:
+        code.append((comments, None))
+    return code
+
+
+def parse_instruction(line):
+    if line.startswith('@'):
+        return ('A', line[1:])
+    if line.startswith('('):
+        return ('L', line[1:-1])
+    dest = jump = None
+    if '=' in line:
+        dest, line = line.split('=', 1)
+    if ';' in line:
+        line, jump = line.split(';', 1)
+    return ('C', dest, line, jump)
+
+
+def render(code):
+    lines = []
+    for comments, instruction in code:
+        lines.extend(comments)
+        if instruction is not None:
+            lines.append(render_instruction(instruction))
+    return NEWLINE.join(lines) + NEWLINE
+
+
+def render_instruction(instruction):
+    '''
+    >>> render_instruction(('C', 'AM', 'M-1', None)), render_instruction(('C', None, 'D', 'JNE'))
+    ('AM=M-1', 'D;JNE')
+    '''
+    kind = instruction[0]
+    if kind == 'A':
+        return '@' + instruction[1]
+    if kind == 'L':
+        return '(%s)' % instruction[1]
+    _, dest, comp, jump = instruction
+    return (dest + '=' if dest else '') + comp + (';' + jump if jump else '')
+
+
+def is_instruction(instruction):
+    return instruction is not None and instruction[0] != 'L'
+
+
+def sets_only_a(instruction):
+    '''
+    True for instructions whose only effect is loading A.
+    '''
+    return instruction[0] == 'A' or (instruction[0] == 'C' and instruction[1] == 'A' and not instruction[3])
+
+
+def cancel_push_pop(code, i):
+    # a value pushed from D and popped right back into D; only the
+    # stack pointer has to end up in A, in case the next command
+    # uses it
+    if window(code, i, len(PUSH_D) + len(POP_D)) == PUSH_D + POP_D:
+        return len(PUSH_D) + len(POP_D), LOAD_SP
+
+
+def fold_decrement(code, i):
+    # A=M followed by A=A-1
+    if window(code, i, 2) == [('C', 'A', 'M', None), ('C', 'A', 'A-1', None)]:
+        return 2, [('C', 'A', 'M-1', None)]
+
+
+def drop_dead_a(code, i):
+    # A is loaded and immediately overwritten by an A instruction
+    pair = window(code, i, 2)
+    if (len(pair) == 2 and all(is_instruction(instruction) for instruction in pair) and
+            sets_only_a(pair[0]) and pair[1][0] == 'A'):
+        return 1, []
+
+
+def drop_dead_d(code, i):
+    # D is loaded and overwritten before anything reads it; A
+    # instructions in between don't read D
+    first = code[i][1]
+    if not (is_instruction(first) and first[0] == 'C' and first[1] == 'D' and not first[3]):
+        return None
+    for j in xrange(i + 1, len(code)):
+        instruction = code[j][1]
+        if not is_instruction(instruction):
+            return None
+        if instruction[0] == 'A':
+            continue
+        _, dest, comp, jump = instruction
+        if 'D' not in comp and dest and 'D' in dest:
+            return 1, []
+        return None
+
+
+RULES = [cancel_push_pop, fold_decrement, drop_dead_a, drop_dead_d]
+
+
+def window(code, i, length):
+    '''
+    Returns up to length instructions starting at i.
+    '''
+    return [instruction for _, instruction in code[i:i + length]]
+
+
+def optimize(code):
+    '''
+    Applies the rules until no rule matches. Returns the new code and
+    the number of instructions saved.
+
+    >>> code, saved = optimize(parse(\'\'\'@5
+    ... D=A
+    ... @SP
+    ... AM=M+1
+    ... A=A-1
+    ... M=D
+    ... @SP
+    ... AM=M-1
+    ... D=M
+    ... A=A-1
+    ... M=D+M\'\'\'))
+    >>> print render(code),
+    @5
+    D=A
+    @SP
+    A=M-1
+    M=D+M
+    >>> saved
+    6
+    '''
+    code = list(code)
+    before = sum(1 for _, instruction in code if is_instruction(instruction))
+    changed = True
+    while changed:
+        changed = False
+        optimized = []
+        i = 0
+        while i < len(code):
+            for rule in RULES:
+                match = rule(code, i)
+                if match is not None:
+                    break
+            if match is None:
+                optimized.append(code[i])
+                i += 1
+                continue
+            changed = True
+            length, replacement = match
+            comments = sum((comments for comments, _ in code[i:i + length]), [])
+            if replacement:
+                optimized.append((comments, replacement[0]))
+                optimized.extend(([], instruction) for instruction in replacement[1:])
+            elif i + length < len(code):
+                # removed instructions hand their comments to the next one
+                code[i + length] = (comments + code[i + length][0], code[i + length][1])
+            else:
+                optimized.append((comments, None))
+            i += length
+        code = optimized
+    after = sum(1 for _, instruction in code if is_instruction(instruction))
+    return code, before - after
+
+
+def optimize_asm(asm):
+    code, saved = optimize(parse(asm))
+    return render(code), saved
+
+
+class Writer(object):
+    '''
+    Wraps a writable stream, optimizing the code written to it a chunk
+    at a time. The end of each write is held back until the next write
+    or close(), so windows spanning two writes (a push at the end of
+    one file and a pop at the start of the next) are still optimized:
+    the last len(PUSH_D + POP_D) lines, and a D= whose value is still
+    unread at the end. Output is the same as optimizing it all at once.
+
+    >>> from StringIO import StringIO
+    >>> output = StringIO()
+    >>> writer = Writer(output)
+    >>> writer.write('@5\\nD=A\\n@SP\\nAM=M+1\\nA=A-1\\nM=D\\n')
+    >>> writer.write('@SP\\nAM=M-1\\nD=M\\n@R5\\nM=D\\n')
+    >>> writer.close()
+    >>> print output.getvalue(),
+    @5
+    D=A
+    @R5
+    M=D
+    >>> writer.saved
+    7
+    '''
+    def __init__(self, output):
+        self.output = output
+        self.saved = 0
+        # parsed code not yet written
+        self.pending = []
+
+    def write(self, asm):
+        if not asm:
+            return
+        code = parse(asm)
+        if self.pending and self.pending[-1][1] is None and code:
+            # trailing comments go with the next write's first line
+            comments, _ = self.pending.pop()
+            code[0] = (comments + code[0][0], code[0][1])
+        code, saved = optimize(self.pending + code)
+        self.saved += saved
+        held = self.held(code)
+        self.flush(code[:held])
+        self.pending = code[held:]
+
+    def close(self):
+        '''
+        Writes the code held back. The stream is left open.
+        '''
+        self.flush(self.pending)
+        self.pending = []
+
+    def held(self, code):
+        '''
+        Returns where the code that a later write could still change
+        starts.
+        '''
+        start = max(len(code) - len(PUSH_D + POP_D), 0)
+        end = len(code)
+        while end > 0 and is_instruction(code[end - 1][1]) and code[end - 1][1][0] == 'A':
+            end -= 1
+        if end > 0:
+            instruction = code[end - 1][1]
+            if is_instruction(instruction) and instruction[0] == 'C' and instruction[1] == 'D' and \
+                    not instruction[3]:
+                start = min(start, end - 1)
+        return start
+
+    def flush(self, code):
+        if code:
+            self.output.write(render(code))
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -2,16 +2,26 @@
 
 # TODO: compile directory
 
+import cPickle
 from glob import glob
-from itertools import chain
+import hashlib
+from itertools import chain, imap
+from multiprocessing import cpu_count, Pool
 import os
 import re
 import sys
 from StringIO import StringIO
 
+import peephole
+
 NEWLINE = '\n'
 SYMBOL_RE = re.compile('^[a-zA-Z_.$:][a-zA-Z0-9_.$:]*$')
 MAX_LOCALS = 1024
+# mark the VM file and line of the code that follows, for the
+# assembler's source map
+LOCATION_COMMENT = '//> %s.vm:%d' + NEWLINE
+NO_LOCATION_COMMENT = '//>' + NEWLINE
+TEMPLATE_CACHE_SIZE = 1024
 
 
 class SyntaxError(Exception):
@@ -19,16 +29,42 @@ class SyntaxError(Exception):
 
 
 class Command(object):
+    # whether the code depends on the unique identifier passed to asm()
+    uses_identifier = False
+    # (filename, line) when parsed from source
+    location = None
+
+    def template_key(self, f):
+        '''
+        Everything this command's code depends on, except the unique
+        identifier: (command class, segment, parameter, filename) for
+        stack operations, the command and its function for labels.
+
+        >>> Push(STATIC, 2, 'Main').template_key(None)[1:]
+        (STATIC, 2, 'Main')
+        >>> Push(LOCAL, 2, 'Main').template_key(Function('Main.main', 0))[1:]
+        (LOCAL, 2, None)
+        >>> Goto('LOOP').template_key(Function('Main.main', 0))[1:]
+        (None, 'LOOP', 'Main.main')
+        '''
+        return self.__class__, str(self), None, None
+
     def asm(self, i, f):
         '''
         Returns hack assembly code for this command.
 
-        i is a unique number, useful to distinguish labels for
-        different commands.
+        i is a unique identifier (a number, possibly prefixed),
+        useful to distinguish labels for different commands.
 
         f is the current (latest) function command or None.
         '''
-        return '// %s%s%s%s' % (str(self), NEWLINE, self.asm_code(i, f), NEWLINE)
+        return self.annotate(self.asm_code(i, f))
+
+    def annotate(self, asm_code):
+        '''
+        Prefixes translated code with this command as a comment.
+        '''
+        return '// %s%s%s%s' % (str(self), NEWLINE, asm_code, NEWLINE)
 
 
 class StackOperation(Command):
@@ -51,6 +87,11 @@ class StackOperation(Command):
         self.parameter = parameter
         self.filename = filename
 
+    def template_key(self, f):
+        # only statics are named after the file
+        filename = self.filename if self.segment is STATIC else None
+        return self.__class__, self.segment, self.parameter, filename
+
     def __repr__(self):
         return '%s(%r, %r)' % (self.__class__.__name__, self.segment, self.parameter)
 
@@ -212,6 +253,9 @@ SEGMENTS = {
 
 
 class ArithmeticCommand(Command):
+    def template_key(self, f):
+        return self.__class__, None, None, None
+
     def __str__(self):
         return self.__class__.__name__.lower()
 
@@ -249,24 +293,73 @@ class Neg(ArithmeticCommand):
 
 EQUALITY_CHECK = BINARY_OP_HEADER + '''
 D=D-M
-@EQUAL%(unique_identifier)d
+@EQUAL%(unique_identifier)s
 D;%(jump)s
 D=0
-@WRITE%(unique_identifier)d
+@WRITE%(unique_identifier)s
 0;JMP
-(EQUAL%(unique_identifier)d)
+(EQUAL%(unique_identifier)s)
 D=-1
-(WRITE%(unique_identifier)d)
+(WRITE%(unique_identifier)s)
 @SP
 A=M-1
 M=D'''
 
+# Shared comparison routines, one per jump kind. The caller passes its
+# return address in D, the same way Call pushes a return label.
+SHARED_EQUALITY_CALL = '''\
+@CMPRET%(unique_identifier)s
+D=A
+@COMPARE_%(jump)s
+0;JMP
+(CMPRET%(unique_identifier)s)'''
+
+SHARED_EQUALITY_CHECK = '''\
+(COMPARE_%(jump)s)
+@R13
+M=D
+''' + BINARY_OP_HEADER + '''
+D=D-M
+@COMPARE_%(jump)s_TRUE
+D;%(jump)s
+D=0
+@COMPARE_%(jump)s_WRITE
+0;JMP
+(COMPARE_%(jump)s_TRUE)
+D=-1
+(COMPARE_%(jump)s_WRITE)
+@SP
+A=M-1
+M=D
+@R13
+A=M
+0;JMP
+'''
+
+# keeps execution from running off the end of the program into the
+# shared routines
+HALT = '''\
+(VM_END)
+@VM_END
+0;JMP
+'''
+
 class Equality(ArithmeticCommand):
+    uses_identifier = True
+
     def asm_code(self, i, f):
         jump = self.JUMP
         unique_identifier = i
         return EQUALITY_CHECK % locals()
 
+    def shared_asm_code(self, i, f):
+        jump = self.JUMP
+        unique_identifier = i
+        return SHARED_EQUALITY_CALL % locals()
+
+    def shared_routine(self):
+        return 'COMPARE_' + self.JUMP, SHARED_EQUALITY_CHECK % dict(jump=self.JUMP)
+
 class Eq(Equality):
     JUMP = 'JEQ'
 
@@ -284,13 +377,13 @@ class Lt(Equality):
 # 0000 & 1111 = 0000
 # 0000 & 0000 = 0000
 AND_CODE = '''%s
-M=M&D''' % BINARY_OP_HEADER
+M=D&M''' % BINARY_OP_HEADER
 # 1111 | 1111 = 1111
 # 1111 | 0000 = 1111
 # 0000 | 1111 = 1111
 # 0000 | 0000 = 0000
 OR_CODE = '''%s
-M=M|D''' % BINARY_OP_HEADER
+M=D|M''' % BINARY_OP_HEADER
 NOT_CODE = '''@SP
 A=M-1
 M=!M
@@ -328,6 +421,11 @@ class BranchingCommand(Command):
     def __init__(self, name):
         self.name = name
 
+    def template_key(self, function):
+        if function is not None:
+            function = function.name
+        return self.__class__, None, self.name, function
+
     @staticmethod
     def name_to_label(function, name):
         if function is not None:
@@ -426,6 +524,7 @@ M=D'''
 
 
 class Call(Command):
+    uses_identifier = True
 
     SAVE_CONST = '''\
 @%s
@@ -458,21 +557,69 @@ M=D
     CALL_LABEL = '''
 (%(symbol)s)'''
 
+    CALL_CODE = (
+        SAVE_CONST % '%(symbol)s' +
+        SAVE_VARS +
+        SET_ARG +
+        SET_LCL +
+        Goto.GOTO % Function.name_to_label('%(name)s') +
+        CALL_LABEL
+    )
+
+    # Compact calls pass the return address in R14, the ARG offset in
+    # R15 and the target in D to a single global call routine.
+    COMPACT_CALL = '''\
+@%(symbol)s
+D=A
+@R14
+M=D
+@%(stack_offset)d
+D=A
+@R15
+M=D
+@%(target)s
+D=A
+@VM_CALL
+0;JMP
+(%(symbol)s)'''
+
+    CALL_ROUTINE = '''\
+(VM_CALL)
+@R13
+M=D
+@R14
+D=M
+''' + Segment.PUSH_D + NEWLINE + SAVE_VARS + '''
+@R15
+D=M
+@SP
+D=M-D
+@ARG
+M=D
+''' + SET_LCL + '''\
+@R13
+A=M
+0;JMP
+'''
+
     def __init__(self, name, num_arguments):
         self.name = name
         self.num_arguments = num_arguments
 
     def asm_code(self, i, f):
         stack_offset = self.num_arguments + len(self.SAVED_VARS) + 1
-        symbol = 'CALL%d' % i
-        return (
-            self.SAVE_CONST % symbol +
-            self.SAVE_VARS +
-            self.SET_ARG +
-            self.SET_LCL +
-            Goto.GOTO % Function.name_to_label(self.name) +
-            self.CALL_LABEL
-        ) % locals()
+        symbol = 'CALL%s' % i
+        name = self.name
+        return self.CALL_CODE % locals()
+
+    def compact_asm_code(self, i, f):
+        stack_offset = self.num_arguments + len(self.SAVED_VARS) + 1
+        symbol = 'CALL%s' % i
+        target = Function.name_to_label(self.name)
+        return self.COMPACT_CALL % locals()
+
+    def compact_routine(self):
+        return 'VM_CALL', self.CALL_ROUTINE
 
     def __str__(self):
         return 'call %s %d' % (self.name, self.num_arguments)
@@ -550,6 +697,12 @@ A=M
             self.JUMP
             )
 
+    def compact_asm_code(self, i, function):
+        return Goto.GOTO % 'VM_RETURN'
+
+    def compact_routine(self):
+        return 'VM_RETURN', '(VM_RETURN)' + NEWLINE + self.asm_code(None, None) + NEWLINE
+
     def __str__(self):
         return 'return'
 
@@ -558,6 +711,8 @@ A=M
 
 
 class Initialize(Command):
+    uses_identifier = True
+
     def asm_code(self, i, function):
         return '''\
 @256
@@ -646,47 +801,57 @@ def parser(text, filename='f'):
     [Call('mult', 2)]
     >>> list(parser('return'))
     [Return()]
+    >>> [command.location for command in parser('push constant 1\\n\\n// two\\nadd', 'Main')]
+    [('Main', 1), ('Main', 4)]
     '''
-    for line in text.splitlines():
-        if '//' in line:
-            line = line[:line.find('//')]
-        line = line.strip().split()
-        if line == []:
-            pass
-        elif line[0] in STACK_OPERATIONS:
-            check_parameters(line, 2, 'Stack')
-            operation, segment, param = line
-            if segment in SEGMENTS:
-                yield STACK_OPERATIONS[operation](SEGMENTS[segment], parse_number(param), filename)
-            else:
-                raise SyntaxError('Not a recognized segment: %s' % segment)
-        elif line[0] in ARITHMETIC_COMMANDS:
-            check_parameters(line, 0, 'Arithmetic')
-            yield ARITHMETIC_COMMANDS[line[0]]()
-        elif line[0] in BRANCHING_COMMANDS:
-            check_parameters(line, 1, 'Branching')
-            operation, name = line
-            check_symbol_name(name)
-            yield BRANCHING_COMMANDS[operation](name)
-        elif line[0] == 'function':
-            check_parameters(line, 2, 'Function')
-            _, name, num_locals = line
-            check_symbol_name(name)
-            num_locals = parse_number(num_locals)
-            if not 0 <= num_locals <= MAX_LOCALS:
-                raise SyntaxError('Function cannot have %d locals' % num_locals)
-            yield Function(name, num_locals)
-        elif line[0] == 'call':
-            check_parameters(line, 2, 'Call')
-            _, name, num_arguments = line
-            check_symbol_name(name)
-            num_arguments = parse_number(num_arguments)
-            yield Call(name, num_arguments)
-        elif line[0] == 'return':
-            check_parameters(line, 0, 'Return')
-            yield Return()
+    for number, line in enumerate(text.splitlines(), 1):
+        command = parse_line(line, filename)
+        if command is not None:
+            command.location = (filename, number)
+            yield command
+
+
+def parse_line(line, filename):
+    if '//' in line:
+        line = line[:line.find('//')]
+    line = line.strip().split()
+    if line == []:
+        return None
+    elif line[0] in STACK_OPERATIONS:
+        check_parameters(line, 2, 'Stack')
+        operation, segment, param = line
+        if segment in SEGMENTS:
+            return STACK_OPERATIONS[operation](SEGMENTS[segment], parse_number(param), filename)
         else:
-            raise SyntaxError('Not a recognized command: %s' % line[0])
+            raise SyntaxError('Not a recognized segment: %s' % segment)
+    elif line[0] in ARITHMETIC_COMMANDS:
+        check_parameters(line, 0, 'Arithmetic')
+        return ARITHMETIC_COMMANDS[line[0]]()
+    elif line[0] in BRANCHING_COMMANDS:
+        check_parameters(line, 1, 'Branching')
+        operation, name = line
+        check_symbol_name(name)
+        return BRANCHING_COMMANDS[operation](name)
+    elif line[0] == 'function':
+        check_parameters(line, 2, 'Function')
+        _, name, num_locals = line
+        check_symbol_name(name)
+        num_locals = parse_number(num_locals)
+        if not 0 <= num_locals <= MAX_LOCALS:
+            raise SyntaxError('Function cannot have %d locals' % num_locals)
+        return Function(name, num_locals)
+    elif line[0] == 'call':
+        check_parameters(line, 2, 'Call')
+        _, name, num_arguments = line
+        check_symbol_name(name)
+        num_arguments = parse_number(num_arguments)
+        return Call(name, num_arguments)
+    elif line[0] == 'return':
+        check_parameters(line, 0, 'Return')
+        return Return()
+    else:
+        raise SyntaxError('Not a recognized command: %s' % line[0])
+
 
 def check_parameters(line, expected_number, name):
     if len(line) != expected_number + 1:
@@ -702,8 +867,22 @@ def parse_number(s):
     return int(s)
 
 
-def code(commands):
+def code(commands, output=None, **options):
     '''
+    Translates commands to hack assembly. Takes the same options as
+    translate().
+
+    If output is given, the assembly is written to it command by
+    command as commands are consumed, instead of being returned.
+
+    With shared_compare, eq/gt/lt jump to one shared comparison routine
+    per jump kind instead of inlining a full comparison each time.
+
+    With compact_calls, call and return jump to one global call routine
+    and one global return routine instead of inlining the frame code.
+
+    Shared routines are emitted after the program, behind a halt loop.
+
     >>> print code([Push(CONSTANT, 5, 'f')])
     // push constant 5
     @5
@@ -961,18 +1140,257 @@ def code(commands):
     // label hello
     (mult$hello)
     <BLANKLINE>
+    >>> print code([Eq(), Lt()], shared_compare=True)
+    // eq
+    @CMPRET0
+    D=A
+    @COMPARE_JEQ
+    0;JMP
+    (CMPRET0)
+    // lt
+    @CMPRET1
+    D=A
+    @COMPARE_JGT
+    0;JMP
+    (CMPRET1)
+    (VM_END)
+    @VM_END
+    0;JMP
+    (COMPARE_JEQ)
+    @R13
+    M=D
+    @SP
+    AM=M-1
+    D=M
+    A=A-1
+    D=D-M
+    @COMPARE_JEQ_TRUE
+    D;JEQ
+    D=0
+    @COMPARE_JEQ_WRITE
+    0;JMP
+    (COMPARE_JEQ_TRUE)
+    D=-1
+    (COMPARE_JEQ_WRITE)
+    @SP
+    A=M-1
+    M=D
+    @R13
+    A=M
+    0;JMP
+    (COMPARE_JGT)
+    @R13
+    M=D
+    @SP
+    AM=M-1
+    D=M
+    A=A-1
+    D=D-M
+    @COMPARE_JGT_TRUE
+    D;JGT
+    D=0
+    @COMPARE_JGT_WRITE
+    0;JMP
+    (COMPARE_JGT_TRUE)
+    D=-1
+    (COMPARE_JGT_WRITE)
+    @SP
+    A=M-1
+    M=D
+    @R13
+    A=M
+    0;JMP
+    <BLANKLINE>
+    >>> print code([Call('mult', 2)], compact_calls=True)[:-len(HALT + Call.CALL_ROUTINE)]
+    // call mult 2
+    @CALL0
+    D=A
+    @R14
+    M=D
+    @7
+    D=A
+    @R15
+    M=D
+    @Fmult
+    D=A
+    @VM_CALL
+    0;JMP
+    (CALL0)
+    <BLANKLINE>
+    >>> lines = code([f, Return()], compact_calls=True).splitlines()
+    >>> lines[lines.index('// return'):lines.index('(VM_RETURN)') + 2]
+    ['// return', '@VM_RETURN', '0;JMP', '(VM_END)', '@VM_END', '0;JMP', '(VM_RETURN)', '@SP']
+    '''
+    if output is None:
+        output = StringIO()
+        code(commands, output, **options)
+        return output.getvalue()
+    routines = translate_to(output, commands, **options)
+    if options.get('source_lines'):
+        output.write(NO_LOCATION_COMMENT)
+    output.write(routines_code(routines))
+
+
+def translate(commands, prefix='', shared_compare=False, compact_calls=False, source_lines=False):
+    '''
+    Translates commands to hack assembly, leaving out the shared
+    routines they jump to. Returns the assembly and a dict of those
+    routines by name.
+
+    Labels generated for single commands are made unique with the
+    command's index, prefixed with prefix, so chunks translated with
+    different prefixes can be concatenated.
+
+    >>> asm, routines = translate([Push(CONSTANT, 1, 'f'), Eq()], 'Main.', shared_compare=True)
+    >>> print asm[asm.index('// eq'):]
+    // eq
+    @CMPRETMain.1
+    D=A
+    @COMPARE_JEQ
+    0;JMP
+    (CMPRETMain.1)
+    <BLANKLINE>
+    >>> routines.keys()
+    ['COMPARE_JEQ']
     '''
     output = StringIO()
+    routines = translate_to(output, commands, prefix, shared_compare, compact_calls, source_lines)
+    return output.getvalue(), routines
+
+
+def translate_to(output, commands, prefix='', shared_compare=False, compact_calls=False,
+                 source_lines=False):
+    '''
+    Like translate(), but writes the assembly to output as commands
+    are consumed. Returns the routines.
+
+    With source_lines, each command's code is preceded by a comment
+    with the VM file and line it came from.
+
+    >>> output = StringIO()
+    >>> _ = translate_to(output, parser('\\nneg', 'Main'), source_lines=True)
+    >>> print output.getvalue(),
+    //> Main.vm:2
+    // neg
+    @SP
+    A=M-1
+    M=-M
+    <BLANKLINE>
+    '''
     current_function = None
+    routines = {}
     for i, command in enumerate(commands):
         if isinstance(command, Function):
             current_function = command
-        output.write(command.asm(i, current_function))
+        if source_lines:
+            if command.location is None:
+                output.write(NO_LOCATION_COMMENT)
+            else:
+                output.write(LOCATION_COMMENT % command.location)
+        asm, routine = translate_command(command, '%s%d' % (prefix, i), current_function,
+                                         shared_compare, compact_calls)
+        if routine is not None:
+            name, routine = routine
+            routines[name] = routine
+        output.write(asm)
+
+    return routines
+
+
+def translate_command(command, i, function, shared_compare=False, compact_calls=False):
+    '''
+    Returns a single command's annotated assembly, and the (name, code)
+    of the shared routine it jumps to, or None.
+    '''
+    if shared_compare and isinstance(command, Equality):
+        routine = command.shared_routine()
+        asm_code = command.shared_asm_code(i, function)
+    elif compact_calls and isinstance(command, (Call, Return)):
+        routine = command.compact_routine()
+        asm_code = command.compact_asm_code(i, function)
+    else:
+        return TEMPLATES.asm(command, i, function), None
+    return command.annotate(asm_code), routine
+
+
+class TemplateCache(object):
+    '''
+    A least recently used memo of translated code for commands that
+    don't use their unique identifier, since the same few pushes and
+    pops make up most of any program.
+
+    >>> cache = TemplateCache(2)
+    >>> for command in [Push(CONSTANT, 0, 'f'), Push(LOCAL, 0, 'f'), Push(CONSTANT, 0, 'f'),
+    ...                 Add(), Push(LOCAL, 0, 'f'), Eq()]:
+    ...     _ = cache.asm(command, 0, None)
+    >>> cache.hits, cache.misses, len(cache.entries)
+    (1, 4, 2)
+    >>> print cache.report()
+    templates: 1 hits, 4 misses (20.0% hit rate)
+    >>> cache.clear()
+    >>> cache.hits, cache.misses, len(cache.entries)
+    (0, 0, 0)
+    '''
+    def __init__(self, size=TEMPLATE_CACHE_SIZE):
+        self.size = size
+        self.clear()
+
+    def clear(self):
+        '''
+        Empties the cache and its hit and miss counts.
+        '''
+        self.entries = {}
+        self.clock = 0
+        self.hits = 0
+        self.misses = 0
+
+    def asm(self, command, i, function):
+        if command.uses_identifier:
+            return command.asm(i, function)
+        key = command.template_key(function)
+        self.clock += 1
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            # entries are [asm, last use]
+            entry[1] = self.clock
+            return entry[0]
+        self.misses += 1
+        if len(self.entries) >= self.size:
+            self.evict()
+        asm = command.asm(i, function)
+        self.entries[key] = [asm, self.clock]
+        return asm
+
+    def evict(self):
+        # linear, but only on misses once the cache is full
+        oldest = min(self.entries, key=lambda key: self.entries[key][1])
+        del self.entries[oldest]
+
+    def report(self):
+        lookups = self.hits + self.misses
+        return 'templates: %d hits, %d misses (%.1f%% hit rate)' % (
+            self.hits, self.misses, 100.0 * self.hits / lookups if lookups else 0)
+
+
+# one per process, so pool workers each keep their own
+TEMPLATES = TemplateCache()
+
+
+def reset_templates():
+    '''
+    Empties the template cache and its counts, as in a fresh process.
+    '''
+    TEMPLATES.clear()
+
 
-    return output.getvalue()
+def routines_code(routines):
+    if not routines:
+        return ''
+    return HALT + ''.join(routines[name] for name in sorted(routines))
 
 
-def code_with_init(commands):
+def code_with_init(commands, output=None, **options):
     '''
     Calls code(), but with initialization code.
 
@@ -1030,16 +1448,170 @@ def code_with_init(commands):
     (None$main)
     <BLANKLINE>
     '''
-    return code(chain([Initialize()], commands))
+    return code(chain([Initialize()], commands), output, **options)
+
+
+def translate_file(job):
+    '''
+    Parses and translates a single .vm file's source, with labels
+    prefixed by its name, going through the cache if there is one.
+    Takes a (filename, source, options, cache) tuple so it can be
+    mapped over a process pool. Returns the chunk, whether it came from
+    the cache, and the template cache's (hits, misses) while translating
+    it.
+    '''
+    filename, source, options, cache = job
+    if cache is not None:
+        key = cache.key(filename, source, options)
+        chunk = cache.get(key)
+        if chunk is not None:
+            return chunk, True, (0, 0)
+    hits, misses = TEMPLATES.hits, TEMPLATES.misses
+    chunk = translate(parser(source, filename), prefix=filename + '.', **options)
+    if cache is not None:
+        cache.put(key, chunk)
+    return chunk, False, (TEMPLATES.hits - hits, TEMPLATES.misses - misses)
+
+
+def translator_version():
+    '''
+    A hash of this module's source, so cached translations are dropped
+    whenever the translator changes.
+    '''
+    with open(os.path.splitext(__file__)[0] + '.py', 'rb') as source:
+        return hashlib.sha1(source.read()).hexdigest()
+
+
+class TranslationCache(object):
+    '''
+    A directory of translated file chunks, keyed by the translator
+    version, the translation options, the file name (it prefixes labels
+    and statics) and the file's contents.
+
+    >>> import shutil, tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> vmfile = os.path.join(directory, 'Main.vm')
+    >>> open(vmfile, 'wb').write('push constant 1\\neq')
+    >>> cache = TranslationCache(os.path.join(directory, 'cache'))
+    >>> def build(**options):
+    ...     output = StringIO()
+    ...     translate_files([vmfile], output, cache=cache, **options)
+    ...     return output.getvalue()
+    >>> first = build()
+    >>> build() == first
+    True
+    >>> cache.hits, cache.misses
+    (1, 1)
+    >>> build(shared_compare=True) == first
+    False
+    >>> shutil.rmtree(directory)
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        self.version = translator_version()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, filename, source, options):
+        digest = hashlib.sha1()
+        for part in [self.version, repr(sorted(options.items())), filename, source]:
+            digest.update('%d:%s' % (len(part), part))
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.chunk')
+
+    def get(self, key):
+        try:
+            with open(self.path(key), 'rb') as chunkfile:
+                return cPickle.load(chunkfile)
+        except (IOError, EOFError, cPickle.UnpicklingError):
+            return None
+
+    def put(self, key, chunk):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # write and rename, so readers never see a partial chunk
+        temporary = self.path(key) + '.%d.tmp' % os.getpid()
+        with open(temporary, 'wb') as chunkfile:
+            cPickle.dump(chunk, chunkfile, cPickle.HIGHEST_PROTOCOL)
+        os.rename(temporary, self.path(key))
+
+
+def translate_files(paths, output, jobs=1, cache=None, **options):
+    '''
+    Translates .vm files into one program with initialization code,
+    written to output. Files are read, translated and written one at a
+    time, in the order given, so memory use doesn't grow with the
+    number of files. With jobs > 1 they are translated on a process
+    pool instead. With a TranslationCache, only files whose chunk isn't
+    cached are translated.
+    '''
+    def work():
+        for path in paths:
+            with open(path, 'rb') as vmfile:
+                yield os.path.basename(path)[:-3], vmfile.read(), options, cache
+
+    routines = translate_to(output, [Initialize()], **options)
+    pool = None
+    if jobs > 1 and len(paths) > 1:
+        pool = Pool(min(jobs, len(paths)))
+        chunks = pool.imap(translate_file, work())
+    else:
+        chunks = imap(translate_file, work())
+    try:
+        for (asm, used_routines), cached, (hits, misses) in chunks:
+            output.write(asm)
+            routines.update(used_routines)
+            if pool is not None:
+                # workers count in their own copy of the template cache
+                TEMPLATES.hits += hits
+                TEMPLATES.misses += misses
+            if cache is not None:
+                if cached:
+                    cache.hits += 1
+                else:
+                    cache.misses += 1
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    if options.get('source_lines'):
+        output.write(NO_LOCATION_COMMENT)
+    output.write(routines_code(routines))
 
 
 def main(args):
+    optimize = False
+    stats = False
+    jobs = 1
+    cache = None
+    options = {}
+    while args and args[0].startswith('--'):
+        if args[0] == '--optimize':
+            optimize = True
+        elif args[0] == '--stats':
+            stats = True
+        elif args[0].startswith('--jobs='):
+            jobs = int(args[0][len('--jobs='):]) or cpu_count()
+        elif args[0].startswith('--cache='):
+            cache = TranslationCache(args[0][len('--cache='):])
+        elif args[0] == '--shared-compare':
+            options['shared_compare'] = True
+        elif args[0] == '--compact-calls':
+            options['compact_calls'] = True
+        elif args[0] == '--source-lines':
+            options['source_lines'] = True
+        else:
+            print_usage()
+            return -1
+        args = args[1:]
     if len(args) != 1:
         print_usage()
         return -1
     path, = args
     if os.path.isdir(path):
-        paths = glob(os.path.join(path, '*.vm'))
+        paths = sorted(glob(os.path.join(path, '*.vm')))
         if path.endswith(os.path.sep):
             path = path[:-1]
         outpath = os.path.join(path, os.path.basename(path) + '.asm')
@@ -1053,17 +1625,23 @@ def main(args):
         paths = [path]
         outpath = path[:-3] + '.asm'
 
-    commands = []
-    for path in paths:
-        filename = os.path.basename(path)[:-3]
-        with open(path, 'rb') as vmfile:
-            commands += parser(vmfile.read(), filename)
     with open(outpath, 'wb') as asmfile:
-        asmfile.write(code_with_init(commands))
+        output = asmfile
+        if optimize:
+            output = peephole.Writer(asmfile)
+        translate_files(paths, output, jobs, cache, **options)
+        if optimize:
+            output.close()
+    if cache is not None:
+        print 'cache: %d hits, %d translated' % (cache.hits, cache.misses)
+    if optimize:
+        print 'peephole: saved %d instructions' % output.saved
+    if stats:
+        print TEMPLATES.report()
     return 0
 
 def print_usage():
-        print 'usage: vm.py [path/to/[file.vm]]'
+        print 'usage: vm.py [--optimize] [--stats] [--shared-compare] [--compact-calls] [--source-lines] [--jobs=N] [--cache=DIR] [path/to/[file.vm]]'
 
 if __name__ == '__main__':
     import doctest
@@ -0,0 +1,251 @@
+#!/usr/bin/python2
+'''
+Translates VM code straight to Hack machine code.
+
+The two step path renders every command's assembly template to text,
+and the assembler then splits, strips and regex matches each line
+again. Here each distinct template is compiled once into (kind, value)
+instruction tuples, with C instructions and numeric A instructions
+already encoded, and the tuples are fed to the assembler's symbol
+resolution (assembler.link) in memory.
+
+A template depends on the command, its file (for statics) and its
+function (for labels), but not on the command's unique identifier.
+Templates are compiled with a placeholder identifier, which is filled
+in for each occurrence of the few commands that generate labels.
+
+The machine code is identical to translating with vm.py and
+assembling the result (without --optimize, which works on the text).
+
+    >>> words = translate([vm.Push(vm.CONSTANT, 7, 'f'), vm.Eq(), vm.Eq()])
+    >>> words == assembler.assemble(assembler.parser(vm.code([vm.Push(vm.CONSTANT, 7, 'f'), vm.Eq(), vm.Eq()])))
+    True
+'''
+
+from glob import glob
+from itertools import chain
+import os
+import sys
+from StringIO import StringIO
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, '06'))
+
+import assembler
+from assembler import WORD, SYMBOL, LABEL
+import vm
+
+# not a valid symbol character, so it can't clash with VM names
+UNIQUE = '#'
+BENCHMARK_REPEAT = 5
+
+
+def compile_template(asm):
+    '''
+    Compiles assembly into instruction tuples, plus the indices of the
+    symbols and labels that contain the UNIQUE placeholder.
+
+    >>> compile_template('// x\\n@EQUAL#\\nD;JEQ\\n@7\\n(EQUAL#)\\n@SP')
+    ([(1, 'EQUAL#'), (0, 58114), (0, 7), (2, 'EQUAL#'), (1, 'SP')], [0, 3])
+    '''
+    instructions = []
+    holes = []
+    for line in asm.splitlines():
+        if '//' in line:
+            line = line[:line.find('//')]
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('@'):
+            value = line[1:]
+            if value[0].isdigit():
+                instructions.append((WORD, assembler.NumericLiteral(int(value)).encode()))
+                continue
+            instruction = (SYMBOL, value)
+        elif line.startswith('('):
+            instruction = (LABEL, line[1:-1])
+        else:
+            instructions.append((WORD, assembler.CInstruction.parse(line).encode()))
+            continue
+        if UNIQUE in instruction[1]:
+            holes.append(len(instructions))
+        instructions.append(instruction)
+    return instructions, holes
+
+
+class Backend(object):
+    '''
+    Turns VM commands into instruction tuples, compiling each distinct
+    template once. Collects the shared routines the commands jump to.
+
+    >>> backend = Backend(shared_compare=True)
+    >>> instructions = list(backend.instructions([vm.Eq(), vm.Eq()], 'Main.'))
+    >>> [value for kind, value in instructions if kind != WORD]
+    ['CMPRETMain.0', 'COMPARE_JEQ', 'CMPRETMain.0', 'CMPRETMain.1', 'COMPARE_JEQ', 'CMPRETMain.1']
+    >>> len(backend.templates), backend.routines.keys()
+    (1, ['COMPARE_JEQ'])
+    '''
+    def __init__(self, shared_compare=False, compact_calls=False):
+        self.shared_compare = shared_compare
+        self.compact_calls = compact_calls
+        self.templates = {}
+        self.routines = {}
+
+    def template(self, command, function):
+        key = command.template_key(function)
+        template = self.templates.get(key)
+        if template is None:
+            asm, routine = vm.translate_command(command, UNIQUE, function,
+                                                self.shared_compare, self.compact_calls)
+            template = self.templates[key] = compile_template(asm) + (routine,)
+        return template
+
+    def chunks(self, commands, prefix=''):
+        '''
+        Yields a list of instruction tuples per command. Labels are made
+        unique like vm.translate() does.
+        '''
+        current_function = None
+        for i, command in enumerate(commands):
+            if isinstance(command, vm.Function):
+                current_function = command
+            instructions, holes, routine = self.template(command, current_function)
+            if routine is not None:
+                name, routine = routine
+                self.routines[name] = routine
+            if holes:
+                unique_identifier = '%s%d' % (prefix, i)
+                instructions = list(instructions)
+                for hole in holes:
+                    kind, value = instructions[hole]
+                    instructions[hole] = kind, value.replace(UNIQUE, unique_identifier)
+            yield instructions
+
+    def instructions(self, commands, prefix=''):
+        return chain.from_iterable(self.chunks(commands, prefix))
+
+    def routine_instructions(self):
+        return compile_template(vm.routines_code(self.routines))[0]
+
+
+def translate(commands, **options):
+    '''
+    Translates commands, without initialization code, to machine words.
+    '''
+    backend = Backend(**options)
+
+    def parts():
+        yield backend.instructions(commands)
+        # only known once all commands are consumed
+        yield backend.routine_instructions()
+    return assembler.link(chain.from_iterable(parts()))
+
+
+def vm2hack(paths, **options):
+    '''
+    Translates .vm files into one program with initialization code, like
+    vm.translate_files(), and returns its machine words.
+
+    >>> here = os.path.dirname(__file__) or '.'
+    >>> paths = sorted(glob(os.path.join(here, 'FunctionCalls', 'StaticsTest', '*.vm')))
+    >>> vm2hack(paths, compact_calls=True) == two_step(paths, compact_calls=True)
+    True
+    '''
+    backend = Backend(**options)
+
+    def parts():
+        yield backend.instructions([vm.Initialize()])
+        for path in paths:
+            filename = os.path.basename(path)[:-3]
+            with open(path, 'rb') as vmfile:
+                source = vmfile.read()
+            yield backend.instructions(vm.parser(source, filename), filename + '.')
+        # only known once all files are consumed
+        yield backend.routine_instructions()
+    return assembler.link(chain.from_iterable(parts()))
+
+
+def two_step(paths, **options):
+    '''
+    Translates with vm.py and assembles the text, the path vm2hack()
+    replaces.
+    '''
+    output = StringIO()
+    vm.translate_files(paths, output, **options)
+    return assembler.assemble(assembler.parser(output.getvalue()))
+
+
+def best_time(function, *args, **kwargs):
+    best = None
+    for _ in xrange(BENCHMARK_REPEAT):
+        start = time.time()
+        result = function(*args, **kwargs)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def benchmark(paths, **options):
+    two_step_time, expected = best_time(two_step, paths, **options)
+    fused_time, words = best_time(vm2hack, paths, **options)
+    if words != expected:
+        raise AssertionError('vm2hack and vm.py + assembler.py disagree')
+    print '%d words, best of %d runs' % (len(words), BENCHMARK_REPEAT)
+    print 'two step: %.3fs' % two_step_time
+    print 'vm2hack:  %.3fs (%.1fx)' % (fused_time, two_step_time / fused_time)
+
+
+def main(args):
+    output_format = 'hack'
+    run_benchmark = False
+    options = {}
+    while args and args[0].startswith('--'):
+        if args[0].startswith('--format='):
+            output_format = args[0][len('--format='):]
+        elif args[0] == '--shared-compare':
+            options['shared_compare'] = True
+        elif args[0] == '--compact-calls':
+            options['compact_calls'] = True
+        elif args[0] == '--benchmark':
+            run_benchmark = True
+        else:
+            print_usage()
+            return -1
+        args = args[1:]
+    if len(args) != 1 or output_format not in assembler.FORMATS:
+        print_usage()
+        return -1
+    path, = args
+    extension, writer = assembler.FORMATS[output_format]
+    if os.path.isdir(path):
+        paths = sorted(glob(os.path.join(path, '*.vm')))
+        if path.endswith(os.path.sep):
+            path = path[:-1]
+        outpath = os.path.join(path, os.path.basename(path) + extension)
+    elif not path.endswith('.vm'):
+        print_usage()
+        return -1
+    elif not os.path.exists(path):
+        print 'file not found'
+        return 1
+    else:
+        paths = [path]
+        outpath = path[:-3] + extension
+
+    if run_benchmark:
+        benchmark(paths, **options)
+        return 0
+    words = vm2hack(paths, **options)
+    with open(outpath, 'wb') as outfile:
+        outfile.write(writer(words))
+    return 0
+
+def print_usage():
+        print 'usage: vm2hack.py [--format=hack|bin] [--shared-compare] [--compact-calls] [--benchmark] [path/to/[file.vm]]'
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
+
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,461 @@
+#!/usr/bin/python2
+'''
+An interpreter for the nand2tetris VM language.
+
+Runs the commands produced by vm.parser directly, without going
+through assembly. Memory follows the Hack platform's layout (SP, LCL,
+ARG, THIS and THAT in RAM[0..4], temp at RAM[5..12], statics from
+RAM[16], the stack from wherever SP points), so results can be checked
+against the same .cmp files as the translated programs.
+
+Each command is compiled once into a closure over the RAM array.
+Labels cost nothing at run time, as in the VM emulator: they are
+resolved to the index of the command that follows them.
+
+    >>> machine = VirtualMachine(vm.parser(\'\'\'
+    ... push constant 7
+    ... push constant 8
+    ... add\'\'\'))
+    >>> machine.ram[SP] = 256
+    >>> machine.run(100)
+    3
+    >>> machine.ram[SP], machine.ram[256]
+    (257, 15)
+'''
+
+from array import array
+from glob import glob
+import os
+import sys
+
+import vm
+
+RAM_SIZE = 2 ** 15
+SP, LCL, ARG, THIS, THAT = range(5)
+POINTERS = {'LCL': LCL, 'ARG': ARG, 'THIS': THIS, 'THAT': THAT}
+STATIC_BASE = 16
+ENTRY_POINT = 'Sys.init'
+
+
+class VMError(Exception):
+    pass
+
+
+def wrap(value):
+    '''
+    Keeps a Python int in the signed 16 bit range.
+
+    >>> wrap(32767 + 1), wrap(-32768 - 1), wrap(-5)
+    (-32768, 32767, -5)
+    '''
+    return ((value + 0x8000) & 0xFFFF) - 0x8000
+
+
+def binary(operation):
+    def compile_binary(command, machine, index):
+        ram = machine.ram
+
+        def execute():
+            sp = ram[SP] - 1
+            ram[SP] = sp
+            ram[sp - 1] = operation(ram[sp - 1], ram[sp])
+        return execute
+    return compile_binary
+
+
+def unary(operation):
+    def compile_unary(command, machine, index):
+        ram = machine.ram
+
+        def execute():
+            top = ram[SP] - 1
+            ram[top] = operation(ram[top])
+        return execute
+    return compile_unary
+
+
+def compile_push(command, machine, index):
+    ram = machine.ram
+    segment = command.segment
+    parameter = command.parameter
+    if segment is vm.CONSTANT:
+        def execute():
+            sp = ram[SP]
+            ram[sp] = parameter
+            ram[SP] = sp + 1
+        return execute
+    if segment.symbol in POINTERS:
+        pointer = POINTERS[segment.symbol]
+
+        def execute():
+            sp = ram[SP]
+            address = ram[pointer] + parameter
+            if address < 0:
+                # a negative index would wrap around the array
+                raise IndexError(address)
+            ram[sp] = ram[address]
+            ram[SP] = sp + 1
+        return execute
+    address = machine.fixed_address(command)
+
+    def execute():
+        sp = ram[SP]
+        ram[sp] = ram[address]
+        ram[SP] = sp + 1
+    return execute
+
+
+def compile_pop(command, machine, index):
+    ram = machine.ram
+    segment = command.segment
+    parameter = command.parameter
+    if segment is vm.CONSTANT:
+        raise vm.SyntaxError('Cannot pop constant')
+    if segment.symbol in POINTERS:
+        pointer = POINTERS[segment.symbol]
+
+        def execute():
+            sp = ram[SP] - 1
+            ram[SP] = sp
+            address = ram[pointer] + parameter
+            if address < 0:
+                raise IndexError(address)
+            ram[address] = ram[sp]
+        return execute
+    address = machine.fixed_address(command)
+
+    def execute():
+        sp = ram[SP] - 1
+        ram[SP] = sp
+        ram[address] = ram[sp]
+    return execute
+
+
+def compile_goto(command, machine, index):
+    target = machine.label_index(command, index)
+
+    def execute():
+        return target
+    return execute
+
+
+def compile_if_goto(command, machine, index):
+    ram = machine.ram
+    target = machine.label_index(command, index)
+
+    def execute():
+        sp = ram[SP] - 1
+        ram[SP] = sp
+        if ram[sp]:
+            return target
+    return execute
+
+
+def compile_function(command, machine, index):
+    ram = machine.ram
+    num_locals = command.num_locals
+
+    def execute():
+        sp = ram[SP]
+        for address in xrange(sp, sp + num_locals):
+            ram[address] = 0
+        ram[SP] = sp + num_locals
+    return execute
+
+
+def compile_call(command, machine, index):
+    ram = machine.ram
+    functions = machine.functions
+    name = command.name
+    # ARG = SP - num_arguments - (return address, LCL, ARG, THIS, THAT)
+    arg_offset = command.num_arguments + len(vm.Call.SAVED_VARS) + 1
+    return_address = index + 1
+
+    def execute():
+        sp = ram[SP]
+        ram[sp] = return_address
+        ram[sp + 1] = ram[LCL]
+        ram[sp + 2] = ram[ARG]
+        ram[sp + 3] = ram[THIS]
+        ram[sp + 4] = ram[THAT]
+        sp += 5
+        ram[ARG] = sp - arg_offset
+        ram[LCL] = sp
+        ram[SP] = sp
+        # run() reports a KeyError as an unknown function
+        return functions[name]
+    return execute
+
+
+def compile_return(command, machine, index):
+    ram = machine.ram
+
+    def execute():
+        frame = ram[LCL]
+        return_address = ram[frame - 5]
+        arg = ram[ARG]
+        ram[arg] = ram[ram[SP] - 1]
+        ram[SP] = arg + 1
+        ram[THAT] = ram[frame - 1]
+        ram[THIS] = ram[frame - 2]
+        ram[ARG] = ram[frame - 3]
+        ram[LCL] = ram[frame - 4]
+        return return_address
+    return execute
+
+
+COMPILERS = {
+    vm.Push: compile_push,
+    vm.Pop: compile_pop,
+    vm.Add: binary(lambda x, y: wrap(x + y)),
+    vm.Sub: binary(lambda x, y: wrap(x - y)),
+    vm.Neg: unary(lambda x: wrap(-x)),
+    vm.Eq: binary(lambda x, y: -(x == y)),
+    vm.Gt: binary(lambda x, y: -(x > y)),
+    vm.Lt: binary(lambda x, y: -(x < y)),
+    vm.And: binary(lambda x, y: x & y),
+    vm.Or: binary(lambda x, y: x | y),
+    vm.Not: unary(lambda x: ~x),
+    vm.Goto: compile_goto,
+    vm.IfGoto: compile_if_goto,
+    vm.Function: compile_function,
+    vm.Call: compile_call,
+    vm.Return: compile_return,
+}
+
+
+class VirtualMachine(object):
+    '''
+    >>> machine = VirtualMachine(vm.parser(\'\'\'
+    ... function Sys.init 0
+    ... push constant 4
+    ... call Main.double 1
+    ... label WHILE
+    ... goto WHILE
+    ... function Main.double 1
+    ... push argument 0
+    ... pop local 0
+    ... push local 0
+    ... push local 0
+    ... add
+    ... pop static 3
+    ... push static 3
+    ... return\'\'\', 'Main'))
+    >>> machine.ram[SP] = 261
+    >>> machine.run(13)
+    13
+    >>> machine.ram[SP], machine.ram[261], machine.ram[STATIC_BASE], machine.halted()
+    (262, 8, 8, True)
+    '''
+    def __init__(self, commands):
+        self.ram = array('h', [0]) * RAM_SIZE
+        self.statics = {}
+        self.labels = {}
+        self.functions = {}
+        self.commands = []
+        # labels are not commands, so they point at the next command
+        current_function = None
+        for command in commands:
+            if isinstance(command, vm.Function):
+                current_function = command
+                self.functions[command.name] = len(self.commands)
+            if isinstance(command, vm.Label):
+                self.labels[command.name_to_label(current_function, command.name)] = len(self.commands)
+            else:
+                self.commands.append((command, current_function))
+        self.program = [COMPILERS[command.__class__](command, self, index)
+                        for index, (command, _) in enumerate(self.commands)]
+        self.reset()
+
+    def label_index(self, command, index):
+        label = command.name_to_label(self.commands[index][1], command.name)
+        if label not in self.labels:
+            raise VMError('Unknown label: %s' % label)
+        return self.labels[label]
+
+    def fixed_address(self, operation):
+        '''
+        Returns the RAM address of a pointer, temp or static operation.
+        Statics are allocated from RAM[16] in order of first use, like
+        the assembler allocates variables.
+        '''
+        segment = operation.segment
+        if segment is vm.STATIC:
+            symbol = '%s.%d' % (operation.filename, operation.parameter)
+            if symbol not in self.statics:
+                self.statics[symbol] = STATIC_BASE + len(self.statics)
+            return self.statics[symbol]
+        segment.check_bounds(operation)
+        return segment.base + operation.parameter
+
+    def segment_address(self, name, index):
+        '''
+        Returns the RAM address of a segment entry, e.g. ('local', 2).
+        '''
+        segment = vm.SEGMENTS[name]
+        if segment.symbol in POINTERS:
+            return self.ram[POINTERS[segment.symbol]] + index
+        return self.fixed_address(vm.Push(segment, index, None))
+
+    def reset(self):
+        '''
+        Like the VM emulator, starts at Sys.init (without a call frame)
+        if the program has one, or at its first command otherwise.
+        '''
+        self.pc = self.functions.get(ENTRY_POINT, 0)
+        self.steps = 0
+
+    def halted(self):
+        '''
+        True when the program ran past its last command or sits in a
+        goto to itself, like "label WHILE, goto WHILE".
+        '''
+        if self.pc >= len(self.program):
+            return True
+        command, function = self.commands[self.pc]
+        return (isinstance(command, vm.Goto) and
+                self.labels.get(command.name_to_label(function, command.name)) == self.pc)
+
+    def step(self):
+        self.run(1)
+
+    def run(self, steps):
+        '''
+        Executes up to steps commands and returns how many ran. Stops
+        early when the program counter leaves the program. A command
+        that reaches outside the RAM, stores a value that doesn't fit in
+        it (like SP past 32767) or calls an unknown function raises
+        VMError.
+
+        >>> machine = VirtualMachine(vm.parser(\'\'\'
+        ... push constant 32767
+        ... pop pointer 0
+        ... push this 5\'\'\', 'Main'))
+        >>> machine.ram[SP] = 256
+        >>> machine.run(10)
+        Traceback (most recent call last):
+        ...
+        VMError: Main:4: push this 5: RAM address out of range
+        >>> machine.pc, machine.steps
+        (2, 2)
+        >>> machine = VirtualMachine(vm.parser(\'\'\'
+        ... label LOOP
+        ... push constant 1
+        ... goto LOOP\'\'\', 'Main'))
+        >>> machine.ram[SP] = 256
+        >>> machine.run(10 ** 6)
+        Traceback (most recent call last):
+        ...
+        VMError: Main:3: push constant 1: value out of range
+        >>> machine = VirtualMachine(vm.parser(\'\'\'
+        ... push constant 1
+        ... call Main.missing 1\'\'\', 'Main'))
+        >>> machine.ram[SP] = 256
+        >>> machine.run(10)
+        Traceback (most recent call last):
+        ...
+        VMError: Main:3: call Main.missing 1: unknown function
+        >>> machine.pc, machine.steps
+        (1, 1)
+        '''
+        program = self.program
+        end = len(program)
+        pc = self.pc
+        executed = 0
+        try:
+            for executed in xrange(steps):
+                if not 0 <= pc < end:
+                    if pc < 0:
+                        raise IndexError(pc)
+                    break
+                target = program[pc]()
+                pc = pc + 1 if target is None else target
+            else:
+                executed = max(steps, 0)
+        except (IndexError, OverflowError, KeyError) as e:
+            self.pc = pc
+            self.steps += executed
+            raise VMError(self.error_message(pc, e))
+        self.pc = pc
+        self.steps += executed
+        return executed
+
+    def error_message(self, pc, error):
+        if not 0 <= pc < len(self.commands):
+            return 'jumped to %d, outside the program' % pc
+        command, _ = self.commands[pc]
+        if isinstance(error, IndexError):
+            problem = 'RAM address out of range'
+        elif isinstance(error, KeyError):
+            problem = 'unknown function'
+        else:
+            problem = 'value out of range'
+        if command.location is None:
+            return '%s: %s' % (command, problem)
+        return '%s:%d: %s: %s' % (command.location + (command, problem))
+
+
+def load(path):
+    '''
+    Parses a .vm file, or every .vm file in a directory.
+
+    >>> here = os.path.dirname(__file__) or '.'
+    >>> machine = VirtualMachine(load(os.path.join(here, 'FunctionCalls', 'FibonacciElement')))
+    >>> machine.ram[SP] = 261
+    >>> machine.run(110), machine.ram[SP], machine.ram[261]
+    (110, 262, 3)
+    >>> machine = VirtualMachine(load(os.path.join(here, '..', '07', 'StackArithmetic', 'StackTest', 'StackTest.vm')))
+    >>> machine.ram[SP] = 256
+    >>> machine.run(38), machine.ram[SP], machine.ram[256:266].tolist()
+    (38, 266, [-1, 0, 0, 0, -1, 0, -1, 0, 0, -91])
+    '''
+    if os.path.isdir(path):
+        paths = sorted(glob(os.path.join(path, '*.vm')))
+    else:
+        paths = [path]
+    commands = []
+    for path in paths:
+        filename = os.path.basename(path)[:-3]
+        with open(path, 'rb') as vmfile:
+            commands += vm.parser(vmfile.read(), filename)
+    return commands
+
+
+def main(args):
+    steps = None
+    if args and args[0].startswith('--steps='):
+        steps = int(args[0][len('--steps='):])
+        args = args[1:]
+    if len(args) != 1:
+        print_usage()
+        return -1
+    path, = args
+    if not os.path.isdir(path) and not path.endswith('.vm'):
+        print_usage()
+        return -1
+    if not os.path.exists(path):
+        print 'file not found'
+        return 1
+
+    machine = VirtualMachine(load(path))
+    machine.ram[SP] = 256
+    chunk = 10 ** 6
+    try:
+        while not machine.halted() and (steps is None or machine.steps < steps):
+            machine.run(chunk if steps is None else min(chunk, steps - machine.steps))
+    except VMError as e:
+        print 'error: %s' % e
+        return 1
+    print 'steps: %d, SP: %d' % (machine.steps, machine.ram[SP])
+    for address in xrange(16):
+        print 'RAM[%d] = %d' % (address, machine.ram[address])
+    return 0
+
+def print_usage():
+        print 'usage: vmemu.py [--steps=N] [path/to/[file.vm]]'
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
+
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,155 @@
+#!/usr/bin/python2
+'''
+Benchmarks the assembler in projects/06.
+
+Times the parser and code (symbol resolution and rendering) phases
+separately on the bundled programs and on Pong scaled up N times, and
+prints the results as JSON so runs on different commits can be
+compared:
+
+    assembler_bench.py --scale=2,8 > before.json
+
+Only scales up to MAX_INSTRUCTIONS get their code phase timed; by
+default Pong is scaled x2, the most that fits, so every default input
+is measured through the whole pipeline.
+
+Every input is measured in a fresh worker process, so its peak RSS
+isn't masked by an earlier, bigger input.
+'''
+
+import os
+import sys
+
+import measure
+
+ASSEMBLER_DIRECTORY = os.path.join(measure.PROJECTS, '06')
+sys.path.append(ASSEMBLER_DIRECTORY)
+
+import assembler
+
+PROGRAMS = [
+    os.path.join('add', 'Add.asm'),
+    os.path.join('max', 'Max.asm'),
+    os.path.join('rect', 'Rect.asm'),
+    os.path.join('pong', 'Pong.asm'),
+    os.path.join('pong', 'PongL.asm'),
+]
+SCALED_PROGRAM = os.path.join('pong', 'Pong.asm')
+DEFAULT_SCALES = [2]
+# label addresses are 16 bit words
+MAX_INSTRUCTIONS = 2 ** 16
+
+
+def rename_labels(text, suffix):
+    '''
+    Appends suffix to every label defined in text, and to references to
+    those labels, so copies of a program can be concatenated. Variables
+    are shared between copies.
+
+    >>> print rename_labels('@LOOP\\n@i\\n(LOOP)\\n@LOOP2 // LOOP\\n(LOOP2)', '$1')
+    @LOOP$1
+    @i
+    (LOOP$1)
+    @LOOP2$1 // LOOP
+    (LOOP2$1)
+    '''
+    lines = text.splitlines()
+    labels = set(line.strip()[1:-1] for line in lines if line.strip().startswith('('))
+    renamed = []
+    for line in lines:
+        stripped = line.strip()
+        if stripped.startswith('(') and stripped[1:-1] in labels:
+            line = line.replace(stripped, '(%s%s)' % (stripped[1:-1], suffix), 1)
+        elif stripped.startswith('@'):
+            symbol = stripped[1:].split('//')[0].strip()
+            if symbol in labels:
+                line = line.replace('@' + symbol, '@' + symbol + suffix, 1)
+        renamed.append(line)
+    return assembler.NEWLINE.join(renamed)
+
+
+def scale(text, copies):
+    '''
+    Concatenates copies of a program with renamed labels. The result
+    may not fit in ROM; it only exists to be assembled. Past
+    MAX_INSTRUCTIONS, labels can't be encoded and only parsing is
+    measured.
+    '''
+    return assembler.NEWLINE.join(rename_labels(text, '$%d' % copy) for copy in xrange(copies))
+
+
+def run(job):
+    '''
+    Measures one input; runs in a worker process.
+    '''
+    name, text, repeat = job
+    lines = len(text.splitlines())
+    baseline = measure.peak_rss()
+    parse_seconds, commands = measure.best_time(repeat, lambda: list(assembler.parser(text)))
+    parse_allocations = measure.allocations(lambda: list(assembler.parser(text)))
+    instructions = sum(1 for command in commands if command.is_instruction())
+    result = {
+        'name': name,
+        'lines': lines,
+        'instructions': instructions,
+        'parse_seconds': parse_seconds,
+        'parse_lines_per_second': measure.rate(lines, parse_seconds),
+        'parse_allocations_per_line': float(parse_allocations) / lines,
+        'code_seconds': None,
+        'code_lines_per_second': None,
+        'code_allocations_per_line': None,
+    }
+    if instructions <= MAX_INSTRUCTIONS:
+        code_seconds, _ = measure.best_time(repeat, lambda: assembler.code(commands))
+        code_allocations = measure.allocations(lambda: assembler.code(commands))
+        result.update({
+            'code_seconds': code_seconds,
+            'code_lines_per_second': measure.rate(lines, code_seconds),
+            'code_allocations_per_line': float(code_allocations) / lines,
+        })
+    result['peak_rss_kb'] = measure.peak_rss()
+    result['rss_growth_kb'] = result['peak_rss_kb'] - baseline
+    return result
+
+
+def jobs(scales, repeat):
+    for program in PROGRAMS:
+        with open(os.path.join(ASSEMBLER_DIRECTORY, program), 'rb') as asmfile:
+            yield program, asmfile.read(), repeat
+    with open(os.path.join(ASSEMBLER_DIRECTORY, SCALED_PROGRAM), 'rb') as asmfile:
+        text = asmfile.read()
+    for copies in scales:
+        yield '%s x%d' % (SCALED_PROGRAM, copies), scale(text, copies), repeat
+
+
+def main(args):
+    repeat = measure.DEFAULT_REPEAT
+    scales = DEFAULT_SCALES
+    outpath = None
+    for arg in args:
+        if arg.startswith('--repeat='):
+            repeat = int(arg[len('--repeat='):])
+        elif arg.startswith('--scale='):
+            scales = [int(copies) for copies in arg[len('--scale='):].split(',') if copies]
+        elif arg.startswith('--output='):
+            outpath = arg[len('--output='):]
+        else:
+            print_usage()
+            return -1
+
+    results = measure.isolated(run, jobs(scales, repeat))
+    for result in results:
+        if result['code_seconds'] is None:
+            sys.stderr.write('%s: %d instructions, over %d; only parsing is measured\n' % (
+                result['name'], result['instructions'], MAX_INSTRUCTIONS))
+    measure.write_json(measure.report('assembler', results), outpath)
+    return 0
+
+def print_usage():
+        print 'usage: assembler_bench.py [--repeat=N] [--scale=N,N,...] [--output=file.json]'
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
+
+    sys.exit(main(sys.argv[1:]))
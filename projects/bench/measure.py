@@ -0,0 +1,117 @@
+'''
+Measurement helpers shared by the benchmarks.
+
+Python 2 has no tracemalloc, so allocations are counted as the net
+number of objects tracked by the garbage collector (lists, tuples,
+dicts, instances; not strings or ints) that a phase leaves alive. It
+catches per-line object overhead, not short-lived garbage.
+'''
+
+import gc
+import json
+from multiprocessing import Pool
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+PROJECTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+DEFAULT_REPEAT = 5
+
+
+def best_time(repeat, function):
+    '''
+    Runs function repeat times, and returns the fastest run's time in
+    seconds and its result.
+
+    >>> seconds, result = best_time(3, lambda: 42)
+    >>> seconds >= 0, result
+    (True, 42)
+    '''
+    best = result = None
+    for _ in xrange(repeat):
+        start = time.time()
+        result = function()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def allocations(function):
+    '''
+    Returns the net number of GC tracked objects function allocates,
+    including the ones its result keeps alive.
+
+    >>> allocations(lambda: [[] for _ in xrange(1000)]) > 900
+    True
+    '''
+    gc.collect()
+    gc.disable()
+    try:
+        before = gc.get_count()[0]
+        result = function()
+        return gc.get_count()[0] - before
+    finally:
+        gc.enable()
+
+
+def peak_rss():
+    '''
+    The process's peak resident set size, in kilobytes.
+    '''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # bytes, not kilobytes
+        peak //= 1024
+    return peak
+
+
+def rate(count, seconds):
+    return count / seconds if seconds else None
+
+
+def isolated(function, jobs):
+    '''
+    Maps function over jobs, each in a fresh worker process, in order.
+    '''
+    pool = Pool(1, maxtasksperchild=1)
+    try:
+        return pool.map(function, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=PROJECTS,
+                                       stderr=open(os.devnull, 'wb')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(suite, results):
+    return {
+        'suite': suite,
+        'commit': commit(),
+        'python': platform.python_version(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+
+
+def write_json(report, path=None):
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if path is None:
+        print text
+    else:
+        with open(path, 'wb') as outfile:
+            outfile.write(text + '\n')
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
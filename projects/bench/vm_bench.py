@@ -0,0 +1,186 @@
+#!/usr/bin/python2
+'''
+Benchmarks the VM translator in projects/08 and guards its code size.
+
+Translates every program under 07/ and 08/, and the compiled OS in
+tools/OS, in each translation configuration. For each it records parse
+and code timings, and the number of asm lines and ROM words per VM
+command. Results are printed as JSON.
+
+ROM is the binding constraint, so the word count of every program is
+checked against vm_sizes.json. If any program grows beyond the
+threshold, the offenders are listed on stderr and the exit status is
+1. After an intended change, regenerate the file with --update-sizes.
+'''
+
+from glob import glob
+import json
+import os
+import sys
+from StringIO import StringIO
+
+import measure
+
+REPOSITORY = os.path.normpath(os.path.join(measure.PROJECTS, os.pardir))
+sys.path.append(os.path.join(measure.PROJECTS, '06'))
+sys.path.append(os.path.join(measure.PROJECTS, '08'))
+
+import assembler
+import peephole
+import vm
+
+PROGRAM_PATTERNS = [
+    os.path.join('projects', '07', '*', '*'),
+    os.path.join('projects', '08', '*', '*'),
+    os.path.join('tools', 'OS'),
+]
+# name: (translation options, peephole optimization)
+CONFIGURATIONS = {
+    'plain': ({}, False),
+    'optimize': ({}, True),
+    'compact': ({'shared_compare': True, 'compact_calls': True}, False),
+    'compact+optimize': ({'shared_compare': True, 'compact_calls': True}, True),
+}
+SIZES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vm_sizes.json')
+# allowed growth in words, as a fraction of the recorded size
+DEFAULT_THRESHOLD = 0.01
+
+
+def programs():
+    '''
+    Returns (name, .vm paths) for every program, named by its directory
+    relative to the repository.
+    '''
+    found = []
+    for pattern in PROGRAM_PATTERNS:
+        for directory in sorted(glob(os.path.join(REPOSITORY, pattern))):
+            paths = sorted(glob(os.path.join(directory, '*.vm')))
+            if paths:
+                found.append((os.path.relpath(directory, REPOSITORY), paths))
+    return found
+
+
+def parse(paths):
+    parsed = []
+    for path in paths:
+        filename = os.path.basename(path)[:-3]
+        with open(path, 'rb') as vmfile:
+            parsed.append((filename, list(vm.parser(vmfile.read(), filename))))
+    return parsed
+
+
+def translate(paths, options, optimize):
+    '''
+    Translates the files into one program with vm.translate_files(), and
+    returns the assembly.
+    '''
+    # start every run cold, like a fresh vm.py process
+    vm.reset_templates()
+    output = StringIO()
+    writer = peephole.Writer(output) if optimize else output
+    vm.translate_files(paths, writer, **options)
+    if optimize:
+        writer.close()
+    return output.getvalue()
+
+
+def measure_program(name, paths, configuration, repeat):
+    options, optimize = CONFIGURATIONS[configuration]
+    parse_seconds, parsed = measure.best_time(repeat, lambda: parse(paths))
+    # translate_files() reads and parses the files too
+    seconds, asm = measure.best_time(repeat, lambda: translate(paths, options, optimize))
+    commands = sum(len(file_commands) for _, file_commands in parsed)
+    asm_lines = sum(1 for line in asm.splitlines() if line and not line.startswith('//'))
+    words = sum(1 for command in assembler.parser(asm) if command.is_instruction())
+    return {
+        'name': name,
+        'configuration': configuration,
+        'vm_commands': commands,
+        'parse_seconds': parse_seconds,
+        'code_seconds': max(seconds - parse_seconds, 0),
+        'seconds': seconds,
+        'asm_lines': asm_lines,
+        'words': words,
+        'asm_lines_per_command': float(asm_lines) / commands,
+        'words_per_command': float(words) / commands,
+    }
+
+
+def sizes(results):
+    '''
+    Returns {program: {configuration: words}}.
+    '''
+    table = {}
+    for result in results:
+        table.setdefault(result['name'], {})[result['configuration']] = result['words']
+    return table
+
+
+def regressions(results, recorded, threshold):
+    '''
+    Returns a message for every result whose word count grew beyond the
+    threshold over its recorded size.
+
+    >>> result = {'name': 'Main', 'configuration': 'plain', 'words': 110}
+    >>> regressions([result], {'Main': {'plain': 100}}, 0.05)
+    ['Main [plain]: 110 words, was 100 (+10.0%)']
+    >>> regressions([result], {'Main': {'plain': 105}}, 0.05)
+    []
+    >>> regressions([result], {}, 0.05)
+    []
+    '''
+    messages = []
+    for result in results:
+        size = recorded.get(result['name'], {}).get(result['configuration'])
+        if size is not None and result['words'] > size * (1 + threshold):
+            messages.append('%s [%s]: %d words, was %d (+%.1f%%)' % (
+                result['name'], result['configuration'], result['words'], size,
+                100.0 * (result['words'] - size) / size))
+    return messages
+
+
+def main(args):
+    repeat = measure.DEFAULT_REPEAT
+    threshold = DEFAULT_THRESHOLD
+    outpath = None
+    update_sizes = False
+    for arg in args:
+        if arg.startswith('--repeat='):
+            repeat = int(arg[len('--repeat='):])
+        elif arg.startswith('--threshold='):
+            threshold = float(arg[len('--threshold='):]) / 100
+        elif arg.startswith('--output='):
+            outpath = arg[len('--output='):]
+        elif arg == '--update-sizes':
+            update_sizes = True
+        else:
+            print_usage()
+            return -1
+
+    results = [measure_program(name, paths, configuration, repeat)
+               for name, paths in programs()
+               for configuration in sorted(CONFIGURATIONS)]
+    measure.write_json(measure.report('vm', results), outpath)
+
+    if update_sizes:
+        with open(SIZES_PATH, 'wb') as sizesfile:
+            sizesfile.write(json.dumps(sizes(results), indent=2, sort_keys=True) + '\n')
+        return 0
+    with open(SIZES_PATH, 'rb') as sizesfile:
+        recorded = json.load(sizesfile)
+    messages = regressions(results, recorded, threshold)
+    if messages:
+        sys.stderr.write('CODE SIZE REGRESSION beyond %.1f%%:\n' % (100 * threshold))
+        for message in messages:
+            sys.stderr.write('  %s\n' % message)
+        return 1
+    return 0
+
+def print_usage():
+        print 'usage: vm_bench.py [--repeat=N] [--threshold=PERCENT] [--output=file.json] [--update-sizes]'
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
+
+    sys.exit(main(sys.argv[1:]))
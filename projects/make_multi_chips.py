@@ -1,5 +1,9 @@
 import os
 import string
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "sim"))
+import hdl
 
 WIDTH = 16
 FILENAME = "%(name)s.hdl"
@@ -18,6 +22,11 @@ CHIP %(name)s {
 }"""
 HEADER_LINE = "    %(keyword)s %(items)s;"
 BODY_LINE = "    %(gate)s(%(inputs)s, %(outputs)s);"
+# ways: (the DMux and the Mux16 that select among that many blocks)
+SELECTORS = {2: ("DMux", "Mux16"), 4: ("DMux4Way", "Mux4Way16"), 8: ("DMux8Way", "Mux8Way16")}
+# the one word block that RAMs are built from at the bottom
+REGISTER = "Register"
+OBJECTIVES = ["gates", "depth"]
 
 class Gate(object):
     def __init__(self, gate, width, wide_inputs, single_inputs, outputs):
@@ -109,8 +118,16 @@ class Ram(Gate):
 
     @property
     def block_name(self):
+        if self.block_bits == 0:
+            return REGISTER
         return "%s%s" % (self.gate, self.humanize_size(self.block_size))
 
+    @property
+    def selectors(self):
+        if self.address_size not in SELECTORS:
+            raise ValueError("no selector chips for %d ways" % self.address_size)
+        return SELECTORS[self.address_size]
+
     @property
     def body_code(self):
         return NEWLINE.join([self.dmux, self.blocks, self.mux])
@@ -119,27 +136,177 @@ class Ram(Gate):
     def dmux(self):
         address = self.subaddress(self.block_bits, self.bits - self.block_bits)
         loads = ", ".join(["%s=load%d" % (letter, number) for letter, number in self.letters_numbers])
-        address_size = self.address_size
-        return "    DMux%(address_size)dWay(in=load, sel=%(address)s, %(loads)s);" % locals()
+        dmux = self.selectors[0]
+        return "    %(dmux)s(in=load, sel=%(address)s, %(loads)s);" % locals()
 
     @property
     def mux(self):
         outs = ", ".join(["%s=out%d" % (letter, number) for letter, number in self.letters_numbers])
         address = self.subaddress(self.block_bits, self.bits - self.block_bits)
-        address_size = self.address_size
-        return "    Mux%(address_size)sWay16(%(outs)s, sel=%(address)s, out=out);" % locals()
+        mux = self.selectors[1]
+        return "    %(mux)s(%(outs)s, sel=%(address)s, out=out);" % locals()
 
     @property
     def blocks(self):
+        if self.block_bits == 0:
+            return NEWLINE.join(
+                "    %(block_name)s(in=in, load=load%(i)s, out=out%(i)s);" % dict(block_name=self.block_name, i=i) for i in range(self.address_size))
         return NEWLINE.join(
             "    %(block_name)s(in=in, load=load%(i)s, address=%(address)s, out=out%(i)s);" % dict(block_name=self.block_name, i=i, address=self.subaddress(0, self.block_bits)) for i in range(self.address_size))
 
     def subaddress(self, first, count):
+        if count == 1:
+            return "address[%d]" % first
         return "address[%d..%d]" % (first, first + count - 1)
 
+
+def path(*depths):
+    """
+    The depth of a path through pieces of the given depths, or None if
+    any piece has no path.
+    """
+    if None in depths:
+        return None
+    return sum(depths)
+
+
+def longest(*depths):
+    depths = [depth for depth in depths if depth is not None]
+    return max(depths) if depths else None
+
+
+class Cost(object):
+    """
+    A chip's Nand gate count and its longest paths between pins, as
+    {(input, output): depth}, where hdl.STATE stands for the DFFs.
+    """
+    def __init__(self, gates, depths):
+        self.gates = gates
+        self.depths = depths
+
+    @classmethod
+    def measure(cls, library, name):
+        netlist = hdl.Flattener(library).flatten(name)
+        return cls(len(netlist.nand_out), hdl.path_depths(netlist))
+
+    @property
+    def depth(self):
+        return max(self.depths.values())
+
+    def longest_from(self, pin):
+        return longest(*[depth for (source, _), depth in self.depths.items() if source == pin])
+
+    def longest_to(self, pin):
+        return longest(*[depth for (_, sink), depth in self.depths.items() if sink == pin])
+
+    def ram(self, ways, dmux, mux):
+        """
+        The cost of a RAM of ways of these blocks, selected by a dmux
+        and a mux: the blocks' paths, extended through the selectors.
+
+        >>> library = hdl.Library(hdl.LIBRARY[0])
+        >>> register = Cost.measure(library, REGISTER)
+        >>> ram8 = register.ram(8, *[Cost.measure(library, name) for name in SELECTORS[8]])
+        >>> measured = Cost.measure(library, "RAM8")
+        >>> ram8.gates, ram8.depth, ram8.depths == measured.depths
+        (2211, 14, True)
+        """
+        state = hdl.STATE
+        depths = self.depths
+        block_out = longest(*[mux.depths.get((letter, "out")) for letter in string.letters[:ways]])
+        block_load = longest(*[dmux.depths.get(("in", letter)) for letter in string.letters[:ways]])
+        select_load = dmux.longest_from("sel")
+        ram_depths = {
+            ("address", "out"): longest(mux.depths.get(("sel", "out")),
+                                        path(depths.get(("address", "out")), block_out)),
+            ("address", state): longest(path(select_load, depths.get(("load", state))),
+                                        depths.get(("address", state))),
+            ("load", state): path(block_load, depths.get(("load", state))),
+            ("in", state): depths.get(("in", state)),
+            (state, "out"): path(depths.get((state, "out")), block_out),
+            (state, state): depths.get((state, state)),
+        }
+        return Cost(self.gates * ways + dmux.gates + mux.gates,
+                    dict((pins, depth) for pins, depth in ram_depths.items() if depth is not None))
+
+
+class Planner(object):
+    """
+    Chooses how to build a RAM of any address width: from 2**k blocks of
+    the RAM k bits narrower (down to Registers), selected by the
+    SELECTORS chips for one of the allowed ways. Each width's choice is
+    the one with the fewest gates (or the least depth, whichever is the
+    objective), and the blocks are in turn the best RAMs of their own
+    width. Gate counts and depths are measured on the chips' HDL as
+    found by the simulator from directory.
+
+    >>> planner = Planner(hdl.LIBRARY[0])
+    >>> library = hdl.Library(hdl.LIBRARY[0])
+    >>> for bits, name in [(3, "RAM8"), (6, "RAM64")]:
+    ...     cost, measured = planner.cost(bits), Cost.measure(library, name)
+    ...     print name, cost.gates, cost.depth, cost.depths == measured.depths
+    RAM8 2211 14 True
+    RAM64 18619 26 True
+    >>> print " <- ".join(ram.block_name for ram in planner.plan(6))
+    RAM8 <- Register
+    >>> print " <- ".join(ram.block_name for ram in Planner(hdl.LIBRARY[0], [2]).plan(6))
+    RAM32 <- RAM16 <- RAM8 <- RAM4 <- RAM2 <- Register
+    """
+    def __init__(self, directory, ways=sorted(SELECTORS), objective="gates"):
+        library = hdl.Library(directory)
+        self.ways = ways
+        self.objective = objective
+        self.selectors = dict((n, [Cost.measure(library, name) for name in SELECTORS[n]])
+                              for n in ways)
+        # bits: (cost, block bits)
+        self.best = {0: (Cost.measure(library, REGISTER), None)}
+
+    def key(self, cost, ways):
+        if self.objective == "depth":
+            return cost.depth, cost.gates, -ways
+        return cost.gates, cost.depth, -ways
+
+    def cost(self, bits):
+        if bits not in self.best:
+            candidates = []
+            for ways in self.ways:
+                select_bits = ways.bit_length() - 1
+                if select_bits <= bits:
+                    cost = self.cost(bits - select_bits).ram(ways, *self.selectors[ways])
+                    candidates.append((self.key(cost, ways), cost, bits - select_bits))
+            if not candidates:
+                raise ValueError("no way to build %d address bits from %s ways" % (bits, self.ways))
+            _, cost, block_bits = min(candidates)
+            self.best[bits] = cost, block_bits
+        return self.best[bits][0]
+
+    def plan(self, bits):
+        """
+        The RAMs to generate for a RAM of bits address bits, itself
+        first and the smallest last.
+        """
+        self.cost(bits)
+        rams = []
+        while bits:
+            block_bits = self.best[bits][1]
+            rams.append(Ram(WIDTH, bits, block_bits))
+            bits = block_bits
+        return rams
+
 def write_chip(dirname, gate):
     open(os.path.join(dirname, gate.filename), "wb").write(gate.chip.replace(NEWLINE, "\r\n"))
 
+
+def write_netlist(dirname, gate):
+    """
+    Writes the gate's chip flattened, next to its .hdl, for simulators to
+    load instead of expanding the HDL.
+    """
+    path = os.path.join(dirname, gate.filename)
+    library = hdl.Library(dirname)
+    netlist = hdl.flatten(path, library)
+    hdl.write_netlist(netlist, path[:-len(".hdl")] + hdl.NETLIST_EXTENSION, library.sources)
+
 GATES = {"01": [Gate("And", WIDTH, ["a", "b"], [], ["out"]),
                 Gate("Or", WIDTH, ["a", "b"], [], ["out"]),
                 Gate("Mux", WIDTH, ["a", "b"], ["sel"], ["out"]),
@@ -150,7 +317,56 @@ GATES = {"01": [Gate("And", WIDTH, ["a", "b"], [], ["out"]),
                   Ram(WIDTH, 6, 3)],
          "03/b": [Ram(WIDTH, 9, 6), Ram(WIDTH, 12, 9), Ram(WIDTH, 14, 12)]}
 
+def main(args):
+    objective = "gates"
+    ways = sorted(SELECTORS)
+    netlists = False
+    while args and args[0].startswith("--"):
+        if args[0].startswith("--optimize=") and args[0][len("--optimize="):] in OBJECTIVES:
+            objective = args[0][len("--optimize="):]
+        elif args[0].startswith("--ways="):
+            ways = sorted(int(n) for n in args[0][len("--ways="):].split(","))
+            if not set(ways) <= set(SELECTORS):
+                print "ways must be among %s" % ", ".join(str(n) for n in sorted(SELECTORS))
+                return -1
+        elif args[0] == "--netlist":
+            netlists = True
+        else:
+            print_usage()
+            return -1
+        args = args[1:]
+
+    if not args:
+        chips = [(dirname, gate) for dirname, gates in sorted(GATES.iteritems()) for gate in gates]
+    else:
+        dirname = args[0]
+        if not os.path.isdir(dirname) or not all(bits.isdigit() and int(bits) > 0 for bits in args[1:]):
+            print_usage()
+            return -1
+        planner = Planner(dirname, ways, objective)
+        rams = {}
+        for bits in args[1:]:
+            for ram in planner.plan(int(bits)):
+                rams[ram.bits] = ram
+        chips = [(dirname, rams[bits]) for bits in sorted(rams)]
+        for bits in sorted(int(bits) for bits in args[1:]):
+            cost = planner.cost(bits)
+            print "%s: %d Nand gates, depth %d, from %s" % (
+                rams[bits].name, cost.gates, cost.depth,
+                " <- ".join(ram.block_name for ram in planner.plan(bits)))
+    for dirname, gate in chips:
+        write_chip(dirname, gate)
+    if netlists:
+        for dirname, gate in chips:
+            write_netlist(dirname, gate)
+    return 0
+
+def print_usage():
+        print "usage: make_multi_chips.py [--netlist]"
+        print "       make_multi_chips.py [--optimize=gates|depth] [--ways=2,4,8] [--netlist] directory bits..."
+
 if __name__ == '__main__':
-    for dirname, gates in GATES.iteritems():
-        for gate in gates:
-            write_chip(dirname, gate)
+    import doctest
+    doctest.testmod()
+
+    sys.exit(main(sys.argv[1:]))
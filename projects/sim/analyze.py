@@ -0,0 +1,361 @@
+#!/usr/bin/python2
+'''
+Counts the Nand gates of HDL chips and finds their logic depth.
+
+Every chip is summarized once, bottom up: its Nand gates, DFFs and
+boxes (built-in chips with no HDL, like Screen), and the longest path in
+Nand gates from each input bit to each output bit. A chip's summary is
+found by expanding only its own parts (hdl.Flattener, with every part
+but Nand and DFF boxed) and chaining their summaries, so analyzing a
+RAM16K expands four RAM4Ks that were summarized once, not 16K
+Registers. The DFFs count as one more input and output (hdl.STATE), so
+paths from a register's output or into a register's input are found
+too. The depths are exact, as if the chip were flattened:
+
+    >>> analyzer = Analyzer(hdl.Library(hdl.LIBRARY[0]))
+    >>> summary = analyzer.summary('Xor')
+    >>> summary.gates, summary.depth, summary.pin_depths()
+    (5, 3, {'out': 3})
+    >>> hdl.path_depths(hdl.Flattener(analyzer.library).flatten('Xor'))[('a', 'out')]
+    3
+
+Results are printed as a table, or as JSON to track across commits.
+'''
+
+import json
+import os
+import sys
+
+import chips
+import hdl
+from hdl import HDLError, STATE
+
+
+class Summary(object):
+    '''
+    A chip's gate, DFF and box counts, and its depths: the longest path
+    from each source to each sink, as {(source, sink): depth}, where a
+    source is an input bit (pin, bit) or STATE, and a sink is an output
+    bit or STATE. Also has the chip's inputs and outputs, so it can be
+    boxed into its users' netlists.
+    '''
+    def __init__(self, name, inputs, outputs, gates, dffs, boxes, depths):
+        self.name = name
+        self.inputs = inputs
+        self.outputs = outputs
+        self.gates = gates
+        self.dffs = dffs
+        self.boxes = boxes
+        self.depths = depths
+        # the longest path, as (source, sink, parts), if found
+        self.path = None
+
+    @property
+    def depth(self):
+        return max(self.depths.values() or [0])
+
+    def pin_depths(self):
+        '''
+        Returns the longest path into each output pin, and into the DFFs
+        as STATE, from any source.
+        '''
+        depths = {}
+        for (_, sink), depth in self.depths.items():
+            pin = sink if sink == STATE else sink[0]
+            depths[pin] = max(depths.get(pin, 0), depth)
+        return depths
+
+
+class PartsFlattener(hdl.Flattener):
+    '''
+    Expands a chip one level: Nand and DFF parts as themselves, and
+    every other part boxed as its Summary.
+    '''
+    def __init__(self, library, summary):
+        super(PartsFlattener, self).__init__(library)
+        self.summary = summary
+
+    def expand_or_box(self, part, wires):
+        if part in hdl.PRIMITIVES:
+            self.expand(part, wires)
+        else:
+            self.box(part, wires, self.summary(part))
+
+
+def describe(point):
+    if point == STATE:
+        return STATE
+    pin, bit = point
+    return '%s[%d]' % (pin, bit)
+
+
+class Analyzer(object):
+    '''
+    Summarizes chips found by a Library, each chip once.
+    '''
+    def __init__(self, library):
+        self.library = library
+        self.summaries = {}
+
+    def summary(self, name):
+        if name not in self.summaries:
+            if self.library.definition(name) is None:
+                self.summaries[name] = self.builtin_summary(name)
+            else:
+                self.summaries[name] = self.chip_summary(name)
+        return self.summaries[name]
+
+    def builtin_summary(self, name):
+        '''
+        A box: no gates, its clocked inputs going to STATE and the rest
+        straight to every output.
+        '''
+        if name not in chips.BUILTINS:
+            raise HDLError('Chip %s not found' % name)
+        model = chips.BUILTINS[name]()
+        outputs = [(pin, bit) for pin, width in model.outputs for bit in xrange(width)]
+        depths = {}
+        for pin, width in model.inputs:
+            for bit in xrange(width):
+                if pin in model.clocked:
+                    depths[(pin, bit), STATE] = 0
+                else:
+                    for output in outputs:
+                        depths[(pin, bit), output] = 0
+        if model.clocked or not model.inputs:
+            for output in outputs:
+                depths[STATE, output] = 0
+        return Summary(name, model.inputs, model.outputs, 0, 0, {name: 1}, depths)
+
+    def chip_summary(self, name):
+        netlist = PartsFlattener(self.library, self.summary).flatten(name)
+        graph = Graph(netlist)
+        sources = [((pin, bit), {wire: 0}) for pin, width in netlist.inputs
+                   for bit, wire in enumerate(netlist.pins[pin])]
+        if graph.state_sources:
+            sources.append((STATE, graph.state_sources))
+        sinks = [((pin, bit), wire) for pin, width in netlist.outputs
+                 for bit, wire in enumerate(netlist.pins[pin])]
+        depths = {}
+        for source, starts in sources:
+            arrival, _ = graph.arrivals(starts)
+            for sink, wire in sinks:
+                if arrival.get(wire, -1) >= 0:
+                    depths[source, sink] = arrival[wire]
+            state_depth = graph.state_depth(arrival)[0]
+            if state_depth >= 0:
+                depths[source, STATE] = state_depth
+        inner_depth, _ = graph.inner_state
+        if inner_depth > depths.get((STATE, STATE), -1):
+            depths[STATE, STATE] = inner_depth
+        boxes = {}
+        for _, summary, _, _ in netlist.boxes:
+            for box, count in summary.boxes.items():
+                boxes[box] = boxes.get(box, 0) + count
+        summary = Summary(name, netlist.inputs, netlist.outputs, graph.gates, graph.dffs, boxes, depths)
+        if depths:
+            summary.path = self.longest_path(graph, summary, dict(sources), dict(sinks))
+        return summary
+
+    def longest_path(self, graph, summary, sources, sinks):
+        '''
+        Returns the longest path as its source, its sink and the parts it
+        runs through, in order.
+        '''
+        (source, sink), depth = max(summary.depths.items(), key=lambda item: item[1])
+        if (source, sink) == (STATE, STATE) and graph.inner_state[0] == depth:
+            return source, sink, [graph.inner_state[1]]
+        arrival, previous = graph.arrivals(sources[source], track=True)
+        parts = []
+        if sink == STATE:
+            wire = graph.state_depth(arrival)[1]
+            parts.append(graph.sink_parts.get(wire))
+        else:
+            wire = sinks[sink]
+        while wire in previous:
+            wire, part = previous[wire]
+            parts.append(part)
+        if source == STATE:
+            parts.append(graph.source_parts.get(wire))
+        parts.reverse()
+        return source, sink, [part for part in parts if part is not None]
+
+    def report(self, name):
+        '''
+        Returns a chip's numbers, as written in JSON.
+        '''
+        summary = self.summary(name)
+        report = {
+            'chip': name,
+            'gates': summary.gates,
+            'dffs': summary.dffs,
+            'boxes': summary.boxes,
+            'depth': summary.depth,
+            'pins': summary.pin_depths(),
+        }
+        if summary.path is not None:
+            source, sink, parts = summary.path
+            report['longest_path'] = {
+                'from': describe(source),
+                'to': describe(sink),
+                'through': parts,
+            }
+        return report
+
+
+class Graph(object):
+    '''
+    A one level netlist as wires joined by weighted edges: 1 through a
+    Nand gate, and a boxed part's depth from each of its input bits to
+    each of its output bits. DFF outputs (and boxes' paths from STATE)
+    start at state_sources, and DFF inputs (and boxes' paths to STATE)
+    end at state_sinks; source_parts and sink_parts have the part of
+    each of those that is a box's pin. Paths from STATE to STATE inside
+    a part are kept as inner_state: (depth, part).
+    '''
+    def __init__(self, netlist):
+        self.gates = len(netlist.nand_out)
+        self.dffs = len(netlist.dff_in)
+        # wire: [(wire, depth, part)]
+        self.edges = {}
+        # wire: depth from or to STATE
+        self.state_sources = dict.fromkeys(netlist.dff_out, 0)
+        self.state_sinks = dict.fromkeys(netlist.dff_in, 0)
+        self.source_parts = {}
+        self.sink_parts = {}
+        self.inner_state = -1, None
+        for gate in xrange(self.gates):
+            for wire in set([netlist.nand_a[gate], netlist.nand_b[gate]]):
+                self.edges.setdefault(wire, []).append((netlist.nand_out[gate], 1, 'Nand'))
+        for part, summary, inputs, outputs in netlist.boxes:
+            self.gates += summary.gates
+            self.dffs += summary.dffs
+            input_wires = dict(((pin, bit), wire) for pin, wires in inputs
+                               for bit, wire in enumerate(wires))
+            output_wires = dict(((pin, bit), wire) for pin, wires in outputs
+                                for bit, wire in enumerate(wires))
+            for (source, sink), depth in summary.depths.items():
+                if source == STATE and sink == STATE:
+                    self.inner_state = max(self.inner_state, (depth, part))
+                elif source == STATE:
+                    wire = output_wires[sink]
+                    self.state_sources[wire] = max(self.state_sources.get(wire, 0), depth)
+                    self.source_parts[wire] = part
+                elif sink == STATE:
+                    wire = input_wires[source]
+                    self.state_sinks[wire] = max(self.state_sinks.get(wire, 0), depth)
+                    self.sink_parts[wire] = part
+                else:
+                    self.edges.setdefault(input_wires[source], []).append(
+                        (output_wires[sink], depth, part))
+        self.order = self.topological_order(netlist.name)
+
+    def topological_order(self, name):
+        pending = {}
+        for wire, targets in self.edges.items():
+            pending.setdefault(wire, 0)
+            for target, _, _ in targets:
+                pending[target] = pending.get(target, 0) + 1
+        ready = [wire for wire, count in pending.items() if not count]
+        order = []
+        while ready:
+            wire = ready.pop()
+            order.append(wire)
+            for target, _, _ in self.edges.get(wire, ()):
+                pending[target] -= 1
+                if not pending[target]:
+                    ready.append(target)
+        if len(order) != len(pending):
+            raise HDLError('%s has a combinational loop' % name)
+        return order
+
+    def arrivals(self, starts, track=False):
+        '''
+        Returns the longest path to every wire reached from starts,
+        {wire: depth at the start}, and with track, the wire and part
+        each wire's longest path came through.
+        '''
+        arrival = dict(starts)
+        previous = {}
+        edges = self.edges
+        for wire in self.order:
+            if wire not in arrival:
+                continue
+            depth = arrival[wire]
+            for target, weight, part in edges.get(wire, ()):
+                if arrival.get(target, -1) < depth + weight:
+                    arrival[target] = depth + weight
+                    if track:
+                        previous[target] = wire, part
+        return arrival, previous
+
+    def state_depth(self, arrival):
+        '''
+        Returns the longest path into STATE, and the wire it runs
+        through, or -1 and None.
+        '''
+        longest, through = -1, None
+        for wire, depth in self.state_sinks.items():
+            if wire in arrival and arrival[wire] + depth > longest:
+                longest, through = arrival[wire] + depth, wire
+        return longest, through
+
+
+def print_report(report):
+    print '%s: %d Nand gates, %d DFFs%s, depth %d' % (
+        report['chip'], report['gates'], report['dffs'],
+        ''.join(', %d %s' % (count, box) for box, count in sorted(report['boxes'].items())),
+        report['depth'])
+    for pin, depth in sorted(report['pins'].items()):
+        print '  %-12s %6d' % (pin, depth)
+    if 'longest_path' in report:
+        path = report['longest_path']
+        print '  longest path: %s' % ' -> '.join([path['from']] + path['through'] + [path['to']])
+
+
+def main(args):
+    as_json = False
+    while args and args[0].startswith('--'):
+        if args[0] == '--json':
+            as_json = True
+        else:
+            print_usage()
+            return -1
+        args = args[1:]
+    if not args or not all(path.endswith('.hdl') for path in args):
+        print_usage()
+        return -1
+    for path in args:
+        if not os.path.exists(path):
+            print 'file not found'
+            return 1
+
+    analyzers = {}
+    reports = []
+    try:
+        for path in args:
+            directory = os.path.dirname(path) or '.'
+            if directory not in analyzers:
+                analyzers[directory] = Analyzer(hdl.Library(directory))
+            analyzer = analyzers[directory]
+            name = os.path.basename(path)[:-len('.hdl')]
+            analyzer.library.definitions[name] = analyzer.library.read(path)
+            reports.append(analyzer.report(name))
+    except HDLError as e:
+        print 'error: %s' % e
+        return 1
+    if as_json:
+        print json.dumps(reports, indent=2, sort_keys=True)
+    else:
+        for report in reports:
+            print_report(report)
+    return 0
+
+def print_usage():
+        print 'usage: analyze.py [--json] path/to/Chip.hdl ...'
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
+
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,635 @@
+#!/usr/bin/python2
+'''
+Behavioral models of the nand2tetris built-in chips.
+
+These stand in for the Java Hardware Simulator's built-in chips, so test
+scripts can run without a gate-level model. A chip is a set of pins
+(unsigned ints, masked to each pin's width) plus, for sequential chips,
+internal state:
+
+    eval()  recomputes the outputs from the inputs and the state.
+    tick()  evaluates, then clocks the state in (the clock's rising
+            edge); outputs keep their values until the next evaluation.
+    tock()  evaluates again, showing the new state (the falling edge).
+
+which is how the Java simulator's output looks between tick and tock.
+
+    >>> register = BUILTINS['Register']()
+    >>> register.set('in', -5)
+    >>> register.set('load', 1)
+    >>> register.tick()
+    >>> register.get('out'), register.get('Register[]')
+    (0, 65531)
+    >>> register.tock()
+    >>> register.get('out')
+    65531
+
+Internal state is reached the way test scripts do, as Part[index] (or
+Part[] for single registers), e.g. DRegister[] or RAM16K[7] in a CPU or
+Computer.
+'''
+
+from array import array
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, '06'))
+
+import hackemu
+
+WIDTH = 16
+MASK = (1 << WIDTH) - 1
+SCREEN = 0x4000
+KBD = 0x6000
+
+
+class ChipError(Exception):
+    pass
+
+
+def mask(width):
+    return (1 << width) - 1
+
+
+def signed(value, width):
+    '''
+    Reads a 16 bit pin value as a two's complement number, like the
+    Java simulator's %D format. Narrower pins are unsigned.
+
+    >>> signed(65535, 16), signed(32767, 15)
+    (-1, 32767)
+    '''
+    if width == WIDTH and value & 0x8000:
+        return value - (1 << WIDTH)
+    return value
+
+
+def split_reference(name):
+    '''
+    Splits an internal state reference into its part and index.
+
+    >>> split_reference('RAM16K[7]'), split_reference('DRegister[]')
+    (('RAM16K', 7), ('DRegister', None))
+    '''
+    if not name.endswith(']') or '[' not in name:
+        raise ChipError('Unknown pin: %s' % name)
+    part, index = name[:-1].split('[', 1)
+    return part, int(index) if index else None
+
+
+class Chip(object):
+    name = None
+    inputs = []
+    outputs = []
+    # inputs only read on clock(), like the HDL's CLOCKED pins
+    clocked = []
+
+    def __init__(self):
+        self.widths = dict(self.inputs + self.outputs)
+        self.pins = dict.fromkeys(self.widths, 0)
+
+    def width(self, name):
+        return self.widths.get(name, WIDTH)
+
+    def get(self, name):
+        if name in self.pins:
+            return self.pins[name]
+        part, index = split_reference(name)
+        return self.internal(part, index)
+
+    def set(self, name, value):
+        if name in self.widths:
+            self.pins[name] = value & mask(self.widths[name])
+        else:
+            part, index = split_reference(name)
+            self.set_internal(part, index, value & MASK)
+
+    def internal(self, part, index):
+        raise ChipError('%s has no part %s' % (self.name, part))
+
+    def set_internal(self, part, index, value):
+        raise ChipError('%s has no part %s' % (self.name, part))
+
+    def command(self, words, directory='.'):
+        '''
+        Handles a chip specific script command, like "ROM32K load
+        Add.hack". File names are relative to directory.
+        '''
+        raise ChipError('Unknown command: %s' % ' '.join(words))
+
+    def eval(self):
+        pass
+
+    def clock(self):
+        pass
+
+    def tick(self):
+        self.eval()
+        self.clock()
+
+    def tock(self):
+        self.eval()
+
+
+def combinational(name, inputs, outputs, function):
+    '''
+    Makes a chip class whose outputs are function(*inputs); a tuple of
+    them if there are several.
+
+    >>> Xor = combinational('Xor', [('a', 1), ('b', 1)], [('out', 1)], lambda a, b: a ^ b)
+    >>> chip = Xor()
+    >>> chip.set('a', 1)
+    >>> chip.eval()
+    >>> chip.get('out')
+    1
+    '''
+    input_names = [pin for pin, _ in inputs]
+    output_masks = [(pin, mask(width)) for pin, width in outputs]
+    single = len(outputs) == 1
+
+    def eval(self):
+        pins = self.pins
+        results = function(*[pins[pin] for pin in input_names])
+        if single:
+            results = (results,)
+        for (pin, pin_mask), value in zip(output_masks, results):
+            pins[pin] = value & pin_mask
+    return type(name, (Chip,), {'name': name, 'inputs': inputs, 'outputs': outputs,
+                                'eval': eval})
+
+
+def alu(x, y, zx, nx, zy, ny, f, no):
+    '''
+    The Hack ALU: returns out, zr and ng.
+
+    >>> alu(5, 3, 0, 1, 0, 0, 1, 1)     # x-y
+    (2, 0, 0)
+    '''
+    if zx:
+        x = 0
+    if nx:
+        x = ~x & MASK
+    if zy:
+        y = 0
+    if ny:
+        y = ~y & MASK
+    out = (x + y if f else x & y) & MASK
+    if no:
+        out = ~out & MASK
+    return out, int(out == 0), out >> 15
+
+
+def mux_way(*args):
+    # data inputs, then sel
+    return args[args[-1]]
+
+
+def dmux_way(ways):
+    def dmux(value, sel):
+        outputs = [0] * ways
+        outputs[sel] = value
+        return tuple(outputs)
+    return dmux
+
+
+LETTERS = 'abcdefgh'
+BIT = [('a', 1), ('b', 1)]
+WORD = [('a', WIDTH), ('b', WIDTH)]
+OUT = [('out', 1)]
+OUT16 = [('out', WIDTH)]
+
+COMBINATIONAL = [
+    combinational('Nand', BIT, OUT, lambda a, b: 1 - (a & b)),
+    combinational('Not', [('in', 1)], OUT, lambda x: 1 - x),
+    combinational('And', BIT, OUT, lambda a, b: a & b),
+    combinational('Or', BIT, OUT, lambda a, b: a | b),
+    combinational('Xor', BIT, OUT, lambda a, b: a ^ b),
+    combinational('Mux', BIT + [('sel', 1)], OUT, lambda a, b, sel: b if sel else a),
+    combinational('DMux', [('in', 1), ('sel', 1)], BIT, dmux_way(2)),
+    combinational('Not16', [('in', WIDTH)], OUT16, lambda x: ~x),
+    combinational('And16', WORD, OUT16, lambda a, b: a & b),
+    combinational('Or16', WORD, OUT16, lambda a, b: a | b),
+    combinational('Mux16', WORD + [('sel', 1)], OUT16, lambda a, b, sel: b if sel else a),
+    combinational('Or8Way', [('in', 8)], OUT, lambda x: int(x != 0)),
+    combinational('Mux4Way16', [(letter, WIDTH) for letter in LETTERS[:4]] + [('sel', 2)],
+                  OUT16, mux_way),
+    combinational('Mux8Way16', [(letter, WIDTH) for letter in LETTERS] + [('sel', 3)],
+                  OUT16, mux_way),
+    combinational('DMux4Way', [('in', 1), ('sel', 2)], [(letter, 1) for letter in LETTERS[:4]],
+                  dmux_way(4)),
+    combinational('DMux8Way', [('in', 1), ('sel', 3)], [(letter, 1) for letter in LETTERS],
+                  dmux_way(8)),
+    combinational('HalfAdder', BIT, [('sum', 1), ('carry', 1)],
+                  lambda a, b: (a ^ b, a & b)),
+    combinational('FullAdder', BIT + [('c', 1)], [('sum', 1), ('carry', 1)],
+                  lambda a, b, c: (a ^ b ^ c, (a + b + c) >> 1)),
+    combinational('Add16', WORD, OUT16, lambda a, b: a + b),
+    combinational('Inc16', [('in', WIDTH)], OUT16, lambda x: x + 1),
+    combinational('ALU', [('x', WIDTH), ('y', WIDTH), ('zx', 1), ('nx', 1), ('zy', 1),
+                          ('ny', 1), ('f', 1), ('no', 1)],
+                  [('out', WIDTH), ('zr', 1), ('ng', 1)], alu),
+]
+
+
+class Register(Chip):
+    '''
+    >>> bit = BUILTINS['Bit']()
+    >>> bit.set('in', 1); bit.set('load', 1)
+    >>> bit.tick()
+    >>> bit.get('out'), bit.get('Bit[]')
+    (0, 1)
+    >>> bit.tock()
+    >>> bit.get('out')
+    1
+    '''
+    name = 'Register'
+    inputs = [('in', WIDTH), ('load', 1)]
+    outputs = OUT16
+    clocked = ['in', 'load']
+
+    def __init__(self):
+        super(Register, self).__init__()
+        self.value = 0
+
+    def internal(self, part, index):
+        if part != self.name:
+            return super(Register, self).internal(part, index)
+        return self.value
+
+    def set_internal(self, part, index, value):
+        if part != self.name:
+            return super(Register, self).set_internal(part, index, value)
+        self.value = value & mask(self.widths['out'])
+
+    def eval(self):
+        self.pins['out'] = self.value
+
+    def clock(self):
+        if self.pins['load']:
+            self.value = self.pins['in']
+
+
+class ARegister(Register):
+    name = 'ARegister'
+
+
+class DRegister(Register):
+    name = 'DRegister'
+
+
+class Bit(Register):
+    name = 'Bit'
+    inputs = [('in', 1), ('load', 1)]
+    outputs = OUT
+
+
+class DFF(Register):
+    name = 'DFF'
+    inputs = [('in', 1)]
+    outputs = OUT
+    clocked = ['in']
+
+    def clock(self):
+        self.value = self.pins['in']
+
+
+class PC(Register):
+    '''
+    >>> pc = BUILTINS['PC']()
+    >>> pc.set('inc', 1)
+    >>> pc.tick(); pc.tock(); pc.tick(); pc.tock()
+    >>> pc.get('out')
+    2
+    '''
+    name = 'PC'
+    inputs = [('in', WIDTH), ('load', 1), ('inc', 1), ('reset', 1)]
+    clocked = ['in', 'load', 'inc', 'reset']
+
+    def clock(self):
+        pins = self.pins
+        if pins['reset']:
+            self.value = 0
+        elif pins['load']:
+            self.value = pins['in']
+        elif pins['inc']:
+            self.value = (self.value + 1) & MASK
+
+
+class RAM(Chip):
+    '''
+    A memory of 2**bits words; subclasses set name and bits.
+
+    >>> ram = BUILTINS['RAM8']()
+    >>> ram.set('in', 7); ram.set('load', 1); ram.set('address', 5)
+    >>> ram.tick()
+    >>> ram.get('out'), ram.get('RAM8[5]')
+    (0, 7)
+    >>> ram.set('load', 0); ram.set('address', 4); ram.tock()
+    >>> ram.get('out')
+    0
+    '''
+    bits = None
+    clocked = ['in', 'load']
+
+    def __init__(self):
+        self.inputs = [('in', WIDTH), ('load', 1), ('address', self.bits)]
+        self.outputs = OUT16
+        super(RAM, self).__init__()
+        self.memory = array('H', [0]) * (1 << self.bits)
+
+    def internal(self, part, index):
+        if part != self.name or index is None:
+            return super(RAM, self).internal(part, index)
+        return self.memory[index]
+
+    def set_internal(self, part, index, value):
+        if part != self.name or index is None:
+            return super(RAM, self).set_internal(part, index, value)
+        self.memory[index] = value
+
+    def eval(self):
+        self.pins['out'] = self.memory[self.pins['address']]
+
+    def clock(self):
+        if self.pins['load']:
+            self.memory[self.pins['address']] = self.pins['in']
+
+
+def ram(name, bits):
+    return type(name, (RAM,), {'name': name, 'bits': bits})
+
+
+class Screen(RAM):
+    name = 'Screen'
+    bits = 13
+
+
+class ROM32K(Chip):
+    name = 'ROM32K'
+    inputs = [('address', 15)]
+    outputs = OUT16
+
+    def __init__(self):
+        super(ROM32K, self).__init__()
+        self.memory = array('H', [0]) * (1 << 15)
+
+    def internal(self, part, index):
+        if part != self.name or index is None:
+            return super(ROM32K, self).internal(part, index)
+        return self.memory[index]
+
+    def set_internal(self, part, index, value):
+        if part != self.name or index is None:
+            return super(ROM32K, self).set_internal(part, index, value)
+        self.memory[index] = value
+
+    def load(self, path):
+        words = read_program(path)
+        self.memory = array('H', [0]) * (1 << 15)
+        self.memory[:len(words)] = array('H', words)
+
+    def command(self, words, directory='.'):
+        if len(words) == 3 and words[:2] == [self.name, 'load']:
+            self.load(os.path.join(directory, words[2]))
+        else:
+            super(ROM32K, self).command(words, directory)
+
+    def eval(self):
+        self.pins['out'] = self.memory[self.pins['address']]
+
+
+class Keyboard(Chip):
+    '''
+    A keyboard nobody types on, unless a script sets Keyboard[].
+    '''
+    name = 'Keyboard'
+    outputs = OUT16
+
+    def __init__(self):
+        super(Keyboard, self).__init__()
+        self.key = 0
+
+    def internal(self, part, index):
+        if part != self.name:
+            return super(Keyboard, self).internal(part, index)
+        return self.key
+
+    def set_internal(self, part, index, value):
+        if part != self.name:
+            return super(Keyboard, self).set_internal(part, index, value)
+        self.key = value
+
+    def eval(self):
+        self.pins['out'] = self.key
+
+
+class Memory(Chip):
+    '''
+    RAM16K, then Screen, then Keyboard, in a 15 bit address space.
+
+    >>> memory = BUILTINS['Memory']()
+    >>> memory.set('in', 3); memory.set('load', 1); memory.set('address', 0x4001)
+    >>> memory.tick(); memory.tock()
+    >>> memory.get('out'), memory.get('Screen[1]'), memory.get('RAM16K[1]')
+    (3, 3, 0)
+    '''
+    name = 'Memory'
+    inputs = [('in', WIDTH), ('load', 1), ('address', 15)]
+    outputs = OUT16
+    clocked = ['in', 'load']
+
+    def __init__(self):
+        super(Memory, self).__init__()
+        self.ram = BUILTINS['RAM16K']()
+        self.screen = Screen()
+        self.keyboard = Keyboard()
+        self.parts = dict((part.name, part) for part in [self.ram, self.screen, self.keyboard])
+
+    def internal(self, part, index):
+        if part not in self.parts:
+            return super(Memory, self).internal(part, index)
+        return self.parts[part].internal(part, index)
+
+    def set_internal(self, part, index, value):
+        if part not in self.parts:
+            return super(Memory, self).set_internal(part, index, value)
+        self.parts[part].set_internal(part, index, value)
+
+    def read(self, address):
+        if address < SCREEN:
+            return self.ram.memory[address]
+        if address < KBD:
+            return self.screen.memory[address - SCREEN]
+        if address == KBD:
+            return self.keyboard.key
+        return 0
+
+    def eval(self):
+        self.pins['out'] = self.read(self.pins['address'])
+
+    def clock(self):
+        pins = self.pins
+        address = pins['address']
+        if not pins['load']:
+            return
+        if address < SCREEN:
+            self.ram.memory[address] = pins['in']
+        elif address < KBD:
+            self.screen.memory[address - SCREEN] = pins['in']
+
+
+class CPU(Chip):
+    '''
+    The Hack CPU, with its ARegister, DRegister and PC as internal
+    state.
+
+    >>> cpu = BUILTINS['CPU']()
+    >>> cpu.set('instruction', 12345)       # @12345
+    >>> cpu.tick(); cpu.tock()
+    >>> cpu.set('instruction', 0b1110110000010000)     # D=A
+    >>> cpu.tick(); cpu.tock()
+    >>> cpu.get('DRegister[]'), cpu.get('addressM'), cpu.get('pc')
+    (12345, 12345, 2)
+    '''
+    name = 'CPU'
+    inputs = [('inM', WIDTH), ('instruction', WIDTH), ('reset', 1)]
+    outputs = [('outM', WIDTH), ('writeM', 1), ('addressM', 15), ('pc', 15)]
+    clocked = ['reset']
+
+    def __init__(self):
+        super(CPU, self).__init__()
+        self.registers = {'ARegister': 0, 'DRegister': 0, 'PC': 0}
+
+    def internal(self, part, index):
+        if part not in self.registers:
+            return super(CPU, self).internal(part, index)
+        return self.registers[part]
+
+    def set_internal(self, part, index, value):
+        if part not in self.registers:
+            return super(CPU, self).set_internal(part, index, value)
+        self.registers[part] = value
+
+    def compute(self):
+        '''
+        Returns the ALU's out, zr and ng for the current instruction.
+        '''
+        instruction = self.pins['instruction']
+        y = self.pins['inM'] if instruction & 0x1000 else self.registers['ARegister']
+        bits = [(instruction >> shift) & 1 for shift in xrange(11, 5, -1)]
+        return alu(self.registers['DRegister'], y, *bits)
+
+    def eval(self):
+        pins = self.pins
+        instruction = pins['instruction']
+        # outM is only meaningful with writeM, but is the ALU's out for
+        # every instruction, as the CPU's HDL drives it
+        pins['outM'] = self.compute()[0]
+        pins['writeM'] = (instruction >> 3) & 1 if instruction & 0x8000 else 0
+        pins['addressM'] = self.registers['ARegister'] & 0x7FFF
+        pins['pc'] = self.registers['PC'] & 0x7FFF
+
+    def clock(self):
+        pins = self.pins
+        registers = self.registers
+        instruction = pins['instruction']
+        jump = False
+        a = registers['ARegister']
+        if instruction & 0x8000:
+            out, zr, ng = self.compute()
+            jump = bool(instruction & (4 if ng else 2 if zr else 1))
+            if instruction & 0x20:
+                registers['ARegister'] = out
+            if instruction & 0x10:
+                registers['DRegister'] = out
+        else:
+            registers['ARegister'] = instruction
+        if pins['reset']:
+            registers['PC'] = 0
+        elif jump:
+            registers['PC'] = a
+        else:
+            registers['PC'] = (registers['PC'] + 1) & MASK
+
+
+class Computer(Chip):
+    '''
+    A CPU running a ROM32K program against a Memory.
+
+    >>> computer = BUILTINS['Computer']()
+    >>> computer.rom.memory[:4] = array('H', [2, 0b1110110000010000, 0, 0b1110001100001000])
+    >>> for _ in xrange(4): computer.tick(); computer.tock()
+    >>> computer.get('RAM16K[0]'), computer.get('PC[]')
+    (2, 4)
+    '''
+    name = 'Computer'
+    inputs = [('reset', 1)]
+    clocked = ['reset']
+
+    def __init__(self):
+        super(Computer, self).__init__()
+        self.cpu = CPU()
+        self.rom = ROM32K()
+        self.memory = Memory()
+
+    def internal(self, part, index):
+        for chip in [self.cpu, self.memory]:
+            try:
+                return chip.internal(part, index)
+            except ChipError:
+                pass
+        if part == self.rom.name:
+            return self.rom.internal(part, index)
+        return super(Computer, self).internal(part, index)
+
+    def set_internal(self, part, index, value):
+        for chip in [self.cpu, self.memory, self.rom]:
+            try:
+                return chip.set_internal(part, index, value)
+            except ChipError:
+                pass
+        return super(Computer, self).set_internal(part, index, value)
+
+    def command(self, words, directory='.'):
+        self.rom.command(words, directory)
+
+    def eval(self):
+        cpu = self.cpu
+        cpu.pins['reset'] = self.pins['reset']
+        cpu.pins['instruction'] = self.rom.memory[cpu.registers['PC'] & 0x7FFF]
+        # addressM only depends on the A register, so evaluate twice
+        cpu.eval()
+        cpu.pins['inM'] = self.memory.read(cpu.pins['addressM'])
+        cpu.eval()
+        memory = self.memory
+        memory.pins['in'] = cpu.pins['outM']
+        memory.pins['load'] = cpu.pins['writeM']
+        memory.pins['address'] = cpu.pins['addressM']
+        memory.eval()
+
+    def clock(self):
+        self.memory.clock()
+        self.cpu.clock()
+
+
+def read_program(path):
+    '''
+    Reads machine words from a .hack file, or assembles the .asm file
+    next to it if there is no .hack (or only a dangling link to one).
+    '''
+    if not os.path.exists(path) and path.endswith('.hack'):
+        path = os.path.realpath(path)[:-len('.hack')] + '.asm'
+    if not os.path.exists(path):
+        raise ChipError('file not found: %s' % path)
+    return hackemu.load(path)
+
+
+SEQUENTIAL = [Register, ARegister, DRegister, Bit, DFF, PC, Screen, ROM32K, Keyboard,
+              Memory, CPU, Computer] + [ram('RAM%s' % suffix, bits) for suffix, bits in
+                                        [('8', 3), ('64', 6), ('512', 9), ('4K', 12), ('16K', 14)]]
+BUILTINS = dict((chip.name, chip) for chip in COMBINATIONAL + SEQUENTIAL)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
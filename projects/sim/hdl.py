@@ -0,0 +1,1428 @@
+#!/usr/bin/python2
+'''
+A gate-level simulator for nand2tetris HDL chips.
+
+A chip is parsed from its .hdl file and flattened into a netlist of
+Nand gates and DFFs, wired by number. Parts are looked up in the chip's
+own directory, then in the chapter directories (LIBRARY), so a CPU is
+built from this project's own ALU, PC and so on. Chips with no HDL
+anywhere (ROM32K, Screen, Keyboard, and RAM16K before
+make_multi_chips.py has run) are kept whole as "boxes": the behavioral
+models from chips.py, wired into the netlist.
+
+The combinational logic is levelized once, by topological sort from
+the inputs, the DFF outputs and the constants, and the evaluation order
+is compiled into straight-line Python (w[9] = 1 ^ (w[4] & w[7]), in
+functions of EVALUATION_CHUNK statements), so each evaluation is a flat
+run over the wires with no recursion or lookups.
+
+    >>> simulator = Simulator(flatten_text(\'\'\'
+    ... CHIP Xor {
+    ...     IN a, b;
+    ...     OUT out;
+    ...     PARTS:
+    ...     Nand(a=a, b=b, out=nab);
+    ...     Nand(a=a, b=nab, out=x);
+    ...     Nand(a=nab, b=b, out=y);
+    ...     Nand(a=x, b=y, out=out);
+    ... }\'\'\'))
+    >>> results = []
+    >>> for a, b in [(0, 0), (0, 1), (1, 0), (1, 1)]:
+    ...     simulator.set('a', a); simulator.set('b', b); simulator.eval()
+    ...     results.append(simulator.get('out'))
+    >>> results
+    [0, 1, 1, 0]
+
+Simulators look like chips.py's chips (pins, eval, tick and tock), so
+tst.py can run test scripts against them.
+
+ParallelSimulator runs many input vectors through one pass, one per
+bit of each wire's int: 64 lanes evaluate the ALU about 30 times as
+many vectors per second as one. --verify uses it to check a chip
+against its built-in model, on every input combination when there are
+at most EXHAUSTIVE_BITS input bits.
+
+EventSimulator evaluates only the gates whose inputs changed, which
+pays off when a tick changes little of a large chip. Flattened with
+memories, RAMs built from Registers (RAM8 up to RAM16K) are recognized
+by their structure and kept whole as arrays, so a whole Computer can be
+simulated at gate level. Going further, the parts listed in FAST_CHIPS
+(the ALU, PC, Registers, RAMs and 16 bit gates) can be swapped for
+their chips.py models. --verify-builtins checks each of those models
+against its chip's HDL, so the swap is only trusted where it holds.
+
+Netlists can be saved in a compact binary form (write_netlist()), as
+make_multi_chips.py --netlist does for the chips it generates; flatten()
+loads one instead of expanding the HDL while its sources are unchanged
+and none of its boxed chips has gained HDL.
+'''
+
+from array import array
+from collections import deque
+import json
+import os
+import random
+import re
+import string
+import struct
+import sys
+import time
+import zlib
+
+import chips
+from chips import ChipError
+
+PROJECTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+LIBRARY = [os.path.join(PROJECTS, *chapter.split('/'))
+           for chapter in ['01', '02', '03/a', '03/b', '05']]
+# built-in chips with no HDL of their own, and the chip they behave as
+ALIASES = {'ARegister': 'Register', 'DRegister': 'Register'}
+PRIMITIVES = {
+    'Nand': ([('a', 1), ('b', 1)], [('out', 1)]),
+    'DFF': ([('in', 1)], [('out', 1)]),
+}
+# chips whose behavioral models from chips.py simulations may swap in
+# for their HDL, as checked by --verify-builtins. Nand is primitive
+# already, and other 1 bit gates are cheaper as gates than as boxes.
+FAST_CHIPS = ['Not16', 'And16', 'Or16', 'Mux16', 'Mux4Way16', 'Mux8Way16', 'Add16',
+              'Inc16', 'ALU', 'Register', 'ARegister', 'DRegister', 'PC', 'RAM8',
+              'RAM64', 'RAM512', 'RAM4K', 'RAM16K']
+# the 1 word memories that memories are built from
+REGISTERS = ['Register', 'ARegister', 'DRegister']
+# the parts that select a memory's block, with their number of ways
+MEMORY_SELECTORS = [('dmux', re.compile(r'DMux(?:(\d+)Way)?$')),
+                    ('mux', re.compile(r'Mux(?:(\d+)Way)?16$'))]
+FALSE, TRUE = 0, 1
+CONSTANTS = {'false': FALSE, 'true': TRUE}
+EVALUATION_CHUNK = 2000
+# test vectors evaluated per pass in ParallelSimulator
+LANES = 64
+# chips with at most this many input bits are verified exhaustively
+EXHAUSTIVE_BITS = 16
+RANDOM_VECTORS = 10000
+# path_depths()'s name for the DFFs, as a source and as a sink
+STATE = 'DFF'
+# pre-flattened netlists, written next to the .hdl by make_multi_chips.py
+NETLIST_EXTENSION = '.hnl'
+NETLIST_MAGIC = 'HNL1'
+NETLIST_ARRAYS = ['nand_a', 'nand_b', 'nand_out', 'dff_in', 'dff_out']
+COMMENT = re.compile(r'//[^\n]*|/\*.*?\*/', re.S)
+TOKEN = re.compile(r'[A-Za-z_]\w*|\d+|\.\.|\S')
+
+
+class HDLError(Exception):
+    pass
+
+
+class ChipDefinition(object):
+    '''
+    A parsed chip: its pins as (name, width) lists, and its parts as
+    (chip name, connections), where each connection is (pin, pin range,
+    signal, signal range) and a range is (first, last) or None.
+    '''
+    def __init__(self, name, inputs, outputs, parts, builtin=False):
+        self.name = name
+        self.inputs = inputs
+        self.outputs = outputs
+        self.parts = parts
+        self.builtin = builtin
+
+
+class Parser(object):
+    def __init__(self, text):
+        self.tokens = TOKEN.findall(COMMENT.sub(' ', text))
+        self.position = 0
+
+    def peek(self):
+        if self.position >= len(self.tokens):
+            raise HDLError('Unexpected end of file')
+        return self.tokens[self.position]
+
+    def next(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def expect(self, expected):
+        token = self.next()
+        if token != expected:
+            raise HDLError('Expected %s, found %s' % (expected, token))
+
+    def number(self):
+        token = self.next()
+        if not token.isdigit():
+            raise HDLError('Expected a number, found %s' % token)
+        return int(token)
+
+    def name(self):
+        token = self.next()
+        if not (token[0].isalpha() or token[0] == '_'):
+            raise HDLError('Expected a name, found %s' % token)
+        return token
+
+    def chip(self):
+        self.expect('CHIP')
+        name = self.name()
+        self.expect('{')
+        inputs, outputs, parts = [], [], []
+        builtin = False
+        while True:
+            token = self.next()
+            if token == 'IN':
+                inputs += self.pins()
+            elif token == 'OUT':
+                outputs += self.pins()
+            elif token == 'PARTS':
+                self.expect(':')
+                while self.peek() != '}':
+                    parts.append(self.part())
+            elif token == 'BUILTIN':
+                self.name()
+                self.expect(';')
+                builtin = True
+            elif token == 'CLOCKED':
+                self.pins()
+            elif token == '}':
+                break
+            else:
+                raise HDLError('Unexpected %s in %s' % (token, name))
+        return ChipDefinition(name, inputs, outputs, parts, builtin)
+
+    def pins(self):
+        pins = []
+        while True:
+            name = self.name()
+            width = 1
+            if self.peek() == '[':
+                self.next()
+                width = self.number()
+                self.expect(']')
+            pins.append((name, width))
+            if self.next() == ';':
+                return pins
+
+    def reference(self):
+        '''
+        Parses name, name[i] or name[i..j] into the name and (i, j).
+        '''
+        name = self.name()
+        if self.peek() != '[':
+            return name, None
+        self.next()
+        first = last = self.number()
+        if self.peek() == '..':
+            self.next()
+            last = self.number()
+        self.expect(']')
+        return name, (first, last)
+
+    def part(self):
+        chip = self.name()
+        self.expect('(')
+        connections = []
+        while True:
+            pin, pin_range = self.reference()
+            self.expect('=')
+            signal, signal_range = self.reference()
+            connections.append((pin, pin_range, signal, signal_range))
+            if self.next() == ')':
+                break
+        self.expect(';')
+        return chip, connections
+
+
+def parse_hdl(text):
+    '''
+    >>> chip = parse_hdl('CHIP Not { IN in; OUT out; PARTS: Nand(a=in, b=in[0], out=out); }')
+    >>> chip.name, chip.inputs, chip.parts
+    ('Not', [('in', 1)], [('Nand', [('a', None, 'in', None), ('b', None, 'in', (0, 0)), ('out', None, 'out', None)])])
+    '''
+    return Parser(text).chip()
+
+
+def address_slice(signal_range, width):
+    '''
+    Returns the bits a sub-bus covers, as (first, last + 1).
+    '''
+    if signal_range is None:
+        return 0, width
+    first, last = signal_range
+    return first, last + 1
+
+
+class Library(object):
+    '''
+    Finds chip definitions by name: in directory, then the LIBRARY
+    directories. Parses each file once, and keeps the modification time
+    of each file it parsed in sources, by absolute path.
+    '''
+    def __init__(self, directory='.', definitions=None):
+        self.path = [directory] + LIBRARY
+        self.definitions = dict(definitions or {})
+        self.memories = {}
+        self.sources = {}
+
+    def definition(self, name):
+        '''
+        Returns the chip's definition, or None if it has no HDL.
+        '''
+        if name not in self.definitions:
+            definition = None
+            for directory in self.path:
+                path = os.path.join(directory, name + '.hdl')
+                if os.path.exists(path):
+                    definition = self.read(path)
+                    break
+            if definition is None and name in ALIASES:
+                definition = self.definition(ALIASES[name])
+            if definition is not None and definition.builtin:
+                definition = None
+            self.definitions[name] = definition
+        return self.definitions[name]
+
+    def read(self, path):
+        self.sources[os.path.abspath(path)] = os.path.getmtime(path)
+        with open(path, 'rb') as hdlfile:
+            try:
+                return parse_hdl(hdlfile.read())
+            except HDLError as e:
+                raise HDLError('%s: %s' % (path, e))
+
+    def memory_bits(self, name):
+        '''
+        Returns k if the chip is a memory of 2**k Registers, else None.
+        A memory is in[16], load and address[k] in, out[16] out, built
+        from one DMux selecting which block loads, n blocks that are
+        themselves memories (or Registers, the 1 word memory), and one
+        Mux selecting which block's out is shown: the same address bits
+        selecting the block in both, and the rest addressing the word
+        inside it. Such a chip behaves as an array of words indexed by
+        address, whichever address bits select the block.
+        '''
+        if name not in self.memories:
+            # nothing built from itself is a memory
+            self.memories[name] = None
+            self.memories[name] = self.find_memory_bits(name)
+        return self.memories[name]
+
+    def find_memory_bits(self, name):
+        if name in REGISTERS:
+            return 0
+        definition = self.definition(name)
+        if definition is None or definition.outputs != [('out', chips.WIDTH)]:
+            return None
+        widths = dict(definition.inputs)
+        if sorted(widths) != ['address', 'in', 'load'] or widths['in'] != chips.WIDTH or \
+                widths['load'] != 1:
+            return None
+        bits = widths['address']
+        selectors = {}
+        blocks = []
+        for part, connections in definition.parts:
+            pins = {}
+            for pin, pin_range, signal, signal_range in connections:
+                if pin_range is not None or pin in pins:
+                    return None
+                pins[pin] = signal, signal_range
+            for kind, pattern in MEMORY_SELECTORS:
+                match = pattern.match(part)
+                if match:
+                    if kind in selectors:
+                        return None
+                    selectors[kind] = int(match.group(1) or 2), pins
+                    break
+            else:
+                blocks.append((part, pins))
+        if sorted(selectors) != ['dmux', 'mux']:
+            return None
+        (ways, dmux), (mux_ways, mux) = selectors['dmux'], selectors['mux']
+        if ways != mux_ways or ways != len(blocks) or ways & (ways - 1) or ways < 2:
+            return None
+        select_bits = ways.bit_length() - 1
+        select = dmux.get('sel')
+        if dmux.get('in') != ('load', None) or mux.get('out') != ('out', None) or \
+                select is None or select[0] != 'address' or mux.get('sel') != select:
+            return None
+        selected = set(xrange(*address_slice(select[1], bits)))
+        if len(selected) != select_bits:
+            return None
+        # each way's load and out must belong to the same block
+        loads = {}
+        outs = {}
+        for part, pins in blocks:
+            if pins.get('load') in loads or pins.get('out') in outs:
+                return None
+            block_bits = self.memory_bits(part)
+            if block_bits != bits - select_bits or pins.get('in') != ('in', None) or \
+                    'load' not in pins or 'out' not in pins:
+                return None
+            if block_bits:
+                address = pins.get('address')
+                if address is None or address[0] != 'address':
+                    return None
+                addressed = set(xrange(*address_slice(address[1], bits)))
+                if len(addressed) != block_bits or addressed & selected:
+                    return None
+            elif len(pins) != 3:
+                return None
+            loads[pins['load']] = outs[pins['out']] = len(loads)
+        way_blocks = [(loads.get(dmux.get(letter)), outs.get(mux.get(letter)))
+                      for letter in string.ascii_letters[:ways]]
+        if len(loads) != ways or len(outs) != ways or \
+                set(way_blocks) != set((block, block) for block in xrange(ways)):
+            return None
+        return bits
+
+    def interface(self, name):
+        '''
+        Returns a chip's (inputs, outputs).
+        '''
+        if name in PRIMITIVES:
+            return PRIMITIVES[name]
+        definition = self.definition(name)
+        if definition is not None:
+            return definition.inputs, definition.outputs
+        if name in chips.BUILTINS:
+            model = chips.BUILTINS[name]()
+            return model.inputs, model.outputs
+        raise HDLError('Chip %s not found' % name)
+
+
+class Netlist(object):
+    '''
+    A flattened chip. Wires are numbered from 2; wire 0 is false and
+    wire 1 is true.
+
+    nand_a, nand_b, nand_out  the Nand gates' wires
+    dff_in, dff_out           the DFFs' wires
+    boxes                     (name, model, input pins, output pins) for
+                              chips simulated behaviorally, where pins
+                              are (pin, wires) lists
+    pins                      the chip's own pins, {pin: wires}
+    parts                     the first part of each chip name, for
+                              internal state: (first DFF, last DFF + 1)
+                              or a box index
+    '''
+    def __init__(self, name, inputs, outputs):
+        self.name = name
+        self.inputs = inputs
+        self.outputs = outputs
+        self.wires = 2
+        self.nand_a = array('i')
+        self.nand_b = array('i')
+        self.nand_out = array('i')
+        self.dff_in = array('i')
+        self.dff_out = array('i')
+        self.boxes = []
+        self.pins = {}
+        self.parts = {}
+
+    def new_wires(self, count):
+        first = self.wires
+        self.wires += count
+        return range(first, first + count)
+
+
+class Flattener(object):
+    '''
+    Expands a chip's parts recursively down to Nand, DFF and boxes.
+    With memories, parts that are memories (Library.memory_bits()) are
+    boxed as arrays of words instead of expanded into their Registers.
+    Parts named in builtins are boxed as their chips.py models.
+    '''
+    def __init__(self, library, memories=False, builtins=()):
+        self.library = library
+        self.memories = memories
+        self.builtins = set(builtins)
+        self.netlist = None
+        # wires found to be the same signal: wire -> the wire it joins
+        self.aliases = {}
+
+    def flatten(self, name):
+        inputs, outputs = self.library.interface(name)
+        netlist = self.netlist = Netlist(name, inputs, outputs)
+        for pin, width in inputs + outputs:
+            netlist.pins[pin] = netlist.new_wires(width)
+        self.expand(name, netlist.pins)
+        if self.aliases:
+            self.resolve_aliases()
+        return netlist
+
+    def alias(self, wire, target):
+        wire = self.find(wire)
+        target = self.find(target)
+        if wire != target:
+            self.aliases[wire] = target
+
+    def find(self, wire):
+        aliases = self.aliases
+        while wire in aliases:
+            wire = aliases[wire]
+        return wire
+
+    def resolve_aliases(self):
+        netlist = self.netlist
+        find = self.find
+        for wires in [netlist.nand_a, netlist.nand_b, netlist.nand_out,
+                      netlist.dff_in, netlist.dff_out]:
+            for i in xrange(len(wires)):
+                wires[i] = find(wires[i])
+        for pin, wires in netlist.pins.items():
+            netlist.pins[pin] = [find(wire) for wire in wires]
+        for _, _, inputs, outputs in netlist.boxes:
+            for pins in [inputs, outputs]:
+                for i, (pin, wires) in enumerate(pins):
+                    pins[i] = pin, [find(wire) for wire in wires]
+
+    def expand(self, name, pins):
+        '''
+        Adds a chip to the netlist, given the wires of all its pins.
+        '''
+        netlist = self.netlist
+        if name == 'Nand':
+            netlist.nand_a.append(pins['a'][0])
+            netlist.nand_b.append(pins['b'][0])
+            netlist.nand_out.append(pins['out'][0])
+            return
+        if name == 'DFF':
+            netlist.dff_in.append(pins['in'][0])
+            netlist.dff_out.append(pins['out'][0])
+            return
+        definition = self.library.definition(name)
+        if definition is None:
+            self.box(name, pins)
+            return
+        self.expand_parts(definition, pins)
+
+    def box(self, name, pins, model=None):
+        if model is None:
+            if name not in chips.BUILTINS:
+                raise HDLError('Chip %s not found' % name)
+            model = chips.BUILTINS[name]()
+        netlist = self.netlist
+        netlist.boxes.append((name, model,
+                              [(pin, pins[pin]) for pin, _ in model.inputs],
+                              [(pin, pins[pin]) for pin, _ in model.outputs]))
+
+    def expand_parts(self, definition, pins):
+        netlist = self.netlist
+        library = self.library
+        internal = {}
+        input_names = set(pin for pin, _ in definition.inputs)
+
+        def signal_wires(signal, signal_range, what):
+            if signal in pins:
+                wires = pins[signal]
+            elif signal in internal:
+                wires = internal[signal]
+            else:
+                raise HDLError('%s: %s %s is never assigned' % (definition.name, what, signal))
+            if signal_range is not None:
+                first, last = signal_range
+                if last >= len(wires) or first > last:
+                    raise HDLError('%s: bad sub-bus %s[%d..%d]' % (definition.name, signal, first, last))
+                wires = wires[first:last + 1]
+            return wires
+
+        def pin_slice(pin, pin_range, width):
+            if pin_range is None:
+                return 0, width
+            first, last = pin_range
+            if last >= width or first > last:
+                raise HDLError('%s: bad sub-bus %s[%d..%d]' % (definition.name, pin, first, last))
+            return first, last + 1
+
+        # outputs first, so internal signals exist before parts read them
+        part_pins = []
+        for part, connections in definition.parts:
+            inputs, outputs = library.interface(part)
+            output_widths = dict(outputs)
+            wires = {}
+            for pin, pin_range, signal, signal_range in connections:
+                if pin not in output_widths:
+                    continue
+                first, end = pin_slice(pin, pin_range, output_widths[pin])
+                if signal in CONSTANTS or signal in input_names:
+                    raise HDLError('%s: can\'t assign %s' % (definition.name, signal))
+                if signal not in pins and signal not in internal:
+                    if signal_range is not None:
+                        raise HDLError('%s: sub-bus of internal pin %s' % (definition.name, signal))
+                    internal[signal] = netlist.new_wires(end - first)
+                targets = signal_wires(signal, signal_range, 'output')
+                if len(targets) != end - first:
+                    raise HDLError('%s: width mismatch in %s=%s' % (definition.name, pin, signal))
+                bits = wires.setdefault(pin, [None] * output_widths[pin])
+                for i, target in zip(xrange(first, end), targets):
+                    if bits[i] is None:
+                        bits[i] = target
+                    else:
+                        self.alias(target, bits[i])
+            for pin, width in outputs:
+                bits = wires.setdefault(pin, [None] * width)
+                for i in xrange(width):
+                    if bits[i] is None:
+                        # not connected to anything
+                        bits[i] = netlist.new_wires(1)[0]
+            part_pins.append((part, connections, inputs, wires))
+
+        for part, connections, inputs, wires in part_pins:
+            input_widths = dict(inputs)
+            for pin, width in inputs:
+                wires[pin] = [FALSE] * width
+            for pin, pin_range, signal, signal_range in connections:
+                if pin not in input_widths:
+                    if pin not in wires:
+                        raise HDLError('%s: %s has no pin %s' % (definition.name, part, pin))
+                    continue
+                first, end = pin_slice(pin, pin_range, input_widths[pin])
+                if signal in CONSTANTS:
+                    sources = [CONSTANTS[signal]] * (end - first)
+                else:
+                    sources = signal_wires(signal, signal_range, 'input')
+                    if len(sources) != end - first:
+                        raise HDLError('%s: width mismatch in %s=%s' % (definition.name, pin, signal))
+                wires[pin][first:end] = sources
+            self.expand_part(part, wires)
+
+    def expand_part(self, part, wires):
+        netlist = self.netlist
+        if part in netlist.parts:
+            self.expand_or_box(part, wires)
+            return
+        boxes = len(netlist.boxes)
+        dffs = len(netlist.dff_in)
+        self.expand_or_box(part, wires)
+        if len(netlist.boxes) > boxes and netlist.boxes[boxes][0] == part and \
+                part not in PRIMITIVES and len(netlist.dff_in) == dffs:
+            netlist.parts[part] = boxes
+        elif len(netlist.dff_in) > dffs:
+            netlist.parts[part] = dffs, len(netlist.dff_in)
+
+    def expand_or_box(self, part, wires):
+        bits = self.memories and self.library.memory_bits(part)
+        if part in self.builtins:
+            self.box(part, wires)
+        elif bits:
+            self.box(part, wires, chips.ram(part, bits)())
+        else:
+            self.expand(part, wires)
+
+
+def flatten(path, library=None, memories=False, builtins=()):
+    '''
+    Flattens the chip in an .hdl file, with its memory parts as arrays
+    if memories, and the parts named in builtins as behavioral models.
+    A plain flattening with no library given is read from the chip's
+    pre-flattened netlist instead, if it has an up to date one.
+    '''
+    if library is None and not memories and not builtins:
+        netlist = load_netlist(path)
+        if netlist is not None:
+            return netlist
+    name = os.path.basename(path)[:-len('.hdl')]
+    if library is None:
+        library = Library(os.path.dirname(path) or '.')
+    library.definitions[name] = library.read(path)
+    return Flattener(library, memories, builtins).flatten(name)
+
+
+def flatten_text(text, directory='.', memories=False, builtins=()):
+    definition = parse_hdl(text)
+    library = Library(directory, {definition.name: definition})
+    return Flattener(library, memories, builtins).flatten(definition.name)
+
+
+def write_netlist(netlist, path, sources):
+    '''
+    Writes a netlist in a compact binary form: NETLIST_MAGIC, the length
+    of a JSON header, the header (names, pins, parts, boxes and the
+    sources it was flattened from, as Library.sources), then the wire
+    arrays as zlib compressed little endian 32 bit ints. Box models are
+    found again by name, so only chips.BUILTINS boxes can be written.
+    '''
+    header = {
+        'name': netlist.name,
+        'inputs': netlist.inputs,
+        'outputs': netlist.outputs,
+        'wires': netlist.wires,
+        'pins': netlist.pins,
+        'parts': netlist.parts,
+        'boxes': [(name, inputs, outputs) for name, _, inputs, outputs in netlist.boxes],
+        'sources': sources,
+        'lengths': [len(getattr(netlist, name)) for name in NETLIST_ARRAYS],
+    }
+    for name, _, _, _ in netlist.boxes:
+        if name not in chips.BUILTINS:
+            raise HDLError('Can\'t write a netlist with a %s box' % name)
+    wires = array('i')
+    for name in NETLIST_ARRAYS:
+        wires.extend(getattr(netlist, name))
+    if sys.byteorder != 'little':
+        wires.byteswap()
+    encoded = json.dumps(header, separators=(',', ':'))
+    with open(path, 'wb') as netfile:
+        netfile.write(NETLIST_MAGIC + struct.pack('<I', len(encoded)) + encoded)
+        netfile.write(zlib.compress(wires.tostring()))
+
+
+def read_netlist(path):
+    '''
+    Reads a netlist written by write_netlist(). Returns it and the
+    sources it was flattened from.
+
+    >>> import tempfile
+    >>> netlist = flatten_text(\'\'\'
+    ... CHIP Bit { IN in, load; OUT out;
+    ...     PARTS: Mux(a=out1, b=in, sel=load, out=d); DFF(in=d, out=out, out=out1); }\'\'\')
+    >>> path = tempfile.mktemp(NETLIST_EXTENSION)
+    >>> write_netlist(netlist, path, {})
+    >>> copy, sources = read_netlist(path)
+    >>> os.remove(path)
+    >>> copy.inputs, copy.pins == netlist.pins, copy.nand_out == netlist.nand_out, copy.parts
+    ([('in', 1), ('load', 1)], True, True, {'DFF': (0, 1)})
+    '''
+    with open(path, 'rb') as netfile:
+        data = netfile.read()
+    if not data.startswith(NETLIST_MAGIC):
+        raise HDLError('%s is not a netlist' % path)
+    start = len(NETLIST_MAGIC) + 4
+    length, = struct.unpack('<I', data[len(NETLIST_MAGIC):start])
+    header = json.loads(data[start:start + length])
+    wires = array('i')
+    wires.fromstring(zlib.decompress(data[start + length:]))
+    if sys.byteorder != 'little':
+        wires.byteswap()
+
+    def pins(items):
+        return [(str(pin), value) for pin, value in items]
+    netlist = Netlist(str(header['name']), pins(header['inputs']), pins(header['outputs']))
+    netlist.wires = header['wires']
+    netlist.pins = dict(pins(header['pins'].items()))
+    netlist.parts = dict((str(part), tuple(location) if isinstance(location, list) else location)
+                         for part, location in header['parts'].items())
+    netlist.boxes = [(str(name), chips.BUILTINS[name](), pins(inputs), pins(outputs))
+                     for name, inputs, outputs in header['boxes']]
+    position = 0
+    for name, length in zip(NETLIST_ARRAYS, header['lengths']):
+        setattr(netlist, name, wires[position:position + length])
+        position += length
+    return netlist, header['sources']
+
+
+def load_netlist(path):
+    '''
+    Returns the pre-flattened netlist of an .hdl file, or None if there
+    is none, any file it was flattened from has changed since, or a
+    chip boxed as its model for lack of HDL now has HDL.
+
+    >>> import shutil, tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> path = os.path.join(directory, 'Top.hdl')
+    >>> open(path, 'wb').write('CHIP Top { OUT out[16]; PARTS: Keyboard(out=out); }')
+    >>> library = Library(directory)
+    >>> write_netlist(flatten(path, library), path[:-len('.hdl')] + NETLIST_EXTENSION, library.sources)
+    >>> len(load_netlist(path).boxes)
+    1
+    >>> open(os.path.join(directory, 'Keyboard.hdl'), 'wb').write(
+    ...     'CHIP Keyboard { OUT out[16]; PARTS: Not16(in=false, out=out); }')
+    >>> load_netlist(path) is None
+    True
+    >>> shutil.rmtree(directory)
+    '''
+    netpath = path[:-len('.hdl')] + NETLIST_EXTENSION
+    if not os.path.exists(netpath):
+        return None
+    netlist, sources = read_netlist(netpath)
+    for source, mtime in sources.items():
+        if not os.path.exists(source) or os.path.getmtime(source) != mtime:
+            return None
+    if os.path.abspath(path) not in sources:
+        return None
+    library = Library(os.path.dirname(path) or '.')
+    for name, _, _, _ in netlist.boxes:
+        if library.definition(name) is not None:
+            return None
+    return netlist
+
+
+def path_depths(netlist):
+    '''
+    Returns the longest path, in Nand gates, from each input pin to each
+    output pin, as {(input, output): depth}, for the pairs with a path.
+    The DFFs count as one more input and output, STATE: a path ending
+    at STATE reaches some DFF\'s input, and one from STATE starts at
+    some DFF\'s output.
+
+    >>> sorted(path_depths(flatten_text(\'\'\'
+    ... CHIP Bit { IN in, load; OUT out;
+    ...     PARTS: Mux(a=out1, b=in, sel=load, out=d); DFF(in=d, out=out, out=out1); }\'\'\')).items())
+    [(('DFF', 'DFF'), 4), (('DFF', 'out'), 0), (('in', 'DFF'), 4), (('load', 'DFF'), 5)]
+    '''
+    if netlist.boxes:
+        raise HDLError('%s has boxes, which have no depth' % netlist.name)
+    order, _ = levelize(netlist)
+    nand_a, nand_b, nand_out = netlist.nand_a, netlist.nand_b, netlist.nand_out
+    sources = [(pin, netlist.pins[pin]) for pin, _ in netlist.inputs]
+    sinks = [(pin, netlist.pins[pin]) for pin, _ in netlist.outputs]
+    if netlist.dff_in:
+        sources.append((STATE, netlist.dff_out))
+        sinks.append((STATE, netlist.dff_in))
+    depths = {}
+    for source, source_wires in sources:
+        arrival = [-1] * netlist.wires
+        for wire in source_wires:
+            if wire > TRUE:
+                arrival[wire] = 0
+        for gate in order:
+            depth = max(arrival[nand_a[gate]], arrival[nand_b[gate]])
+            if depth >= 0:
+                arrival[nand_out[gate]] = depth + 1
+        for sink, sink_wires in sinks:
+            depth = max(arrival[wire] for wire in sink_wires)
+            if depth >= 0:
+                depths[source, sink] = depth
+    return depths
+
+
+def combinational_wires(model, inputs):
+    '''
+    Returns the wires of a box's inputs that its outputs depend on
+    between clocks: all but the model's clocked pins.
+    '''
+    return [wire for pin, wires in inputs if pin not in model.clocked for wire in wires]
+
+
+def levelize(netlist):
+    '''
+    Orders the combinational nodes (Nand gates, then boxes, numbered
+    after the gates) so every node comes after the nodes driving its
+    inputs. Returns the order and each node's level: 1 + the highest
+    level among its inputs' drivers, 0 for inputs, constants and DFF
+    outputs.
+
+    >>> order, levels = levelize(flatten_text(\'\'\'
+    ... CHIP And { IN a, b; OUT out;
+    ...     PARTS: Nand(a=n, b=n, out=out); Nand(a=a, b=b, out=n); }\'\'\'))
+    >>> order, levels.tolist()
+    ([1, 0], [2, 1])
+    '''
+    gates = len(netlist.nand_out)
+    nodes = gates + len(netlist.boxes)
+    inputs = [None] * nodes
+    driver = {}
+    for gate in xrange(gates):
+        inputs[gate] = (netlist.nand_a[gate], netlist.nand_b[gate])
+        driver[netlist.nand_out[gate]] = gate
+    for index, (_, model, box_inputs, box_outputs) in enumerate(netlist.boxes):
+        node = gates + index
+        inputs[node] = combinational_wires(model, box_inputs)
+        for _, wires in box_outputs:
+            for wire in wires:
+                driver[wire] = node
+    fanout = {}
+    pending = array('i', [0]) * nodes
+    for node in xrange(nodes):
+        for wire in set(inputs[node]):
+            if wire in driver:
+                fanout.setdefault(driver[wire], []).append(node)
+                pending[node] += 1
+    levels = array('i', [0]) * nodes
+    ready = deque(node for node in xrange(nodes) if not pending[node])
+    order = []
+    while ready:
+        node = ready.popleft()
+        order.append(node)
+        levels[node] += 1
+        level = levels[node]
+        for successor in fanout.get(node, ()):
+            if levels[successor] < level:
+                levels[successor] = level
+            pending[successor] -= 1
+            if not pending[successor]:
+                ready.append(successor)
+    if len(order) != nodes:
+        raise HDLError('%s has a combinational loop' % netlist.name)
+    return order, levels
+
+
+def box_functions(model, inputs, outputs, w):
+    '''
+    Returns functions that evaluate and clock a box: copying its input
+    wires into the model's pins, and its output pins back to wires.
+    '''
+    pins = model.pins
+
+    def read_inputs():
+        for pin, wires in inputs:
+            value = 0
+            for bit, wire in enumerate(wires):
+                value |= w[wire] << bit
+            pins[pin] = value
+
+    def evaluate():
+        read_inputs()
+        model.eval()
+        for pin, wires in outputs:
+            value = pins[pin]
+            for bit, wire in enumerate(wires):
+                w[wire] = value >> bit & 1
+
+    def clock():
+        read_inputs()
+        model.clock()
+    return evaluate, clock
+
+
+def compile_evaluation(netlist, order, box_evaluators, ones=1):
+    '''
+    Compiles the evaluation order into Python functions of w, the wire
+    list, and returns one function that runs them all. ones is a wire
+    with every lane set, 1 unless wires carry several lanes.
+    '''
+    gates = len(netlist.nand_out)
+    nand_a, nand_b, nand_out = netlist.nand_a, netlist.nand_b, netlist.nand_out
+    namespace = {'boxes': box_evaluators}
+    names = []
+    for start in xrange(0, len(order), EVALUATION_CHUNK):
+        name = 'evaluate%d' % len(names)
+        lines = ['def %s(w):' % name]
+        for node in order[start:start + EVALUATION_CHUNK]:
+            if node < gates:
+                lines.append('w[%d] = %d ^ (w[%d] & w[%d])' % (nand_out[node], ones, nand_a[node], nand_b[node]))
+            else:
+                lines.append('boxes[%d]()' % (node - gates))
+        exec '\n    '.join(lines) in namespace
+        names.append(name)
+    functions = [namespace[name] for name in names]
+
+    def evaluate(w):
+        for function in functions:
+            function(w)
+    return evaluate
+
+
+class Simulator(object):
+    '''
+    Simulates a Netlist with the chips.py chip interface: pins read and
+    written by name, eval(), tick() and tock(). DFFs latch their inputs
+    on tick and show them on tock.
+
+    Internal state is reached by part chip name, as Part[i], which reads
+    the part's DFFs as 16 bit words in the order they were created
+    (word i of a RAM built from Registers), or a box's own state.
+    '''
+    def __init__(self, netlist, lanes=1):
+        self.netlist = netlist
+        self.lanes = lanes
+        self.ones = (1 << lanes) - 1
+        self.name = netlist.name
+        self.inputs = netlist.inputs
+        self.outputs = netlist.outputs
+        self.widths = dict(netlist.inputs + netlist.outputs)
+        self.w = [0] * netlist.wires
+        self.w[TRUE] = self.ones
+        self.state = [0] * len(netlist.dff_in)
+        self.boxes = []
+        self.box_clocks = []
+        for _, model, inputs, outputs in netlist.boxes:
+            evaluate, clock = box_functions(model, inputs, outputs, self.w)
+            self.boxes.append(evaluate)
+            self.box_clocks.append(clock)
+        self.order, self.levels = levelize(netlist)
+        self.evaluate = self.compile()
+        self.eval()
+
+    def compile(self):
+        '''
+        Returns the function that evaluates the wires.
+        '''
+        return compile_evaluation(self.netlist, self.order, self.boxes, self.ones)
+
+    def width(self, name):
+        return self.widths.get(name, chips.WIDTH)
+
+    def get(self, name):
+        if name in self.widths:
+            w = self.w
+            value = 0
+            for bit, wire in enumerate(self.netlist.pins[name]):
+                value |= w[wire] << bit
+            return value
+        part, index = chips.split_reference(name)
+        return self.internal(part, index)
+
+    def set(self, name, value):
+        if name in self.widths:
+            w = self.w
+            for bit, wire in enumerate(self.netlist.pins[name]):
+                if wire > TRUE:
+                    w[wire] = value >> bit & 1
+        else:
+            part, index = chips.split_reference(name)
+            self.set_internal(part, index, value & chips.MASK)
+
+    def part_dffs(self, part, index):
+        '''
+        Returns the DFF numbers of word index of a part.
+        '''
+        location = self.netlist.parts.get(part)
+        if not isinstance(location, tuple):
+            raise ChipError('%s has no part %s' % (self.name, part))
+        first, end = location
+        first += chips.WIDTH * (index or 0)
+        if first >= end:
+            raise ChipError('%s[%d] is out of range' % (part, index))
+        return xrange(first, min(end, first + chips.WIDTH))
+
+    def box_model(self, part):
+        location = self.netlist.parts.get(part)
+        if isinstance(location, int):
+            return self.netlist.boxes[location][1]
+        return None
+
+    def internal(self, part, index):
+        model = self.box_model(part)
+        if model is not None:
+            return model.internal(part, index)
+        state = self.state
+        return sum(state[dff] << bit for bit, dff in enumerate(self.part_dffs(part, index)))
+
+    def set_internal(self, part, index, value):
+        model = self.box_model(part)
+        if model is not None:
+            model.set_internal(part, index, value)
+            return
+        dff_out = self.netlist.dff_out
+        for bit, dff in enumerate(self.part_dffs(part, index)):
+            self.state[dff] = self.w[dff_out[dff]] = value >> bit & 1
+
+    def command(self, words, directory='.'):
+        for name, model, _, _ in self.netlist.boxes:
+            if name == words[0]:
+                model.command(words, directory)
+                return
+        raise ChipError('Unknown command: %s' % ' '.join(words))
+
+    def eval(self):
+        self.evaluate(self.w)
+
+    def tick(self):
+        self.evaluate(self.w)
+        w = self.w
+        self.state = [w[wire] for wire in self.netlist.dff_in]
+        for clock in self.box_clocks:
+            clock()
+
+    def tock(self):
+        w = self.w
+        for wire, value in zip(self.netlist.dff_out, self.state):
+            w[wire] = value
+        self.evaluate(w)
+
+
+class EventSimulator(Simulator):
+    '''
+    A Simulator that evaluates only the nodes (gates and boxes) whose
+    inputs changed since the last evaluation. Each wire has a fan-out
+    list of the nodes reading it, computed once from the netlist. An
+    evaluation compares the sources (the chip's inputs and the DFF
+    outputs) with their values last time, and schedules the readers of
+    those that changed; a node whose output changes schedules its own
+    readers. Nodes are run level by level, so each runs at most once,
+    after everything driving it.
+
+    Boxes are clocked on tick, so they are all scheduled for the next
+    evaluation. Flattened with memories, a write to a RAM16K is one box
+    evaluation instead of a pass over 16K Registers.
+
+    >>> simulator = EventSimulator(flatten_text(\'\'\'
+    ... CHIP And3 { IN a, b, c; OUT out;
+    ...     PARTS: And(a=a, b=b, out=ab); And(a=ab, b=c, out=out); }\'\'\'))
+    >>> simulator.evaluations
+    4
+    >>> simulator.set('a', 1); simulator.set('b', 1); simulator.set('c', 1); simulator.eval()
+    >>> simulator.get('out'), simulator.evaluations
+    (1, 8)
+    >>> simulator.set('c', 0); simulator.eval()
+    >>> simulator.get('out'), simulator.evaluations
+    (0, 10)
+    '''
+    def compile(self):
+        netlist = self.netlist
+        gates = len(netlist.nand_out)
+        self.evaluations = 0
+        self.fanout = fanout = [()] * netlist.wires
+        for node in xrange(gates + len(netlist.boxes)):
+            if node < gates:
+                wires = set([netlist.nand_a[node], netlist.nand_b[node]])
+            else:
+                _, model, inputs, _ = netlist.boxes[node - gates]
+                wires = set(combinational_wires(model, inputs))
+            for wire in wires:
+                fanout[wire] += (node,)
+        self.box_outputs = [[wire for _, wires in outputs for wire in wires]
+                            for _, _, _, outputs in netlist.boxes]
+        self.sources = sorted(set(
+            [wire for pin, _ in netlist.inputs for wire in netlist.pins[pin] if wire > TRUE] +
+            list(netlist.dff_out)))
+        self.seen = dict((wire, 0) for wire in self.sources)
+        self.buckets = [[] for _ in xrange(max(self.levels or [0]) + 1)]
+        self.scheduled = bytearray(len(self.levels))
+        # the first evaluation runs every node
+        for node in self.order:
+            self.schedule(node)
+        return self.propagate
+
+    def schedule(self, node):
+        if not self.scheduled[node]:
+            self.scheduled[node] = 1
+            self.buckets[self.levels[node]].append(node)
+
+    def propagate(self, w):
+        netlist = self.netlist
+        nand_a, nand_b, nand_out = netlist.nand_a, netlist.nand_b, netlist.nand_out
+        gates = len(nand_out)
+        fanout = self.fanout
+        levels = self.levels
+        buckets = self.buckets
+        scheduled = self.scheduled
+        seen = self.seen
+        for wire in self.sources:
+            value = w[wire]
+            if value != seen[wire]:
+                seen[wire] = value
+                for node in fanout[wire]:
+                    if not scheduled[node]:
+                        scheduled[node] = 1
+                        buckets[levels[node]].append(node)
+        evaluations = 0
+        for bucket in buckets:
+            if not bucket:
+                continue
+            evaluations += len(bucket)
+            for node in bucket:
+                scheduled[node] = 0
+                if node < gates:
+                    out = nand_out[node]
+                    value = 1 ^ (w[nand_a[node]] & w[nand_b[node]])
+                    if value == w[out]:
+                        continue
+                    w[out] = value
+                    changed = fanout[out]
+                else:
+                    outputs = self.box_outputs[node - gates]
+                    before = [w[wire] for wire in outputs]
+                    self.boxes[node - gates]()
+                    changed = [successor for wire, value in zip(outputs, before)
+                               if w[wire] != value for successor in fanout[wire]]
+                for successor in changed:
+                    if not scheduled[successor]:
+                        scheduled[successor] = 1
+                        buckets[levels[successor]].append(successor)
+            del bucket[:]
+        self.evaluations += evaluations
+
+    def schedule_boxes(self):
+        gates = len(self.netlist.nand_out)
+        for box in xrange(len(self.boxes)):
+            self.schedule(gates + box)
+
+    def set_internal(self, part, index, value):
+        super(EventSimulator, self).set_internal(part, index, value)
+        self.schedule_boxes()
+
+    def command(self, words, directory='.'):
+        super(EventSimulator, self).command(words, directory)
+        self.schedule_boxes()
+
+    def tick(self):
+        super(EventSimulator, self).tick()
+        self.schedule_boxes()
+
+
+class ParallelSimulator(Simulator):
+    '''
+    Simulates lanes copies of a netlist at once. Each wire is an int
+    whose bit i is the wire's value in lane i, so one pass over the
+    Nand gates evaluates every lane, and pins are read and written as
+    lists of per-lane values. Boxes have no bitwise form, so netlists
+    with boxes can't run in lanes.
+
+    >>> simulator = ParallelSimulator(flatten_text(\'\'\'
+    ... CHIP And2 { IN a[2], b[2]; OUT out[2];
+    ...     PARTS: And(a=a[0], b=b[0], out=out[0]); And(a=a[1], b=b[1], out=out[1]); }\'\'\'), 3)
+    >>> simulator.set('a', [3, 3, 1]); simulator.set('b', [1, 2, 3]); simulator.eval()
+    >>> simulator.get('out')
+    [1, 2, 1]
+    '''
+    def __init__(self, netlist, lanes=LANES):
+        if netlist.boxes:
+            raise HDLError('%s contains %s, which can\'t run in lanes' % (
+                netlist.name, ', '.join(sorted(set(name for name, _, _, _ in netlist.boxes)))))
+        super(ParallelSimulator, self).__init__(netlist, lanes)
+
+    def get(self, name):
+        if name in self.widths:
+            return self.read_lanes(self.w, self.netlist.pins[name])
+        part, index = chips.split_reference(name)
+        return self.internal(part, index)
+
+    def set(self, name, values):
+        if name in self.widths:
+            self.write_lanes(self.w, self.netlist.pins[name], values)
+        else:
+            part, index = chips.split_reference(name)
+            self.set_internal(part, index, values)
+
+    def read_lanes(self, bits, indices):
+        '''
+        Returns each lane's value of the bits at indices, least
+        significant first.
+        '''
+        values = [0] * self.lanes
+        for bit, index in enumerate(indices):
+            lanes = bits[index]
+            lane = 0
+            while lanes:
+                if lanes & 1:
+                    values[lane] |= 1 << bit
+                lanes >>= 1
+                lane += 1
+        return values
+
+    def write_lanes(self, bits, indices, values):
+        for bit, index in enumerate(indices):
+            if index > TRUE or bits is not self.w:
+                lanes = 0
+                for lane, value in enumerate(values):
+                    lanes |= (value >> bit & 1) << lane
+                bits[index] = lanes
+
+    def internal(self, part, index):
+        return self.read_lanes(self.state, self.part_dffs(part, index))
+
+    def set_internal(self, part, index, values):
+        dffs = self.part_dffs(part, index)
+        self.write_lanes(self.state, dffs, values)
+        dff_out = self.netlist.dff_out
+        for dff in dffs:
+            self.w[dff_out[dff]] = self.state[dff]
+
+
+def exhaustive_vectors(inputs):
+    '''
+    Yields every combination of input values, as {pin: value} dicts.
+
+    >>> list(exhaustive_vectors([('a', 1), ('sel', 2)]))[:3]
+    [{'a': 0, 'sel': 0}, {'a': 1, 'sel': 0}, {'a': 0, 'sel': 1}]
+    '''
+    total = sum(width for _, width in inputs)
+    for combination in xrange(1 << total):
+        vector = {}
+        for pin, width in inputs:
+            vector[pin] = combination & chips.mask(width)
+            combination >>= width
+        yield vector
+
+
+def random_vectors(inputs, count, seed=0):
+    generator = random.Random(seed)
+    for _ in xrange(count):
+        yield dict((pin, generator.getrandbits(width)) for pin, width in inputs)
+
+
+def test_vectors(inputs, count=RANDOM_VECTORS):
+    '''
+    Every input combination if there are at most EXHAUSTIVE_BITS input
+    bits, else count random ones. Returns the vectors and whether they
+    are exhaustive.
+    '''
+    if sum(width for _, width in inputs) <= EXHAUSTIVE_BITS:
+        return exhaustive_vectors(inputs), True
+    return random_vectors(inputs, count), False
+
+
+def batches(vectors, size):
+    batch = []
+    for vector in vectors:
+        batch.append(vector)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def verify(netlist, model, vectors, lanes=LANES):
+    '''
+    Runs a netlist on vectors, lanes at a time, and compares its outputs
+    with a chips.py model's. Returns the number of vectors and a list of
+    (vector, pin, expected, actual) mismatches.
+
+    A sequential model (one with clocked inputs) takes the vectors as a
+    sequence, a clock cycle each in every lane, and is compared after
+    eval and again after tick and tock. Netlists with boxes run in one
+    lane.
+
+    >>> netlist = flatten_text(\'\'\'
+    ... CHIP Or { IN a, b; OUT out;
+    ...     PARTS: Nand(a=a, b=a, out=na); Nand(a=b, b=b, out=nb); Nand(a=na, b=nb, out=out); }\'\'\')
+    >>> verify(netlist, chips.BUILTINS['Or'](), exhaustive_vectors(netlist.inputs))
+    (4, [])
+    >>> verify(netlist, chips.BUILTINS['And'](), exhaustive_vectors(netlist.inputs))[1][0]
+    ({'a': 1, 'b': 0}, 'out', 0, 1)
+    >>> netlist = flatten_text(\'\'\'
+    ... CHIP Bit { IN in, load; OUT out;
+    ...     PARTS: Mux(a=out1, b=in, sel=load, out=d); DFF(in=d, out=out, out=out1); }\'\'\')
+    >>> verify(netlist, chips.BUILTINS['Bit'](), random_vectors(netlist.inputs, 100))
+    (100, [])
+    >>> netlist = Flattener(Library()).flatten('CPU')
+    >>> verify(netlist, chips.BUILTINS['CPU'](), random_vectors(netlist.inputs, 1000))
+    (1000, [])
+    '''
+    if netlist.boxes:
+        lanes = 1
+        simulator = Simulator(netlist)
+        write = lambda pin, values: simulator.set(pin, values[0])
+        read = lambda pin: [simulator.get(pin)]
+    else:
+        simulator = ParallelSimulator(netlist, lanes)
+        write, read = simulator.set, simulator.get
+    models = [model] + [type(model)() for _ in xrange(lanes - 1)]
+    count = 0
+    mismatches = []
+
+    def compare(batch):
+        actual = dict((pin, read(pin)) for pin, _ in netlist.outputs)
+        for lane, vector in enumerate(batch):
+            for pin, _ in netlist.outputs:
+                expected = models[lane].get(pin)
+                if expected != actual[pin][lane]:
+                    mismatches.append((vector, pin, expected, actual[pin][lane]))
+
+    for batch in batches(vectors, lanes):
+        for pin, _ in netlist.inputs:
+            write(pin, [vector[pin] for vector in batch])
+        for lane, vector in enumerate(batch):
+            for pin, value in vector.items():
+                models[lane].set(pin, value)
+            models[lane].eval()
+        simulator.eval()
+        compare(batch)
+        if model.clocked:
+            simulator.tick()
+            simulator.tock()
+            for lane in xrange(len(batch)):
+                models[lane].tick()
+                models[lane].tock()
+            compare(batch)
+        count += len(batch)
+    return count, mismatches
+
+
+def run_verify(netlist, lanes, count):
+    '''
+    Verifies a chip against its built-in model, printing a report.
+    Returns the number of mismatches.
+    '''
+    if netlist.name not in chips.BUILTINS:
+        print '%s: only chips with a built-in model can be verified' % netlist.name
+        return 1
+    vectors, exhaustive = test_vectors(netlist.inputs, count)
+    start = time.time()
+    checked, mismatches = verify(netlist, chips.BUILTINS[netlist.name](), vectors, lanes)
+    seconds = time.time() - start
+    print '%s: %d %s vectors in %d lanes, %d mismatches (%.2fs)' % (
+        netlist.name, checked, 'exhaustive' if exhaustive else 'random',
+        1 if netlist.boxes else lanes, len(mismatches), seconds)
+    for vector, pin, expected, actual in mismatches[:10]:
+        print '  %s: %s is %d, expected %d' % (
+            ', '.join('%s=%d' % item for item in sorted(vector.items())), pin, actual, expected)
+    return len(mismatches)
+
+
+def verify_builtins(directory, lanes, count):
+    '''
+    Verifies the models of FAST_CHIPS against their HDL, found from
+    directory. Each chip is flattened with the other FAST_CHIPS boxed
+    as their models, so it is checked one level of HDL deep, and a
+    mismatch points at the chip whose own HDL is wrong. Returns the
+    number of chips that failed.
+    '''
+    library = Library(directory)
+    failed = 0
+    for name in FAST_CHIPS:
+        if library.definition(name) is None:
+            print '%s: no HDL' % name
+            continue
+        builtins = [chip for chip in FAST_CHIPS if chip != name]
+        if run_verify(Flattener(library, builtins=builtins).flatten(name), lanes, count):
+            failed += 1
+    return failed
+
+
+def main(args):
+    lanes = LANES
+    count = RANDOM_VECTORS
+    check = False
+    check_builtins = False
+    memories = False
+    while args and args[0].startswith('--'):
+        if args[0] == '--memories':
+            memories = True
+        elif args[0] == '--verify-builtins':
+            check_builtins = True
+        elif args[0].startswith('--verify-builtins='):
+            check_builtins = True
+            count = int(args[0][len('--verify-builtins='):])
+        elif args[0] == '--verify':
+            check = True
+        elif args[0].startswith('--verify='):
+            check = True
+            count = int(args[0][len('--verify='):])
+        elif args[0].startswith('--lanes='):
+            lanes = int(args[0][len('--lanes='):])
+        else:
+            print_usage()
+            return -1
+        args = args[1:]
+    if check_builtins and len(args) <= 1:
+        directory = args[0] if args else '.'
+        if not os.path.isdir(directory):
+            print 'directory not found'
+            return 1
+        try:
+            return 1 if verify_builtins(directory, lanes, count) else 0
+        except HDLError as e:
+            print 'error: %s' % e
+            return 1
+    if len(args) != 1 or not args[0].endswith('.hdl'):
+        print_usage()
+        return -1
+    path, = args
+    if not os.path.exists(path):
+        print 'file not found'
+        return 1
+    try:
+        netlist = flatten(path, memories=memories)
+        order, levels = levelize(netlist)
+        if check:
+            return 1 if run_verify(netlist, lanes, count) else 0
+    except HDLError as e:
+        print 'error: %s' % e
+        return 1
+    print '%s: %d wires, %d Nand gates, %d DFFs, %d boxes (%s), %d levels' % (
+        netlist.name, netlist.wires, len(netlist.nand_out), len(netlist.dff_in),
+        len(netlist.boxes), ', '.join(sorted(set(name for name, _, _, _ in netlist.boxes))) or '-',
+        max(levels) if levels else 0)
+    return 0
+
+def print_usage():
+        print 'usage: hdl.py [--memories] [--verify[=RANDOM_VECTORS]] [--lanes=N] path/to/Chip.hdl'
+        print '       hdl.py --verify-builtins[=RANDOM_VECTORS] [--lanes=N] [path/to/directory]'
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
+
+    sys.exit(main(sys.argv[1:]))
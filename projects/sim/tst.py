@@ -0,0 +1,642 @@
+#!/usr/bin/python2
+'''
+Runs nand2tetris test scripts (.tst) headlessly, comparing their output
+with the .cmp files, like the Java Hardware Simulator, CPU Emulator and
+VM Emulator do interactively.
+
+The script's load command picks the engine:
+
+    load Chip.hdl       the chip's behavioral model from chips.py, or
+                        with --hdl (or when there is no model) the
+                        .hdl file itself, simulated by hdl.py; with
+                        --hdl=events, event-driven, and its memory
+                        parts as arrays; with --hdl=fast, event-driven
+                        with hdl.FAST_CHIPS parts as their models.
+                        Plain --hdl skips chips of more than
+                        COMPILED_GATES Nand gates, which take minutes
+                        to simulate gate by gate
+    load Prog.asm/hack  hackemu.py's Emulator; a missing .hack is
+                        assembled from its .asm, and a missing .asm is
+                        translated from the directory's .vm files
+    load Prog.vm, load  vmemu.py's VirtualMachine, with the compiled
+                        OS from tools/OS for classes the directory lacks
+
+Every output line is checked against the .cmp file as it is written
+('*' in the .cmp matches anything), and the script stops at the first
+mismatch. The .out file is written either way.
+
+    >>> script = Script.from_text(\'\'\'
+    ... load Xor.hdl,
+    ... output-list a%B1.1.1 b%B1.1.1 out%B1.1.1;
+    ... set a 1, eval, output;
+    ... repeat 2 { set b 1, eval, output; }\'\'\')
+    >>> script.run()
+    >>> print '\\n'.join(script.lines)
+    | a | b |out|
+    | 1 | 0 | 1 |
+    | 1 | 1 | 0 |
+    | 1 | 1 | 0 |
+
+Given directories, tst.py runs every script under them on a process
+pool. Scripts that need a person at the keyboard (an endless repeat,
+or a while loop waiting for a key) or have nothing to compare are
+skipped.
+'''
+
+from glob import glob
+from multiprocessing import Pool, cpu_count
+import os
+import re
+import sys
+import time
+
+PROJECTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.append(os.path.join(PROJECTS, '06'))
+sys.path.append(os.path.join(PROJECTS, '08'))
+
+import analyze
+import chips
+from chips import ChipError
+import hackemu
+from hackemu import EmulatorError
+import hdl
+from hdl import HDLError
+import vm
+import vmemu
+from vmemu import VMError
+
+OS_DIRECTORY = os.path.join(PROJECTS, os.pardir, 'tools', 'OS')
+COMMENT = re.compile(r'//[^\n]*|/\*.*?\*/', re.S)
+TOKEN = re.compile(r'"[^"]*"|[{},;!]|[^\s{},;!"]+')
+TERMINATORS = ',;!'
+COLUMN = re.compile(r'^(.+)%([BDXS])(\d+)\.(\d+)\.(\d+)$')
+# a while loop that runs this long is waiting for a key press
+WHILE_LIMIT = 10 ** 5
+WILDCARD = '*'
+PASS, FAIL, SKIP, ERROR = 'PASS', 'FAIL', 'SKIP', 'ERROR'
+REPEAT, WHILE, COMMAND = range(3)
+COMPILED, EVENTS, FAST = 'compiled', 'events', 'fast'
+# the most Nand gates a chip may have to be simulated --hdl=compiled
+COMPILED_GATES = 2 * 10 ** 5
+# --hdl=name: (simulator, hdl.flatten() options)
+SIMULATIONS = {
+    COMPILED: (hdl.Simulator, {}),
+    EVENTS: (hdl.EventSimulator, {'memories': True}),
+    FAST: (hdl.EventSimulator, {'builtins': hdl.FAST_CHIPS}),
+}
+CONDITIONS = {
+    '=': lambda a, b: a == b,
+    '<>': lambda a, b: a != b,
+    '<': lambda a, b: a < b,
+    '>': lambda a, b: a > b,
+    '<=': lambda a, b: a <= b,
+    '>=': lambda a, b: a >= b,
+}
+
+
+class ScriptError(Exception):
+    pass
+
+
+class Skipped(Exception):
+    '''
+    Raised for scripts that can't run headlessly, or not in reasonable
+    time.
+    '''
+    pass
+
+
+class ComparisonError(Exception):
+    def __init__(self, line, expected, actual):
+        super(ComparisonError, self).__init__(
+            'comparison failure at line %d:\n  expected %s\n  got      %s' % (line, expected, actual))
+        self.line = line
+
+
+def tokenize(text):
+    '''
+    >>> tokenize('set a %B01, // comment\\nrepeat 2 {tick;}')
+    ['set', 'a', '%B01', ',', 'repeat', '2', '{', 'tick', ';', '}']
+    '''
+    return TOKEN.findall(COMMENT.sub('', text))
+
+
+def parse(tokens):
+    '''
+    Returns a list of (REPEAT, count, body), (WHILE, condition, body)
+    and (COMMAND, words) tuples. A repeat without a count repeats
+    forever (count is None).
+
+    >>> parse(tokenize('output-list a%D1.6.1; repeat { tick, tock; } output'))
+    [(2, ['output-list', 'a%D1.6.1']), (0, None, [(2, ['tick']), (2, ['tock'])]), (2, ['output'])]
+    '''
+    commands, position = parse_block(tokens, 0)
+    if position != len(tokens):
+        raise ScriptError('Unexpected %s' % tokens[position])
+    return commands
+
+
+def parse_block(tokens, position):
+    commands = []
+    words = []
+    while position < len(tokens):
+        token = tokens[position]
+        position += 1
+        if token in TERMINATORS:
+            if words:
+                commands.append((COMMAND, words))
+            words = []
+        elif token == '}':
+            if words:
+                commands.append((COMMAND, words))
+            return commands, position - 1
+        elif token == '{':
+            if not words or words[0] not in ('repeat', 'while'):
+                raise ScriptError('Unexpected {')
+            body, position = parse_block(tokens, position)
+            if position >= len(tokens):
+                raise ScriptError('Missing }')
+            position += 1
+            if words[0] == 'repeat':
+                if len(words) > 2:
+                    raise ScriptError('Invalid repeat: %s' % ' '.join(words))
+                commands.append((REPEAT, int(words[1]) if len(words) == 2 else None, body))
+            else:
+                if len(words) != 4 or words[2] not in CONDITIONS:
+                    raise ScriptError('Invalid while: %s' % ' '.join(words))
+                commands.append((WHILE, words[1:], body))
+            words = []
+        else:
+            words.append(token)
+    if words:
+        commands.append((COMMAND, words))
+    return commands, position
+
+
+def parse_value(text):
+    '''
+    >>> [parse_value(text) for text in ['%B0101', '%X2000', '%D-5', '-32123']]
+    [5, 8192, -5, -32123]
+    '''
+    try:
+        if text.startswith('%B'):
+            return int(text[2:], 2)
+        if text.startswith('%X'):
+            return int(text[2:], 16)
+        if text.startswith('%D'):
+            return int(text[2:])
+        return int(text)
+    except ValueError:
+        raise ScriptError('Invalid value: %s' % text)
+
+
+class Column(object):
+    '''
+    An output-list entry, like out%D1.6.1: the variable, its format
+    (Binary, Decimal, heXadecimal or String), and the padding and width
+    of its cells.
+
+    >>> column = Column('RAM[256]%D2.6.2')
+    >>> column.header(), column.cell(-1)
+    (' RAM[256] ', '      -1  ')
+    >>> Column('address%B1.15.1').cell(5)
+    ' 000000000000101 '
+    '''
+    def __init__(self, text):
+        match = COLUMN.match(text)
+        if match is None:
+            raise ScriptError('Invalid output format: %s' % text)
+        self.name, self.format = match.group(1, 2)
+        self.left, self.width, self.right = [int(group) for group in match.group(3, 4, 5)]
+
+    def header(self):
+        size = self.left + self.width + self.right
+        name = self.name[:size]
+        left = (size - len(name)) / 2
+        return ' ' * left + name + ' ' * (size - len(name) - left)
+
+    def cell(self, value):
+        width = self.width
+        if self.format == 'D':
+            text = str(value).rjust(width)
+        elif self.format == 'S':
+            text = str(value).ljust(width)
+        elif self.format == 'B':
+            text = bin(value & chips.mask(width))[2:].zfill(width)
+        else:
+            text = ('%x' % (value & chips.mask(4 * width))).zfill(width)
+        return ' ' * self.left + text + ' ' * self.right
+
+
+def matches(expected, actual):
+    '''
+    >>> matches('|  1 |*****|', '|  1 |   -3|'), matches('| 1 |', '| 2 |')
+    (True, False)
+    '''
+    if len(expected) != len(actual):
+        return False
+    for wanted, got in zip(expected, actual):
+        if wanted != got and wanted != WILDCARD:
+            return False
+    return True
+
+
+class ChipEngine(object):
+    '''
+    Runs a chip model; time counts clock cycles, with a + after a tick.
+    '''
+    def __init__(self, chip):
+        self.chip = chip
+        self.time = 0
+        self.ticked = False
+        self.steps = {'eval': self.eval, 'tick': self.tick, 'tock': self.tock}
+
+    def eval(self):
+        self.chip.eval()
+
+    def tick(self):
+        self.chip.tick()
+        self.ticked = True
+
+    def tock(self):
+        self.chip.tock()
+        self.time += 1
+        self.ticked = False
+
+    def get(self, name):
+        if name == 'time':
+            return '%d%s' % (self.time, '+' if self.ticked else '')
+        return chips.signed(self.chip.get(name), self.chip.width(name))
+
+    def set(self, name, value):
+        self.chip.set(name, value)
+
+    def run(self, step, count):
+        step = self.steps[step]
+        for _ in xrange(count):
+            step()
+
+    def command(self, words, directory):
+        self.chip.command(words, directory)
+
+
+class CpuEngine(object):
+    '''
+    Runs machine code; ticktock executes an instruction.
+    '''
+    def __init__(self, words):
+        self.emulator = hackemu.Emulator(words)
+        self.steps = {'ticktock': self.emulator.run}
+
+    def get(self, name):
+        emulator = self.emulator
+        if name == 'time':
+            return emulator.cycles
+        if name == 'PC':
+            return emulator.pc
+        if name in ('A', 'D'):
+            return getattr(emulator, name.lower())
+        return emulator.ram[ram_address(name)]
+
+    def set(self, name, value):
+        emulator = self.emulator
+        if name == 'PC':
+            emulator.pc = value
+        elif name in ('A', 'D'):
+            setattr(emulator, name.lower(), wrap(value))
+        else:
+            emulator.poke(ram_address(name), value)
+
+    def run(self, step, count):
+        self.steps[step](count)
+
+    def command(self, words, directory):
+        raise ScriptError('Unknown command: %s' % ' '.join(words))
+
+
+class VmEngine(object):
+    '''
+    Runs VM code; vmstep executes a command. The pointers are sp,
+    local, argument, this and that, and segment entries are reached as
+    local[2], temp[0] and so on.
+    '''
+    POINTERS = {'sp': vmemu.SP, 'local': vmemu.LCL, 'argument': vmemu.ARG,
+                'this': vmemu.THIS, 'that': vmemu.THAT}
+
+    def __init__(self, commands):
+        self.machine = vmemu.VirtualMachine(commands)
+        self.steps = {'vmstep': self.machine.run}
+
+    def address(self, name):
+        if name in self.POINTERS:
+            return self.POINTERS[name]
+        if name.startswith('RAM['):
+            return ram_address(name)
+        try:
+            segment, index = chips.split_reference(name)
+            return self.machine.segment_address(segment, index)
+        except (ChipError, KeyError, TypeError):
+            raise ScriptError('Unknown variable: %s' % name)
+
+    def get(self, name):
+        return self.machine.ram[self.address(name)]
+
+    def set(self, name, value):
+        self.machine.ram[self.address(name)] = wrap(value)
+
+    def run(self, step, count):
+        self.steps[step](count)
+
+    def command(self, words, directory):
+        raise ScriptError('Unknown command: %s' % ' '.join(words))
+
+
+def wrap(value):
+    return ((value + 0x8000) & 0xFFFF) - 0x8000
+
+
+def ram_address(name):
+    '''
+    >>> ram_address('RAM[256]')
+    256
+    '''
+    if not name.startswith('RAM[') or not name.endswith(']'):
+        raise ScriptError('Unknown variable: %s' % name)
+    return int(name[4:-1])
+
+
+def vm_paths(directory):
+    '''
+    The directory's .vm files, plus the OS's for classes it lacks.
+    '''
+    paths = sorted(glob(os.path.join(directory, '*.vm')))
+    classes = set(os.path.basename(path) for path in paths)
+    for path in sorted(glob(os.path.join(OS_DIRECTORY, '*.vm'))):
+        if os.path.basename(path) not in classes:
+            paths.append(path)
+    return paths
+
+
+def program_words(path):
+    '''
+    Returns the machine words of a .hack or .asm file, falling back to
+    the .asm next to a missing .hack, and to translating the directory's
+    .vm files for a missing .asm (with initialization code if there is
+    a Sys.init, like vm.py).
+    '''
+    base = os.path.splitext(path)[0]
+    for candidate in [path, base + '.asm']:
+        if os.path.exists(candidate):
+            return hackemu.load(candidate)
+    commands = vmemu.load(os.path.dirname(path) or '.')
+    if not commands:
+        raise ScriptError('file not found: %s' % path)
+    if any(isinstance(command, vm.Function) and command.name == vmemu.ENTRY_POINT
+           for command in commands):
+        asm = vm.code_with_init(commands)
+    else:
+        asm = vm.code(commands)
+    return hackemu.assemble(hackemu.parser(asm))
+
+
+def check_gates(path):
+    '''
+    Raises Skipped if the chip in an .hdl file has too many Nand gates
+    to simulate fully flattened.
+    '''
+    library = hdl.Library(os.path.dirname(path) or '.')
+    chip = os.path.basename(path)[:-len('.hdl')]
+    library.definitions[chip] = library.read(path)
+    gates = analyze.Analyzer(library).summary(chip).gates
+    if gates > COMPILED_GATES:
+        raise Skipped('%s has %d Nand gates, too many to simulate compiled; '
+                      'run with --hdl=events or --hdl=fast' % (chip, gates))
+
+
+def load_engine(directory, words, simulation=None):
+    if len(words) == 1:
+        if not glob(os.path.join(directory, '*.vm')):
+            raise Skipped('no .vm files to load')
+        commands = []
+        for path in vm_paths(directory):
+            commands += vmemu.load(path)
+        return VmEngine(commands)
+    name = words[1]
+    path = os.path.join(directory, name)
+    if name.endswith('.hdl'):
+        chip = name[:-len('.hdl')]
+        if (simulation or chip not in chips.BUILTINS) and os.path.exists(path):
+            if (simulation or COMPILED) == COMPILED:
+                check_gates(path)
+            simulator, options = SIMULATIONS[simulation or COMPILED]
+            return ChipEngine(simulator(hdl.flatten(path, **options)))
+        if chip not in chips.BUILTINS:
+            raise ScriptError('file not found: %s' % path)
+        return ChipEngine(chips.BUILTINS[chip]())
+    if name.endswith('.hack') or name.endswith('.asm'):
+        return CpuEngine(program_words(path))
+    if name.endswith('.vm'):
+        if not os.path.exists(path):
+            raise ScriptError('file not found: %s' % path)
+        return VmEngine(vmemu.load(path))
+    raise ScriptError('Cannot load %s' % name)
+
+
+class Script(object):
+    '''
+    A parsed test script. With a simulation (a SIMULATIONS key), chips
+    are simulated from their HDL even if they have a behavioral model.
+    '''
+    def __init__(self, commands, directory='.', simulation=None):
+        self.commands = commands
+        self.directory = directory
+        self.simulation = simulation
+        self.engine = None
+        self.columns = None
+        self.lines = []
+        self.expected = None
+        self.output_path = None
+
+    @classmethod
+    def from_file(cls, path, simulation=None):
+        with open(path, 'rb') as scriptfile:
+            return cls(parse(tokenize(scriptfile.read())), os.path.dirname(path) or '.', simulation)
+
+    @classmethod
+    def from_text(cls, text, directory='.'):
+        return cls(parse(tokenize(text)), directory)
+
+    def run(self):
+        try:
+            self.execute(self.commands)
+        finally:
+            if self.output_path is not None:
+                with open(self.output_path, 'wb') as outfile:
+                    outfile.write(''.join(line + '\r\n' for line in self.lines))
+        if self.expected is not None and len(self.lines) < len(self.expected):
+            raise ComparisonError(len(self.lines) + 1, self.expected[len(self.lines)], '(end of output)')
+
+    def execute(self, commands):
+        for command in commands:
+            kind = command[0]
+            if kind == REPEAT:
+                _, count, body = command
+                if count is None:
+                    raise Skipped('repeats forever')
+                self.repeat(count, body)
+            elif kind == WHILE:
+                _, (name, condition, value), body = command
+                for _ in xrange(WHILE_LIMIT):
+                    if not CONDITIONS[condition](self.variable(name), parse_value(value)):
+                        break
+                    self.execute(body)
+                else:
+                    raise Skipped('waits for input (while %s %s %s)' % (name, condition, value))
+            else:
+                self.command(command[1])
+
+    def repeat(self, count, body):
+        if len(body) == 1 and body[0][0] == COMMAND and len(body[0][1]) == 1:
+            step = body[0][1][0]
+            if self.engine is not None and step in self.engine.steps:
+                # one engine call instead of count interpreted commands
+                self.engine.run(step, count)
+                return
+        for _ in xrange(count):
+            self.execute(body)
+
+    def variable(self, name):
+        if self.engine is None:
+            raise ScriptError('Nothing loaded')
+        return self.engine.get(name)
+
+    def command(self, words):
+        name = words[0]
+        if name == 'load':
+            self.engine = load_engine(self.directory, words, self.simulation)
+        elif name == 'output-file':
+            self.output_path = os.path.join(self.directory, words[1])
+        elif name == 'compare-to':
+            with open(os.path.join(self.directory, words[1]), 'rb') as cmpfile:
+                self.expected = [line.rstrip() for line in cmpfile.read().rstrip().splitlines()]
+        elif name == 'output-list':
+            self.columns = [Column(text) for text in words[1:]]
+            self.write('|%s|' % '|'.join(column.header() for column in self.columns))
+        elif name == 'output':
+            if self.columns is None:
+                raise ScriptError('output without output-list')
+            self.write('|%s|' % '|'.join(column.cell(self.variable(column.name))
+                                         for column in self.columns))
+        elif name == 'set':
+            if len(words) != 3:
+                raise ScriptError('Invalid set: %s' % ' '.join(words))
+            self.variable(words[1])
+            self.engine.set(words[1], parse_value(words[2]))
+        elif name in ('echo', 'clear-echo', 'breakpoint', 'clear-breakpoints'):
+            pass
+        elif self.engine is None:
+            raise ScriptError('Nothing loaded')
+        elif name in self.engine.steps and len(words) == 1:
+            self.engine.run(name, 1)
+        else:
+            self.engine.command(words, self.directory)
+
+    def write(self, line):
+        if self.expected is not None:
+            number = len(self.lines)
+            if number >= len(self.expected) or not matches(self.expected[number], line):
+                expected = self.expected[number] if number < len(self.expected) else '(end of file)'
+                self.lines.append(line)
+                raise ComparisonError(number + 1, expected, line)
+        self.lines.append(line)
+
+
+def run_script(job):
+    '''
+    Runs a script, given its path and how to simulate chips; returns
+    its path, status, a message and the time it took. Runs in a worker
+    process.
+    '''
+    path, simulation = job
+    start = time.time()
+    try:
+        script = Script.from_file(path, simulation)
+        script.run()
+        if script.expected is None:
+            raise Skipped('nothing to compare')
+        status, message = PASS, ''
+    except ComparisonError as e:
+        status, message = FAIL, str(e)
+    except Skipped as e:
+        status, message = SKIP, str(e)
+    except (ScriptError, ChipError, HDLError, EmulatorError, VMError, IOError) as e:
+        status, message = ERROR, str(e)
+    return path, status, message, time.time() - start
+
+
+def find_scripts(paths):
+    scripts = []
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, filenames in sorted(os.walk(path)):
+                scripts += sorted(os.path.join(directory, filename)
+                                  for filename in filenames if filename.endswith('.tst'))
+        else:
+            scripts.append(path)
+    return scripts
+
+
+def main(args):
+    jobs = cpu_count()
+    verbose = False
+    simulation = None
+    while args and args[0].startswith('--'):
+        if args[0].startswith('--jobs='):
+            jobs = int(args[0][len('--jobs='):])
+        elif args[0] == '--hdl':
+            simulation = COMPILED
+        elif args[0].startswith('--hdl=') and args[0][len('--hdl='):] in SIMULATIONS:
+            simulation = args[0][len('--hdl='):]
+        elif args[0] == '--verbose':
+            verbose = True
+        else:
+            print_usage()
+            return -1
+        args = args[1:]
+    for path in args:
+        if not os.path.exists(path):
+            print 'file not found'
+            return 1
+    scripts = [(script, simulation) for script in find_scripts(args or [os.path.normpath(PROJECTS)])]
+
+    start = time.time()
+    if jobs > 1:
+        pool = Pool(jobs)
+        results = pool.imap(run_script, scripts)
+    else:
+        pool = None
+        results = (run_script(job) for job in scripts)
+    counts = dict.fromkeys([PASS, FAIL, SKIP, ERROR], 0)
+    try:
+        for path, status, message, seconds in results:
+            counts[status] += 1
+            if status != PASS or verbose:
+                print '%-5s %s (%.2fs)' % (status, os.path.relpath(path), seconds)
+                if message:
+                    print '      ' + message.replace('\n', '\n      ')
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    print '%d passed, %d failed, %d errors, %d skipped in %.2fs' % (
+        counts[PASS], counts[FAIL], counts[ERROR], counts[SKIP], time.time() - start)
+    return 1 if counts[FAIL] or counts[ERROR] else 0
+
+def print_usage():
+        print 'usage: tst.py [--jobs=N] [--hdl[=compiled|events|fast]] [--verbose] [path/to/[file.tst] ...]'
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
+
+    sys.exit(main(sys.argv[1:]))